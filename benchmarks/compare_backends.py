@@ -0,0 +1,192 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+from PIL import Image
+from src import image_utils
+from src import vision_tool_interface
+from .synthetic import write_synthetic_images
+
+# Every configuration is compared against the eager fp32 model at the processor's dynamic sizes
+DEFAULT_CONFIGURATIONS = "eager@fixed,eager-int8,torchscript,torchscript-int8,onnx,onnx-int8"
+
+def parse_configuration(text: str):
+    """
+    Parses a configuration name such as "onnx-int8" or "eager@fixed".
+
+    Returns:
+        tuple: (backend, quantize, fixed) where `fixed` asks for the default input buckets.
+    """
+    name, _, sizes = text.partition('@')
+    backend, _, suffix = name.partition('-')
+    if suffix not in ('', 'int8'):
+        raise ValueError(f"Unknown configuration suffix: {text}")
+    return backend, suffix == 'int8', sizes == 'fixed'
+
+def _pairwise_iou(a, b):
+    """IoU of every [x, y, w, h] box in `a` against every box in `b`, as an (len(a), len(b)) array."""
+    a, b = np.asarray(a, dtype=np.float64).reshape(-1, 4), np.asarray(b, dtype=np.float64).reshape(-1, 4)
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 0] + a[:, None, 2], b[None, :, 0] + b[None, :, 2])
+    y2 = np.minimum(a[:, None, 1] + a[:, None, 3], b[None, :, 1] + b[None, :, 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    union = (a[:, None, 2] * a[:, None, 3]) + (b[None, :, 2] * b[None, :, 3]) - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1e-9), 0.0)
+
+def match_detections(reference, candidate, iou_threshold=0.5):
+    """
+    Greedily matches candidate detections to reference detections of the same label.
+
+    Args:
+        reference (list): Detections of the eager model.
+        candidate (list): Detections of the backend under test.
+        iou_threshold (float): Minimum IoU of a match.
+
+    Returns:
+        list: (reference index, candidate index, iou) of every match, best IoU first.
+    """
+    if not reference or not candidate:
+        return []
+    ious = _pairwise_iou([d['box'] for d in reference], [d['box'] for d in candidate])
+    same_label = np.array([[r['label'] == c['label'] for c in candidate] for r in reference])
+    ious = np.where(same_label, ious, 0.0)
+    matches, used_reference, used_candidate = [], set(), set()
+    for flat in np.argsort(-ious, axis=None):
+        i, j = np.unravel_index(flat, ious.shape)
+        if ious[i, j] < iou_threshold:
+            break
+        if i in used_reference or j in used_candidate:
+            continue
+        used_reference.add(i)
+        used_candidate.add(j)
+        matches.append((int(i), int(j), float(ious[i, j])))
+    return matches
+
+def accuracy(reference_results, candidate_results, iou_threshold=0.5):
+    """
+    Summarizes how closely a backend reproduces the reference detections over many patches.
+
+    Returns:
+        dict: 'recall' and 'precision' of the matched detections, their 'mean_iou' and the
+              'mean_score_delta' (absolute score difference) of the matches.
+    """
+    reference_count = candidate_count = 0
+    ious, score_deltas = [], []
+    for reference, candidate in zip(reference_results, candidate_results):
+        reference, candidate = reference or [], candidate or []
+        reference_count += len(reference)
+        candidate_count += len(candidate)
+        for i, j, iou in match_detections(reference, candidate, iou_threshold):
+            ious.append(iou)
+            score_deltas.append(abs(reference[i]['score'] - candidate[j]['score']))
+    return {
+        'recall': len(ious) / reference_count if reference_count else 1.0,
+        'precision': len(ious) / candidate_count if candidate_count else 1.0,
+        'mean_iou': float(np.mean(ious)) if ious else None,
+        'mean_score_delta': float(np.mean(score_deltas)) if score_deltas else None,
+        'detections': candidate_count,
+    }
+
+def time_detector(detector, patches, threshold, repeats):
+    """
+    Runs a detector over the patches one at a time (as the workflow's per-patch latency sees it).
+
+    Returns:
+        tuple: (detections of the last repeat, median seconds per patch over all repeats).
+    """
+    detector.warmup()
+    seconds, results = [], None
+    for _ in range(repeats):
+        results = []
+        for patch in patches:
+            start = time.perf_counter()
+            results.append(detector.detect_raw_batch([patch], batch_size=1, threshold=threshold)[0])
+            seconds.append(time.perf_counter() - start)
+    return results, float(np.median(seconds))
+
+def load_patches(paths, rows, cols):
+    """Splits every image into a rows x cols grid and returns the RGB patches."""
+    patches = []
+    for path in paths:
+        with Image.open(path) as image:
+            image = image.convert('RGB')
+        patches.extend(patch.image for patch in image_utils.partition_image(image, rows, cols))
+    return patches
+
+def print_results(results):
+    print(f"\n{'configuration':<22} {'ms/patch':>9} {'speedup':>8} {'recall':>7} {'precision':>9} {'mean IoU':>9} {'score d':>8}")
+    for r in results:
+        if 'error' in r:
+            print(f"{r['configuration']:<22} error: {r['error']}")
+            continue
+        mean_iou = f"{r['mean_iou']:.3f}" if r['mean_iou'] is not None else "-"
+        delta = f"{r['mean_score_delta']:.3f}" if r['mean_score_delta'] is not None else "-"
+        print(f"{r['configuration']:<22} {r['seconds_per_patch'] * 1000:>9.1f} {r['speedup']:>7.2f}x {r['recall']:>7.3f}"
+              f" {r['precision']:>9.3f} {mean_iou:>9} {delta:>8}")
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.compare_backends",
+        description="Compare the speed and detections of the optimized detector backends against the eager model.",
+    )
+    parser.add_argument('inputs', nargs='*', help="Images to test on (default: synthetic images).")
+    parser.add_argument('--configurations', default=DEFAULT_CONFIGURATIONS,
+                        help="Comma-separated BACKEND[-int8][@fixed] configurations (default: %(default)s).")
+    parser.add_argument('--model', default=None, help="Model id (default: config.DETECTOR_MODEL_ID).")
+    parser.add_argument('--device', default='cpu', help="torch device (default: %(default)s).")
+    parser.add_argument('--grid', default="3x3", help="Patch grid ROWSxCOLS per image (default: %(default)s).")
+    parser.add_argument('--images', type=int, default=2, help="Synthetic images when no inputs are given (default: %(default)s).")
+    parser.add_argument('--size', default="2048x1536", help="Synthetic image size WIDTHxHEIGHT (default: %(default)s).")
+    parser.add_argument('--threshold', type=float, default=vision_tool_interface.DETECTION_THRESHOLD,
+                        help="Detection score threshold (default: %(default)s).")
+    parser.add_argument('--iou', type=float, default=0.5, help="IoU for a detection to count as reproduced (default: %(default)s).")
+    parser.add_argument('--repeats', type=int, default=2, help="Timed passes over the patches (default: %(default)s).")
+    parser.add_argument('--min-recall', type=float, default=0.9,
+                        help="Fail (exit 1) if a configuration reproduces fewer of the eager detections (default: %(default)s).")
+    parser.add_argument('--json', default=None, help="Also write the results to this JSON file.")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    model_id = args.model or vision_tool_interface.MODEL_ID
+    rows, cols = (int(v) for v in args.grid.lower().split('x'))
+    paths = args.inputs
+    if not paths:
+        width, height = (int(v) for v in args.size.lower().split('x'))
+        paths = write_synthetic_images(os.path.join(tempfile.gettempdir(), "image_store_benchmark"), args.images, width, height)
+        print("Note: synthetic images hold few recognizable objects; pass real photos for a meaningful accuracy check.")
+    patches = load_patches(paths, rows, cols)
+    print(f"{len(patches)} patches from {len(paths)} images, model {model_id} on {args.device}")
+
+    reference_detector = vision_tool_interface.Detector(model_id, args.device)
+    reference, reference_seconds = time_detector(reference_detector, patches, args.threshold, args.repeats)
+    results = [{'configuration': 'eager (reference)', 'seconds_per_patch': reference_seconds, 'speedup': 1.0,
+                **accuracy(reference, reference, args.iou)}]
+
+    for text in (c.strip() for c in args.configurations.split(',') if c.strip()):
+        try:
+            backend, quantize, fixed = parse_configuration(text)
+            detector = vision_tool_interface.Detector(model_id, args.device, backend, quantize,
+                                                      vision_tool_interface.detector_backends.DEFAULT_INPUT_SIZES if fixed else None)
+            candidate, seconds = time_detector(detector, patches, args.threshold, args.repeats)
+        except Exception as e:
+            results.append({'configuration': text, 'error': str(e)})
+            continue
+        results.append({'configuration': text, 'seconds_per_patch': seconds, 'speedup': reference_seconds / seconds,
+                        **accuracy(reference, candidate, args.iou)})
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    failed = [r['configuration'] for r in results if 'error' in r or r['recall'] < args.min_recall]
+    if failed:
+        print(f"Below recall {args.min_recall} or failed: {', '.join(failed)}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
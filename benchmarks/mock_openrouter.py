@@ -0,0 +1,195 @@
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_DECISIONS = {"ANALYZE": 0.3, "SKIP": 0.6, "EXPAND_CONTEXT": 0.1}
+
+def parse_decision_weights(text: str) -> dict:
+    """
+    Parses a decision distribution such as "ANALYZE=0.3,SKIP=0.6,EXPAND_CONTEXT=0.1".
+
+    Args:
+        text (str): Comma-separated KEYWORD=weight pairs.
+
+    Returns:
+        dict: Keyword -> weight, normalized to sum to 1.
+    """
+    weights = {}
+    for part in text.split(','):
+        if part.strip():
+            keyword, _, weight = part.partition('=')
+            weights[keyword.strip().upper()] = float(weight)
+    total = sum(weights.values())
+    if total <= 0:
+        raise ValueError(f"Decision weights must sum to a positive number: {text}")
+    return {keyword: weight / total for keyword, weight in weights.items()}
+
+class _MockHTTPServer(ThreadingHTTPServer):
+    # The default listen backlog of 5 drops connections when many clients connect at once, and
+    # their retry a second later would show up as agent latency
+    request_queue_size = 128
+
+class MockChatServer:
+    """
+    A local stand-in for the OpenRouter chat-completions endpoint.
+
+    Every request sleeps for a log-normally distributed latency, fails with a 429 or 503 at
+    `error_rate`, and otherwise answers with a decision keyword drawn from `decisions`. The
+    draw is a hash of the attached image, so the same patch gets the same decision in every
+    run and mode. Multi-patch prompts get a JSON object with one decision per image.
+    """
+
+    def __init__(self, latency: float = 0.3, latency_sigma: float = 0.5, error_rate: float = 0.0,
+                 decisions: dict = None, seed: int = 0, host: str = "127.0.0.1", port: int = 0):
+        """
+        Args:
+            latency (float): Mean response latency, in seconds.
+            latency_sigma (float): Shape of the log-normal latency; 0 makes every request take `latency`.
+            error_rate (float): Fraction of requests answered with a 429 or 503 error.
+            decisions (dict, optional): Keyword -> probability. Defaults to DEFAULT_DECISIONS.
+            seed (int): Seed of the latency and error draws.
+            host (str): Interface to listen on.
+            port (int): Port to listen on; 0 picks a free one.
+        """
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.decisions = decisions or DEFAULT_DECISIONS
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'errors': 0, 'images': 0}
+        self._server = _MockHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/api/v1/chat/completions"
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: Counts of 'requests' received, 'errors' returned and 'images' attached.
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def _decide(self, image_url: str) -> str:
+        digest = hashlib.sha256(image_url.encode('utf-8')).digest()
+        draw = int.from_bytes(digest[:8], 'big') / 2 ** 64
+        for keyword, weight in self.decisions.items():
+            draw -= weight
+            if draw < 0:
+                return keyword
+        return keyword
+
+    def _draw(self):
+        with self._lock:
+            sigma = self.latency_sigma
+            # Log-normal with mean `latency`: most requests are fast, a few are very slow
+            delay = self.latency * math.exp(self._random.gauss(0.0, sigma) - sigma * sigma / 2) if sigma else self.latency
+            error = None
+            if self._random.random() < self.error_rate:
+                error = 429 if self._random.random() < 0.5 else 503
+        return delay, error
+
+    def _respond(self, body: dict):
+        content = body['messages'][0]['content']
+        content = content if isinstance(content, list) else [{'type': 'text', 'text': content}]
+        images = [block['image_url']['url'] for block in content if block.get('type') == 'image_url']
+        prompt = " ".join(block.get('text', '') for block in content if block.get('type') == 'text')
+        with self._lock:
+            self._stats['images'] += len(images)
+
+        decisions = [self._decide(url) for url in images] or [self._decide(prompt)]
+        if re.search(r"JSON object", prompt):
+            text = json.dumps({str(n): decision for n, decision in enumerate(decisions, start=1)})
+        else:
+            text = decisions[0]
+        return {
+            'id': 'mock',
+            'model': body.get('model'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+        }
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, payload, headers=None):
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                delay, error = server._draw()
+                time.sleep(delay)
+                with server._lock:
+                    server._stats['requests'] += 1
+                    if error:
+                        server._stats['errors'] += 1
+                if error == 429:
+                    self._send(429, {'error': {'code': 429, 'message': 'Rate limit exceeded (mock)'}}, {'Retry-After': '1'})
+                    return
+                if error:
+                    self._send(error, {'error': {'code': error, 'message': 'Upstream unavailable (mock)'}})
+                    return
+                try:
+                    self._send(200, server._respond(body))
+                except (KeyError, IndexError, TypeError) as e:
+                    self._send(400, {'error': {'code': 400, 'message': f'Malformed request: {e}'}})
+
+        return Handler
+
+    def start(self) -> "MockChatServer":
+        """Serves requests on a background thread."""
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-openrouter", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a local mock of the OpenRouter chat-completions API.")
+    parser.add_argument('--port', type=int, default=8089, help="Port to listen on (default: %(default)s).")
+    parser.add_argument('--latency', type=float, default=0.3, help="Mean latency in seconds (default: %(default)s).")
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help="Log-normal latency shape (default: %(default)s).")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of 429/503 answers (default: %(default)s).")
+    parser.add_argument('--decisions', default="ANALYZE=0.3,SKIP=0.6,EXPAND_CONTEXT=0.1",
+                        help="Decision distribution (default: %(default)s).")
+    args = parser.parse_args(argv)
+
+    server = MockChatServer(args.latency, args.latency_sigma, args.error_rate,
+                            parse_decision_weights(args.decisions), port=args.port)
+    print(f"Mock chat-completions endpoint at {server.url}")
+    try:
+        server.start()._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from src.instrumentation import percentile
+from .mock_openrouter import MockChatServer, parse_decision_weights
+from .synthetic import write_synthetic_images
+
+# Each mode is a set of WorkflowSettings arguments and config overrides. "serial" approximates the
+# original one-patch-at-a-time workflow: one worker per stage, one request in flight, no triage or caches.
+SERIAL_WORKERS = {'decode': 1, 'partition': 1, 'decide': 1, 'detect': 1, 'aggregate': 1, 'render': 1}
+MODES = {
+    'serial': {
+        'settings': {'stage_workers': SERIAL_WORKERS, 'queue_size': 1, 'triage': False, 'decision_batch_size': 1},
+        'config': {'OPENROUTER_MAX_CONCURRENCY': 1},
+    },
+    'concurrent': {
+        'settings': {'triage': False, 'decision_batch_size': 1},
+        'config': {},
+    },
+    'triage': {
+        'settings': {'triage': True, 'decision_batch_size': 1},
+        'config': {},
+    },
+    'batch': {
+        'settings': {'triage': True, 'decision_batch_size': 4},
+        'config': {},
+    },
+    'quadtree': {
+        'settings': {'triage': True, 'decision_batch_size': 1, 'scheduler': 'quadtree'},
+        'config': {},
+    },
+    'cached': {
+        # Runs the images twice and reports the second, warm-cache pass
+        'settings': {'triage': True, 'decision_batch_size': 1},
+        'config': {'DECISION_CACHE_ENABLED': True, 'DETECTION_CACHE_ENABLED': True},
+        'passes': 2,
+    },
+}
+DEFAULT_MODES = "serial,concurrent,triage,batch,quadtree,cached"
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux; children covers forked detection workers
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return own / 1024, children / 1024
+
+def run_mode(mode: str, paths: list[str], url: str, options: dict) -> dict:
+    """
+    Runs one benchmark mode in this process against the mock server.
+
+    Args:
+        mode (str): A key of MODES.
+        paths (list[str]): The images to process.
+        url (str): The mock chat-completions URL.
+        options (dict): Grid, detector and retry options from the command line.
+
+    Returns:
+        dict: Throughput, per-stage latency, agent-call and memory figures of the run.
+    """
+    from src import config, instrumentation, main_workflow, openrouter_agent, vision_tool_interface
+    from .stub_detector import make_stub_detector
+
+    spec = MODES[mode]
+    config.OPENROUTER_API_KEY = "sk-benchmark-mock"
+    config.OPENROUTER_REQUESTS_PER_MINUTE = {}
+    config.OPENROUTER_BACKOFF_BASE_SECONDS = options['backoff_base']
+    config.DECISION_CACHE_ENABLED = False
+    config.DETECTION_CACHE_ENABLED = False
+    config.DECISION_CACHE_PATH = None # caches stay in memory so runs don't interfere
+    config.DETECTION_CACHE_PATH = None
+    for name, value in spec['config'].items():
+        setattr(config, name, value)
+    openrouter_agent.OPENROUTER_CHAT_URL = url
+
+    detection_pool = None
+    if options['detector'] == 'stub':
+        vision_tool_interface.detect_raw_batch = make_stub_detector(options['detector_seconds'], options['detector_batch_seconds'])
+    else:
+        vision_tool_interface.MODEL_ID = options['model'] or vision_tool_interface.MODEL_ID
+        config.DETECTOR_BACKEND = options['detector_backend']
+        config.DETECTOR_QUANTIZE_INT8 = options['quantize_int8']
+        if options['detect_processes']:
+            # Fork the workers before anything runs inference in this process, then warm them up
+            from src.detection_pool import DetectionPool
+            detection_pool = DetectionPool(num_workers=options['detect_processes'])
+            detection_pool.warmup()
+        else:
+            vision_tool_interface.Detector.get(vision_tool_interface.MODEL_ID).warmup()
+
+    rss_before, _ = _peak_rss_mb()
+    settings_kwargs = dict(spec['settings'])
+    if detection_pool is not None:
+        settings_kwargs['detection_pool'] = detection_pool
+        settings_kwargs['stage_workers'] = dict(settings_kwargs.get('stage_workers') or {}, detect=options['detect_processes'])
+    settings = main_workflow.WorkflowSettings(
+        num_rows=options['rows'], num_cols=options['cols'], min_tile_size=options['min_tile_size'],
+        render=options['render_dir'] is not None, output_dir=options['render_dir'] or "data",
+        **settings_kwargs,
+    )
+
+    failed = 0
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(spec.get('passes', 1) - 1):
+            for _ in main_workflow.process_images(paths, settings):
+                pass
+        # Only the last pass is measured
+        instrumentation.reset()
+        instrumentation.enable()
+        calls_before = openrouter_agent.get_call_stats()
+        workflow_pipeline = main_workflow.build_pipeline(settings)
+        started = time.perf_counter()
+        for result in workflow_pipeline.run(main_workflow.ImageJob(path, settings) for path in paths):
+            if not isinstance(result, main_workflow.ImageJob):
+                failed += 1
+        elapsed = time.perf_counter() - started
+    if detection_pool is not None:
+        detection_pool.shutdown()
+
+    calls_after = openrouter_agent.get_call_stats()
+    calls = {key: calls_after[key] - calls_before[key] for key in calls_after}
+    rss_peak, children_peak = _peak_rss_mb()
+    count = len(paths)
+    return {
+        'mode': mode,
+        'images': count,
+        'failed': failed,
+        'seconds': elapsed,
+        'images_per_second': count / elapsed if elapsed > 0 else 0.0,
+        'agent_calls_per_image': calls['calls'] / count,
+        'agent_errors': calls['errors'],
+        'request_bytes_per_image': calls['request_bytes'] / count,
+        'peak_rss_mb': rss_peak,
+        'baseline_rss_mb': rss_before,
+        'worker_peak_rss_mb': children_peak,
+        'stages': {
+            name: {'p50': percentile(seconds, 0.5), 'p95': percentile(seconds, 0.95)}
+            for name, seconds in workflow_pipeline.stage_seconds.items()
+        },
+        'timers': instrumentation.snapshot()['timers'],
+        'scheduler': openrouter_agent.get_scheduler().stats(),
+    }
+
+def print_results(results):
+    """Prints a comparison table of the modes, then the per-stage latencies of each."""
+    print(f"\n{'mode':<12}{'img/s':>8}{'s':>8}{'calls/img':>11}{'kB/img':>9}{'errors':>8}{'peak RSS MB':>13}{'failed':>8}")
+    for r in results:
+        if 'error' in r:
+            print(f"{r['mode']:<12} failed: {r['error']}")
+            continue
+        print(f"{r['mode']:<12}{r['images_per_second']:>8.2f}{r['seconds']:>8.1f}{r['agent_calls_per_image']:>11.1f}"
+              f"{r['request_bytes_per_image'] / 1e3:>9.1f}{r['agent_errors']:>8}{r['peak_rss_mb']:>13.0f}{r['failed']:>8}")
+    print("\nStage latency per image, p50 / p95 (s):")
+    for r in results:
+        if 'error' in r:
+            continue
+        stages = "  ".join(f"{name} {s['p50']:.3f}/{s['p95']:.3f}" for name, s in r['stages'].items())
+        print(f"  {r['mode']:<12}{stages}")
+    print("\nInner timers, p50 / p95 (s):")
+    for r in results:
+        if 'error' in r:
+            continue
+        timers = "  ".join(f"{name} {t['p50']:.4f}/{t['p95']:.4f}" for name, t in r['timers'].items() if not name.startswith('stage.'))
+        print(f"  {r['mode']:<12}{timers}")
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.run_benchmark",
+        description="Benchmark the workflow offline against a local mock of OpenRouter and a stub or real detector.",
+    )
+    parser.add_argument('--modes', default=DEFAULT_MODES, help=f"Comma-separated modes out of {', '.join(MODES)} (default: %(default)s).")
+    parser.add_argument('--images', type=int, default=8, help="Number of synthetic images (default: %(default)s).")
+    parser.add_argument('--size', default="2048x1536", help="Synthetic image size WIDTHxHEIGHT (default: %(default)s).")
+    parser.add_argument('--objects', type=int, default=4, help="Textured objects per synthetic image (default: %(default)s).")
+    parser.add_argument('--grid', default="3x3", help="Patch grid ROWSxCOLS (default: %(default)s).")
+    parser.add_argument('--min-tile-size', type=int, default=256, help="Smallest quadtree tile side (default: %(default)s).")
+    parser.add_argument('--image-dir', default=None, help="Where synthetic images are written (default: a cache dir under the temp dir).")
+    parser.add_argument('--latency', type=float, default=0.3, help="Mean mock agent latency in seconds (default: %(default)s).")
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help="Log-normal latency shape (default: %(default)s).")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of mock 429/503 answers (default: %(default)s).")
+    parser.add_argument('--decisions', default="ANALYZE=0.3,SKIP=0.6,EXPAND_CONTEXT=0.1",
+                        help="Mock decision distribution (default: %(default)s).")
+    parser.add_argument('--backoff-base', type=float, default=0.2, help="Retry backoff base in seconds (default: %(default)s).")
+    parser.add_argument('--detector', choices=['stub', 'real'], default='stub',
+                        help="'stub' simulates inference without a model; 'real' loads DETR (default: %(default)s).")
+    parser.add_argument('--model', default=None, help="Model id for --detector real, e.g. a tiny checkpoint (default: config.DETECTOR_MODEL_ID).")
+    parser.add_argument('--detector-backend', choices=['eager', 'torchscript', 'onnx'], default='eager',
+                        help="Inference backend for --detector real; torchscript and onnx are experimental (default: %(default)s).")
+    parser.add_argument('--quantize-int8', action='store_true', help="With --detector real, use dynamic int8 quantization.")
+    parser.add_argument('--detect-processes', type=int, default=0, help="With --detector real, run detection in this many forked processes.")
+    parser.add_argument('--detector-seconds', type=float, default=0.02, help="Stub inference time per image (default: %(default)s).")
+    parser.add_argument('--detector-batch-seconds', type=float, default=0.01, help="Stub overhead per batch (default: %(default)s).")
+    parser.add_argument('--render-dir', default=None, help="Also draw and save the output images here (default: don't render).")
+    parser.add_argument('--json', default=None, help="Also write the full results to this JSON file.")
+    parser.add_argument('--worker', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--url', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--paths', default=None, help=argparse.SUPPRESS)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    rows, cols = (int(v) for v in args.grid.lower().split('x'))
+    options = {
+        'rows': rows, 'cols': cols, 'min_tile_size': args.min_tile_size,
+        'detector': args.detector, 'model': args.model, 'detect_processes': args.detect_processes,
+        'detector_backend': args.detector_backend, 'quantize_int8': args.quantize_int8,
+        'detector_seconds': args.detector_seconds, 'detector_batch_seconds': args.detector_batch_seconds,
+        'backoff_base': args.backoff_base, 'render_dir': args.render_dir,
+    }
+
+    if args.worker:
+        # Child process: run one mode and report on the last line of stdout
+        result = run_mode(args.worker, json.loads(args.paths), args.url, options)
+        print(json.dumps(result))
+        return 0
+
+    modes = [m.strip() for m in args.modes.split(',') if m.strip()]
+    unknown = [m for m in modes if m not in MODES]
+    if unknown:
+        print(f"Unknown modes: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+
+    width, height = (int(v) for v in args.size.lower().split('x'))
+    image_dir = args.image_dir or os.path.join(tempfile.gettempdir(), "image_store_benchmark")
+    paths = write_synthetic_images(image_dir, args.images, width, height, args.objects)
+    print(f"{len(paths)} synthetic {width}x{height} images in {image_dir}, grid {rows}x{cols}, "
+          f"mock latency {args.latency}s (sigma {args.latency_sigma}), error rate {args.error_rate}, detector: {args.detector}")
+
+    results = []
+    with MockChatServer(args.latency, args.latency_sigma, args.error_rate, parse_decision_weights(args.decisions)) as server:
+        for mode in modes:
+            # Every mode runs in a fresh process so peak RSS and module state are its own
+            command = [sys.executable, '-m', 'benchmarks.run_benchmark', *(argv if argv is not None else sys.argv[1:]),
+                       '--worker', mode, '--url', server.url, '--paths', json.dumps(paths)]
+            print(f"Running {mode}...", flush=True)
+            completed = subprocess.run(command, capture_output=True, text=True)
+            lines = completed.stdout.strip().splitlines()
+            try:
+                results.append(json.loads(lines[-1]))
+            except (IndexError, json.JSONDecodeError):
+                error = (completed.stderr.strip().splitlines() or ["no output"])[-1]
+                results.append({'mode': mode, 'error': error})
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0 if all('error' not in r for r in results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
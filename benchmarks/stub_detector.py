@@ -0,0 +1,42 @@
+import time
+import numpy as np
+
+STUB_LABELS = ["person", "car", "dog", "cat", "bicycle"]
+
+def make_stub_detector(seconds_per_image: float = 0.02, seconds_per_batch: float = 0.01):
+    """
+    Builds a stand-in for `vision_tool_interface.detect_raw_batch` that needs no model.
+
+    It simulates inference cost (a fixed cost per batch plus a cost per image) and returns
+    one or two deterministic boxes per image, derived from the image's pixels, so merging,
+    caching and rendering downstream get realistic input.
+
+    Args:
+        seconds_per_image (float): Simulated compute per image.
+        seconds_per_batch (float): Simulated fixed overhead per forward pass.
+
+    Returns:
+        callable: `detect_raw_batch(images, batch_size=8, threshold=0.7)`.
+    """
+    def detect_raw_batch(images, batch_size=8, threshold=0.7):
+        raw_detections = []
+        batch_size = max(1, batch_size)
+        for start in range(0, len(images), batch_size):
+            chunk = images[start:start + batch_size]
+            time.sleep(seconds_per_batch + seconds_per_image * len(chunk))
+            for image in chunk:
+                width, height = image.size
+                # A cheap pixel-dependent value keeps the output stable for the same patch
+                value = int(np.asarray(image.reduce(max(1, min(width, height) // 8)), dtype=np.uint32).sum())
+                detections = []
+                for k in range(1 + value % 2):
+                    w, h = max(1, width // (3 + k)), max(1, height // (3 + k))
+                    detections.append({
+                        'box': [(width - w) // 2 + k * 5, (height - h) // 2 + k * 5, w, h],
+                        'label': STUB_LABELS[(value + k) % len(STUB_LABELS)],
+                        'score': max(threshold, 0.75 + (value % 20) / 100),
+                    })
+                raw_detections.append(detections)
+        return raw_detections
+
+    return detect_raw_batch
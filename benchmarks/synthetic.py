@@ -0,0 +1,63 @@
+import os
+import numpy as np
+from PIL import Image, ImageDraw
+
+def make_synthetic_image(width: int, height: int, objects: int = 4, seed: int = 0) -> Image.Image:
+    """
+    Draws a synthetic scene: a smooth, nearly uniform background with a few textured objects.
+
+    Most of the frame is empty (so local triage and the agent can skip it), while the objects
+    give the detector and the image encoder realistic work.
+
+    Args:
+        width (int): Image width in pixels.
+        height (int): Image height in pixels.
+        objects (int): Number of textured shapes to draw.
+        seed (int): Random seed.
+
+    Returns:
+        PIL.Image.Image: The RGB image.
+    """
+    rng = np.random.default_rng(seed)
+    # A vertical gradient plus faint noise, like sky or a wall
+    top, bottom = rng.integers(60, 200, 3), rng.integers(60, 200, 3)
+    ramp = np.linspace(0.0, 1.0, height, dtype=np.float32)[:, None, None]
+    background = top * (1 - ramp) + bottom * ramp + rng.normal(0, 1.5, (height, 1, 3))
+    pixels = np.broadcast_to(background, (height, width, 3)).clip(0, 255).astype(np.uint8)
+    image = Image.fromarray(np.ascontiguousarray(pixels))
+
+    draw = ImageDraw.Draw(image)
+    short_side = min(width, height)
+    for _ in range(objects):
+        w, h = (int(v) for v in rng.integers(short_side // 16, short_side // 5, 2))
+        x, y = int(rng.integers(0, max(1, width - w))), int(rng.integers(0, max(1, height - h)))
+        texture = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+        mask = Image.new('L', (w, h), 0)
+        ImageDraw.Draw(mask).ellipse([0, 0, w - 1, h - 1], fill=255)
+        image.paste(Image.fromarray(texture), (x, y), mask)
+        draw.rectangle([x, y, x + w, y + h], outline=tuple(int(c) for c in rng.integers(0, 256, 3)), width=max(2, short_side // 300))
+    return image
+
+def write_synthetic_images(directory: str, count: int, width: int, height: int, objects: int = 4, seed: int = 0) -> list[str]:
+    """
+    Writes `count` synthetic JPEG images to a directory, reusing files that already exist.
+
+    Args:
+        directory (str): Output directory.
+        count (int): Number of images.
+        width (int): Image width in pixels.
+        height (int): Image height in pixels.
+        objects (int): Textured shapes per image.
+        seed (int): Seed of the first image; image i uses seed + i.
+
+    Returns:
+        list[str]: The image paths.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"synthetic_{width}x{height}_{objects}_{seed + i:04d}.jpg")
+        if not os.path.exists(path):
+            make_synthetic_image(width, height, objects, seed + i).save(path, quality=90)
+        paths.append(path)
+    return paths
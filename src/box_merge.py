@@ -0,0 +1,316 @@
+import numpy as np
+from . import image_utils
+
+def detections_to_arrays(detections, offset=(0, 0)):
+    """
+    Packs detection dictionaries into arrays, shifting the boxes by a patch offset.
+
+    Args:
+        detections (list): Dictionaries with 'box' ([x, y, w, h]), 'label' and 'score'.
+        offset (tuple): (left, upper) of the patch in the original image.
+
+    Returns:
+        tuple: (boxes, scores, labels) where boxes is a float (N, 4) [x, y, w, h] array in
+               original image coordinates, scores a float (N,) array and labels a str (N,) array.
+    """
+    if not detections:
+        return np.zeros((0, 4), dtype=np.float64), np.zeros(0, dtype=np.float64), np.zeros(0, dtype=str)
+    boxes = np.array([det['box'] for det in detections], dtype=np.float64)
+    boxes[:, 0] += offset[0]
+    boxes[:, 1] += offset[1]
+    scores = np.array([det['score'] for det in detections], dtype=np.float64)
+    labels = np.array([det['label'] for det in detections])
+    return boxes, scores, labels
+
+def concatenate(arrays):
+    """
+    Joins several (boxes, scores, labels) tuples into one.
+
+    Args:
+        arrays (list[tuple]): Tuples as returned by `detections_to_arrays`.
+
+    Returns:
+        tuple: The concatenated (boxes, scores, labels).
+    """
+    arrays = [a for a in arrays if len(a[1])]
+    if not arrays:
+        return detections_to_arrays([])
+    return (np.concatenate([a[0] for a in arrays]),
+            np.concatenate([a[1] for a in arrays]),
+            np.concatenate([a[2] for a in arrays]))
+
+def arrays_to_detections(boxes, scores, labels):
+    """
+    Unpacks (boxes, scores, labels) arrays into detection dictionaries.
+
+    Args:
+        boxes (numpy.ndarray): (N, 4) [x, y, w, h] boxes.
+        scores (numpy.ndarray): (N,) scores.
+        labels (numpy.ndarray): (N,) class names.
+
+    Returns:
+        list: Dictionaries with 'box' ([x, y, w, h] ints), 'label' and 'score'.
+    """
+    int_boxes = np.rint(boxes).astype(int).tolist()
+    return [
+        {'box': box, 'label': str(label), 'score': float(score)}
+        for box, label, score in zip(int_boxes, labels.tolist(), scores.tolist())
+    ]
+
+def _candidate_pairs(xyxy, class_ids):
+    """
+    Finds the pairs of same-class boxes whose extents overlap, without comparing all pairs.
+
+    Boxes are sorted by their left edge (sweep and prune): box j can only overlap box i if it
+    starts before i ends, so each box is only paired with the few boxes that start inside its
+    horizontal extent. With boxes spread over the image this keeps the work near-linear.
+
+    Returns:
+        tuple: Index arrays (i, j) into `xyxy` of the candidate pairs, with i != j.
+    """
+    order = np.argsort(xyxy[:, 0], kind='stable')
+    x1 = xyxy[order, 0]
+    ends = np.searchsorted(x1, xyxy[order, 2], side='left')
+    counts = np.maximum(ends - np.arange(len(order)) - 1, 0)
+    if counts.sum() == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+    first = np.repeat(np.arange(len(order)), counts)
+    # Position of each pair within its group, so j runs over first+1 .. ends-1
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    second = first + 1 + (np.arange(counts.sum()) - starts)
+    i, j = order[first], order[second]
+
+    keep = (class_ids[i] == class_ids[j]) & (xyxy[i, 1] < xyxy[j, 3]) & (xyxy[j, 1] < xyxy[i, 3])
+    return i[keep], j[keep]
+
+def _border_pairs(xyxy, class_ids, regions, tolerance, min_overlap):
+    """
+    Finds pairs of same-class boxes that look like the two halves of an object cut by a patch edge.
+
+    Box i must reach the right (or lower) edge of its region, box j the left (or upper) edge of
+    an adjacent region sharing that edge, and their extents along the edge must overlap by at
+    least `min_overlap` of the longer one, so that a small box is never joined to the side of
+    a large one.
+
+    Returns:
+        tuple: Index arrays (i, j) of the pairs, with i's region left of (or above) j's, and a
+            boolean array that is True where the shared edge is vertical.
+    """
+    grown = xyxy + np.array([-tolerance, -tolerance, tolerance, tolerance])
+    i, j = _candidate_pairs(grown, class_ids)
+    i, j = np.concatenate([i, j]), np.concatenate([j, i])
+    ri, rj = regions[i], regions[j]
+    bi, bj = xyxy[i], xyxy[j]
+
+    def reaches(coordinate, edge):
+        return np.abs(coordinate - edge) <= tolerance
+
+    def along(lo, hi):
+        # Overlap of the extents along the shared edge, relative to the longer one
+        inter = np.minimum(bi[:, hi], bj[:, hi]) - np.maximum(bi[:, lo], bj[:, lo])
+        longer = np.maximum(bi[:, hi] - bi[:, lo], bj[:, hi] - bj[:, lo])
+        return inter >= min_overlap * np.maximum(longer, 1e-9)
+
+    vertical_edge = (reaches(ri[:, 2], rj[:, 0]) & (ri[:, 1] < rj[:, 3]) & (rj[:, 1] < ri[:, 3])
+                     & reaches(bi[:, 2], ri[:, 2]) & reaches(bj[:, 0], rj[:, 0]) & along(1, 3))
+    horizontal_edge = (reaches(ri[:, 3], rj[:, 1]) & (ri[:, 0] < rj[:, 2]) & (rj[:, 0] < ri[:, 2])
+                       & reaches(bi[:, 3], ri[:, 3]) & reaches(bj[:, 1], rj[:, 1]) & along(0, 2))
+    keep = vertical_edge | horizontal_edge
+    return i[keep], j[keep], vertical_edge[keep]
+
+def _seam_is_continuous(image, box_i, box_j, region_i, vertical, max_step_ratio):
+    """
+    Checks that the pixels of two border boxes continue smoothly across their patch edge.
+
+    An object cut by the edge has no edge of its own there, so the step between the two pixel
+    lines on either side of the seam is about as large as the steps just inside each part. Two
+    separate objects that merely touch the edge meet at a visible boundary instead.
+
+    Args:
+        image (PIL.Image.Image | numpy.ndarray): The full image.
+        box_i, box_j (numpy.ndarray): The two boxes (x1, y1, x2, y2), box_i before the edge.
+        region_i (numpy.ndarray): The region of box_i, whose right (or lower) side is the edge.
+        vertical (bool): Whether the shared edge is vertical.
+        max_step_ratio (float): Largest allowed ratio of the step across the seam to the steps
+            next to it.
+
+    Returns:
+        bool: True if the two boxes look like one object.
+    """
+    lo_axis, hi_axis = (1, 3) if vertical else (0, 2)
+    lo = int(max(box_i[lo_axis], box_j[lo_axis]))
+    hi = int(np.ceil(min(box_i[hi_axis], box_j[hi_axis])))
+    seam = int(round(region_i[2] if vertical else region_i[3]))
+    if hi - lo < 1:
+        return False
+    coords = (seam - 2, lo, seam + 2, hi) if vertical else (lo, seam - 2, hi, seam + 2)
+    height, width = (image.shape[:2] if isinstance(image, np.ndarray) else (image.height, image.width))
+    if coords[0] < 0 or coords[1] < 0 or coords[2] > width or coords[3] > height:
+        return True # the seam is at the image border; nothing to compare
+    strip = np.asarray(image_utils.Patch(image, coords).array, dtype=np.float32)
+    if strip.ndim == 2:
+        strip = strip[:, :, None]
+    if not vertical:
+        strip = strip.transpose(1, 0, 2)
+    # Columns: two pixels before the seam, two after; steps are compared per channel, so a change
+    # of colour at equal brightness still counts
+    steps = np.abs(np.diff(strip, axis=1)).mean(axis=(0, 2))
+    inside = max(steps[0], steps[2])
+    return steps[1] <= max_step_ratio * inside + 2.0 # a couple of levels of slack for flat regions
+
+def fuse_border_boxes(boxes, scores, labels, regions, image, tolerance=2.0, min_overlap=0.8, max_step_ratio=2.0):
+    """
+    Joins the parts of objects that were cut by the shared edge of adjacent patches.
+
+    Adjacent grid or quadtree patches share an edge without overlapping, so the two halves of
+    an object on that edge have no intersection and no overlap metric can merge them. Here a
+    box reaching its patch's edge is joined with a same-class box reaching the neighbouring
+    patch's side of that edge when they line up along it and the image continues across the
+    seam between them (two separate objects side by side meet at a visible boundary); chains of
+    parts (an object on a patch corner) become one box, the union of the parts, with the
+    highest score.
+
+    Args:
+        boxes (numpy.ndarray): (N, 4) [x, y, w, h] boxes in original image coordinates.
+        scores (numpy.ndarray): (N,) scores.
+        labels (numpy.ndarray): (N,) class names.
+        regions (numpy.ndarray): (N, 4) (left, upper, right, lower) of the patch each box was found in.
+        image (PIL.Image.Image | numpy.ndarray): The full image, to look at the seams.
+        tolerance (float): Pixels within which a box counts as reaching an edge and two edges coincide.
+        min_overlap (float): Minimum overlap along the edge, as a fraction of the longer part.
+        max_step_ratio (float): Largest allowed ratio of the pixel step across the seam to the
+                                steps next to it.
+
+    Returns:
+        tuple: The (boxes, scores, labels) with every group of parts replaced by one box.
+    """
+    if len(scores) < 2:
+        return boxes, scores, labels
+    xyxy = np.concatenate([boxes[:, :2], boxes[:, :2] + boxes[:, 2:]], axis=1)
+    _, class_ids = np.unique(labels, return_inverse=True)
+    regions = np.asarray(regions, dtype=np.float64)
+    i, j, vertical = _border_pairs(xyxy, class_ids, regions, tolerance, min_overlap)
+    continuous = np.array([
+        _seam_is_continuous(image, xyxy[a], xyxy[b], regions[a], v, max_step_ratio)
+        for a, b, v in zip(i.tolist(), j.tolist(), vertical.tolist())
+    ], dtype=bool)
+    i, j = i[continuous], j[continuous]
+    if len(i) == 0:
+        return boxes, scores, labels
+
+    # Union-find over the (few) border pairs
+    parent = np.arange(len(scores))
+
+    def find(k):
+        while parent[k] != k:
+            parent[k] = parent[parent[k]]
+            k = parent[k]
+        return k
+
+    for a, b in zip(i.tolist(), j.tolist()):
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+    roots = np.array([find(k) for k in range(len(scores))])
+
+    keep = roots == np.arange(len(scores))
+    fused = xyxy.copy()
+    fused_scores = scores.astype(np.float64, copy=True)
+    np.minimum.at(fused[:, 0], roots, xyxy[:, 0])
+    np.minimum.at(fused[:, 1], roots, xyxy[:, 1])
+    np.maximum.at(fused[:, 2], roots, xyxy[:, 2])
+    np.maximum.at(fused[:, 3], roots, xyxy[:, 3])
+    np.maximum.at(fused_scores, roots, scores)
+    fused = fused[keep]
+    return np.concatenate([fused[:, :2], fused[:, 2:] - fused[:, :2]], axis=1), fused_scores[keep], labels[keep]
+
+def merge_boxes(boxes, scores, labels, iou_threshold=0.5, method="nms", metric="iou", regions=None, image=None,
+                border_tolerance=2.0):
+    """
+    Merges duplicate detections of the same class across patches.
+
+    Overlapping pairs are found with a sort-based spatial index and their overlap is computed
+    in one vectorized step; only boxes that actually have a duplicate take part in the
+    greedy suppression.
+
+    Args:
+        boxes (numpy.ndarray): (N, 4) [x, y, w, h] boxes in original image coordinates.
+        scores (numpy.ndarray): (N,) scores.
+        labels (numpy.ndarray): (N,) class names; boxes of different classes are never merged.
+        iou_threshold (float): Overlap above which two boxes are duplicates.
+        method (str): 'nms' keeps the highest-scoring box of each group of duplicates; 'wbf'
+                      (weighted box fusion) replaces it by the score-weighted average of the group.
+        metric (str): 'iou' (intersection over union) or 'ios' (intersection over the smaller
+                      box), which also merges a partial box cut at a patch border into the full
+                      box found in an overlapping context crop.
+        regions (numpy.ndarray, optional): (N, 4) (left, upper, right, lower) of the patch each
+                                           box was found in. When given together with `image`,
+                                           the parts of objects cut by a shared patch edge are
+                                           first joined (see `fuse_border_boxes`).
+        image (PIL.Image.Image | numpy.ndarray, optional): The full image, for `fuse_border_boxes`.
+        border_tolerance (float): Edge tolerance in pixels for `fuse_border_boxes`.
+
+    Returns:
+        tuple: The merged (boxes, scores, labels), sorted by descending score.
+    """
+    if method not in ("nms", "wbf"):
+        raise ValueError(f"Unknown merge method: {method}")
+    if metric not in ("iou", "ios"):
+        raise ValueError(f"Unknown overlap metric: {metric}")
+
+    if regions is not None and image is not None:
+        boxes, scores, labels = fuse_border_boxes(boxes, scores, labels, regions, image, tolerance=border_tolerance)
+
+    n = len(scores)
+    if n == 0:
+        return boxes, scores, labels
+
+    xyxy = np.concatenate([boxes[:, :2], boxes[:, :2] + boxes[:, 2:]], axis=1)
+    _, class_ids = np.unique(labels, return_inverse=True)
+    i, j = _candidate_pairs(xyxy, class_ids)
+
+    inter_w = np.clip(np.minimum(xyxy[i, 2], xyxy[j, 2]) - np.maximum(xyxy[i, 0], xyxy[j, 0]), 0, None)
+    inter_h = np.clip(np.minimum(xyxy[i, 3], xyxy[j, 3]) - np.maximum(xyxy[i, 1], xyxy[j, 1]), 0, None)
+    inter = inter_w * inter_h
+    areas = boxes[:, 2] * boxes[:, 3]
+    if metric == "iou":
+        denominator = areas[i] + areas[j] - inter
+    else:
+        denominator = np.minimum(areas[i], areas[j])
+    overlap = inter / np.maximum(denominator, 1e-9)
+    duplicate = overlap > iou_threshold
+    i, j = i[duplicate], j[duplicate]
+
+    order = np.argsort(-scores, kind='stable')
+    if len(i) == 0:
+        return boxes[order], scores[order], labels[order]
+
+    # Adjacency lists of the duplicate graph in CSR form
+    sources = np.concatenate([i, j])
+    targets = np.concatenate([j, i])
+    by_source = np.argsort(sources, kind='stable')
+    targets = targets[by_source]
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(sources, minlength=n))])
+
+    suppressed = np.zeros(n, dtype=bool)
+    kept = []
+    fused_boxes = boxes.copy()
+    for index in order:
+        if suppressed[index]:
+            continue
+        kept.append(index)
+        neighbours = targets[offsets[index]:offsets[index + 1]]
+        if len(neighbours) == 0:
+            continue
+        neighbours = neighbours[~suppressed[neighbours]]
+        suppressed[neighbours] = True
+        if method == "wbf" and len(neighbours):
+            group = np.concatenate([[index], neighbours])
+            weights = scores[group]
+            group_xyxy = xyxy[group]
+            fused = (group_xyxy * weights[:, None]).sum(axis=0) / weights.sum()
+            fused_boxes[index] = [fused[0], fused[1], fused[2] - fused[0], fused[3] - fused[1]]
+
+    kept = np.array(kept, dtype=int)
+    return fused_boxes[kept], scores[kept], labels[kept]
@@ -0,0 +1,293 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from PIL import Image
+from . import config
+
+def make_key(*parts) -> str:
+    """
+    Builds a stable cache key from several parts.
+
+    Args:
+        *parts: Strings, bytes or JSON-serializable values identifying the cached item.
+
+    Returns:
+        str: A hex SHA-256 digest of all parts.
+    """
+    hasher = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, bytes):
+            data = part
+        elif isinstance(part, str):
+            data = part.encode('utf-8')
+        else:
+            data = json.dumps(part, sort_keys=True).encode('utf-8')
+        # Length-prefix every part so that ("ab", "c") and ("a", "bc") don't collide
+        hasher.update(len(data).to_bytes(8, 'little'))
+        hasher.update(data)
+    return hasher.hexdigest()
+
+def image_digest(image: Image.Image) -> str:
+    """
+    Computes a content digest of an image's decoded pixels.
+
+    Args:
+        image (PIL.Image.Image): The Pillow Image object to hash.
+
+    Returns:
+        str: A hex SHA-256 digest of the image mode, size and pixel data.
+    """
+    return make_key(image.mode, list(image.size), image.tobytes())
+
+def file_digest(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Computes a content digest of a file without reading it into memory at once.
+
+    Args:
+        path (str): The path of the file to hash.
+        chunk_size (int): Number of bytes read per step.
+
+    Returns:
+        str: A hex SHA-256 digest of the file contents.
+    """
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+class TieredCache:
+    """
+    A two-tier key/value cache: an in-memory LRU in front of an optional SQLite store.
+
+    Values must be JSON-serializable. Entries expire after `ttl_seconds` and the on-disk
+    store is trimmed to `max_entries` by evicting the least recently used rows. The
+    cache is safe to share between threads.
+    """
+
+    def __init__(self, path: str = None, memory_entries: int = 1024, max_entries: int = 100000, ttl_seconds: float = None):
+        """
+        Args:
+            path (str, optional): SQLite file for the persistent tier. If None, only the
+                                  in-memory tier is used.
+            memory_entries (int): Maximum number of entries kept in the in-memory LRU.
+            max_entries (int): Maximum number of rows kept in the on-disk store.
+            ttl_seconds (float, optional): Lifetime of an entry. If None, entries never expire.
+        """
+        self.path = path
+        self.memory_entries = memory_entries
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict() # key -> (stored_at, value)
+        self._lock = threading.Lock()
+        self._conn = None
+        self._disk_count = 0
+
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+            self._conn.commit()
+            self._disk_count = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def _expired(self, stored_at: float, now: float) -> bool:
+        return self.ttl_seconds is not None and now - stored_at > self.ttl_seconds
+
+    def _remember(self, key: str, stored_at: float, value):
+        self._memory[key] = (stored_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str, default=None):
+        """
+        Looks up a key, checking the in-memory tier first and then the on-disk store.
+
+        Args:
+            key (str): The cache key.
+            default: Value returned on a miss.
+
+        Returns:
+            The cached value, or `default` if the key is missing or expired.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._expired(entry[0], now):
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return entry[1]
+                del self._memory[key]
+
+            if self._conn is not None:
+                row = self._conn.execute("SELECT value, stored_at FROM cache WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    value_json, stored_at = row
+                    if not self._expired(stored_at, now):
+                        self._conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+                        self._conn.commit()
+                        value = json.loads(value_json)
+                        self._remember(key, stored_at, value)
+                        self.disk_hits += 1
+                        return value
+                    self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                    self._conn.commit()
+                    self._disk_count -= 1
+
+            self.misses += 1
+            return default
+
+    def put(self, key: str, value):
+        """
+        Stores a value in both tiers, evicting old entries if the store is over capacity.
+
+        Args:
+            key (str): The cache key.
+            value: A JSON-serializable value.
+        """
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, value)
+            if self._conn is None:
+                return
+
+            inserted = self._conn.execute("SELECT 1 FROM cache WHERE key = ?", (key,)).fetchone() is None
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, stored_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now)
+            )
+            if inserted:
+                self._disk_count += 1
+            if self._disk_count > self.max_entries:
+                self._evict_disk(now)
+            self._conn.commit()
+
+    def _evict_disk(self, now: float):
+        # Drop expired rows first, then the least recently used ones until we are back under the limit
+        if self.ttl_seconds is not None:
+            self._conn.execute("DELETE FROM cache WHERE stored_at < ?", (now - self.ttl_seconds,))
+        self._disk_count = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        excess = self._disk_count - self.max_entries
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at LIMIT ?)", (excess,)
+            )
+            self._disk_count -= excess
+
+    def stats(self) -> dict:
+        """
+        Returns the hit/miss counters and current sizes of both tiers.
+
+        Returns:
+            dict: 'memory_hits', 'disk_hits', 'misses', 'memory_entries' and 'disk_entries'.
+        """
+        with self._lock:
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'memory_entries': len(self._memory),
+                'disk_entries': self._disk_count,
+            }
+
+    def close(self):
+        """Closes the on-disk store. The in-memory tier stays usable."""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+_decision_cache = None
+_decision_cache_lock = threading.Lock()
+
+def get_decision_cache() -> TieredCache:
+    """
+    Returns the process-wide cache of parsed agent decisions, configured from src/config.py.
+
+    Returns:
+        TieredCache: The shared decision cache.
+    """
+    global _decision_cache
+    if _decision_cache is None:
+        with _decision_cache_lock:
+            if _decision_cache is None:
+                _decision_cache = TieredCache(
+                    path=config.DECISION_CACHE_PATH,
+                    memory_entries=config.DECISION_CACHE_MEMORY_ENTRIES,
+                    max_entries=config.DECISION_CACHE_MAX_ENTRIES,
+                    ttl_seconds=config.DECISION_CACHE_TTL_SECONDS,
+                )
+    return _decision_cache
+
+_detection_cache = None
+_detection_cache_lock = threading.Lock()
+
+def get_detection_cache() -> TieredCache:
+    """
+    Returns the process-wide cache of raw (unfiltered) detections, configured from src/config.py.
+
+    Returns:
+        TieredCache: The shared detection cache.
+    """
+    global _detection_cache
+    if _detection_cache is None:
+        with _detection_cache_lock:
+            if _detection_cache is None:
+                _detection_cache = TieredCache(
+                    path=config.DETECTION_CACHE_PATH,
+                    memory_entries=config.DETECTION_CACHE_MEMORY_ENTRIES,
+                    max_entries=config.DETECTION_CACHE_MAX_ENTRIES,
+                    ttl_seconds=config.DETECTION_CACHE_TTL_SECONDS,
+                )
+    return _detection_cache
+
+def region_key(image_key: str, box) -> str:
+    """
+    Identifies a crop of a source image without hashing its pixels.
+
+    Args:
+        image_key (str): A digest of the whole source image (e.g. from `file_digest`).
+        box (tuple): The crop box (left, upper, right, lower) in source image coordinates.
+
+    Returns:
+        str: The region key.
+    """
+    return make_key('region', image_key, [int(c) for c in box])
+
+def decision_key(image: Image.Image, prompt: str, model: str = None, region: str = None) -> str:
+    """
+    Builds the cache key of an agent decision from the patch pixels, the prompt and the model.
+
+    Args:
+        image (PIL.Image.Image): The patch sent to the agent (may be None for text-only prompts).
+                                 Not read when `region` is given.
+        prompt (str): The prompt text.
+        model (str, optional): The model id. Defaults to config.OPENROUTER_MULTIMODAL_MODEL.
+        region (str, optional): A `region_key` identifying the patch pixels without hashing
+                                them, e.g. for patches of memory-mapped images, where hashing
+                                would copy every full-resolution patch into memory.
+
+    Returns:
+        str: The cache key.
+    """
+    if model is None:
+        model = config.OPENROUTER_MULTIMODAL_MODEL
+    if region is not None:
+        return make_key('decision', region, prompt, model)
+    pixels = image_digest(image) if image is not None else ''
+    return make_key('decision', pixels, prompt, model)
@@ -0,0 +1,291 @@
+import argparse
+import contextlib
+import glob
+import json
+import os
+import sys
+import time
+from . import main_workflow
+from . import openrouter_agent
+from . import pipeline
+from . import cache
+from . import config
+from . import instrumentation
+from . import triage
+from .detection_pool import DetectionPool
+
+def expand_inputs(inputs):
+    """
+    Expands CLI inputs (files, directories and glob patterns) into image paths.
+
+    Args:
+        inputs (list[str]): The positional arguments given on the command line.
+
+    Yields:
+        str: Image paths, each at most once (however it was spelled), in argument order.
+    """
+    seen = set()
+    for pattern in inputs:
+        matches = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+        for match in matches:
+            for path in main_workflow.iter_image_paths(match):
+                key = os.path.abspath(path)
+                if key not in seen:
+                    seen.add(key)
+                    yield path
+
+def load_completed(results_path):
+    """
+    Reads the images that already have a successful result in a JSON Lines results file.
+
+    Args:
+        results_path (str): The results file; it may not exist yet.
+
+    Returns:
+        set[str]: The absolute paths of the images to skip when resuming.
+    """
+    completed = set()
+    if not os.path.exists(results_path):
+        return completed
+    with open(results_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue # a line cut short by an interrupted run
+            if record.get('status') == 'ok':
+                # Records store absolute paths; older relative ones resolve against the working directory
+                completed.add(os.path.abspath(record['image']))
+    return completed
+
+def job_record(result):
+    """
+    Converts a pipeline result into the JSON Lines record written to the results file.
+
+    Args:
+        result (ImageJob | pipeline.StageFailure): A completed image or a failure.
+
+    Returns:
+        dict: The record, with the absolute image path and detection boxes ([x, y, w, h]) in
+            original image coordinates.
+    """
+    if isinstance(result, pipeline.StageFailure):
+        job = result.item
+        return {
+            'image': os.path.abspath(job.image_path) if job is not None else None,
+            'status': 'error',
+            'stage': result.stage,
+            'error': str(result.error),
+        }
+
+    decisions = {}
+    for decision in result.decisions.values():
+        decisions[decision] = decisions.get(decision, 0) + 1
+    return {
+        'image': os.path.abspath(result.image_path),
+        'status': 'ok',
+        'detections': result.detections,
+        'decisions': decisions,
+        'agent_failures': result.agent_failures,
+        'output_image': result.output_path,
+    }
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m src",
+        description="Run the agentic object detection workflow over image files, directories or glob patterns.",
+    )
+    parser.add_argument('inputs', nargs='+', help="Image files, directories, or glob patterns (quote them, e.g. 'images/**/*.jpg').")
+    parser.add_argument('-o', '--output', default='results.jsonl', help="JSON Lines results file (default: %(default)s).")
+    parser.add_argument('--classes', default=None,
+                        help="Comma-separated target classes (default: person,car,dog,cat,bicycle,traffic light,stop sign).")
+    parser.add_argument('--rows', type=int, default=3, help="Rows in the patch grid (default: %(default)s).")
+    parser.add_argument('--cols', type=int, default=3, help="Columns in the patch grid (default: %(default)s).")
+    parser.add_argument('--scheduler', choices=['grid', 'quadtree'], default='grid',
+                        help="'grid' decides every grid patch; 'quadtree' starts from the grid as coarse tiles and "
+                             "only recurses where the agent wants analysis (default: %(default)s).")
+    parser.add_argument('--min-tile-size', type=int, default=512, help="Smallest quadtree tile side in pixels (default: %(default)s).")
+    parser.add_argument('--max-depth', type=int, default=4, help="Maximum quadtree splits below the root tiles (default: %(default)s).")
+    parser.add_argument('--decision-batch-size', type=int, default=config.AGENT_DECISION_BATCH_SIZE,
+                        help="Patches decided per agent request; above 1 the agent answers for several patches "
+                             "at once in JSON (default: %(default)s).")
+    triage_group = parser.add_mutually_exclusive_group()
+    triage_group.add_argument('--triage', action='store_true',
+                              help="Skip blank patches (no edges, nearly uniform) locally instead of asking the agent.")
+    triage_group.add_argument('--no-triage', action='store_true',
+                              help="Ask the agent about every patch, even if TRIAGE_ENABLED is set in config.py.")
+    parser.add_argument('--triage-detector', action='store_true',
+                        help="Also run the detector at a low threshold on small thumbnails during triage, "
+                             "analyzing patches with a likely target object without asking the agent.")
+    parser.add_argument('--expansion-factor', type=float, default=1.5, help="Expansion of EXPAND_CONTEXT patches (default: %(default)s).")
+    parser.add_argument('--threshold', type=float, default=None, help="Minimum detection score (default: 0.7).")
+    parser.add_argument('--batch-size', type=int, default=None, help="Patches per detector forward pass (default: 8).")
+    parser.add_argument('--workers', type=int, default=2,
+                        help="Worker threads for the decode, decide and render stages (default: %(default)s).")
+    parser.add_argument('--detect-workers', type=int, default=1, help="Worker threads for the detection stage (default: %(default)s).")
+    parser.add_argument('--detect-processes', type=int, default=0,
+                        help="Run detection in this many forked worker processes sharing one copy of the model (default: in-process).")
+    parser.add_argument('--threads-per-process', type=int, default=None,
+                        help="torch threads per detection process (default: CPU count / processes).")
+    parser.add_argument('--detector-backend', choices=['eager', 'torchscript', 'onnx'], default=config.DETECTOR_BACKEND,
+                        help="Detector inference backend; 'torchscript' and 'onnx' are experimental, 'onnx' needs onnxruntime (default: %(default)s).")
+    parser.add_argument('--quantize-int8', action='store_true',
+                        help="Run the detector with dynamic int8 quantization (CPU only).")
+    parser.add_argument('--merge', choices=['nms', 'wbf', 'none'], default='nms',
+                        help="How duplicate boxes from overlapping patches are merged (default: %(default)s).")
+    parser.add_argument('--merge-iou', type=float, default=0.5, help="Overlap above which boxes are duplicates (default: %(default)s).")
+    parser.add_argument('--merge-metric', choices=['iou', 'ios'], default='iou',
+                        help="Overlap measure; 'ios' also merges partial boxes cut at patch borders (default: %(default)s).")
+    parser.add_argument('--no-border-fusion', action='store_true',
+                        help="Don't join the parts of objects cut by the shared edge of adjacent patches.")
+    parser.add_argument('--border-tolerance', type=float, default=config.MERGE_BORDER_TOLERANCE,
+                        help="Pixels within which a box counts as reaching a patch edge for border fusion (default: %(default)s).")
+    parser.add_argument('--render-dir', default=None, help="Save annotated images here (default: don't render).")
+    parser.add_argument('--no-resume', action='store_true', help="Process every image even if the results file already has it.")
+    parser.add_argument('--trace-file', default=None,
+                        help="Append a JSON trace of per-stage timings and counters for every image to this JSON Lines file.")
+    parser.add_argument('--metrics-file', default=None,
+                        help="Write all timers (p50/p95/p99) and counters in Prometheus text format to this file at the end.")
+    parser.add_argument('--quiet', action='store_true', help="Hide per-patch progress output.")
+    return parser
+
+def print_report(elapsed, processed, failed, skipped, stage_seconds):
+    """Prints the throughput, per-stage latency and agent-call summary of a run."""
+    print(f"\nProcessed {processed} images ({failed} failed, {skipped} skipped as already done) in {elapsed:.1f}s"
+          f" - {processed / elapsed if elapsed > 0 else 0.0:.2f} images/s")
+    print("Stage latency per image (s):")
+    for stage, seconds in stage_seconds.items():
+        if seconds:
+            print(f"  {stage:<10} n={len(seconds):<6} mean={sum(seconds) / len(seconds):.3f}"
+                  f" p50={instrumentation.percentile(seconds, 0.5):.3f} p95={instrumentation.percentile(seconds, 0.95):.3f} max={max(seconds):.3f}")
+
+    call_stats = openrouter_agent.get_call_stats()
+    per_image = call_stats['calls'] / processed if processed else 0.0
+    print(f"Agent calls: {call_stats['calls']} ({call_stats['errors']} failed, {per_image:.2f} per image)")
+    scheduler_stats = openrouter_agent.get_scheduler().stats()
+    if any(scheduler_stats.values()):
+        print(f"Agent retries: {scheduler_stats['retries']}, hedged requests: {scheduler_stats['hedges']} "
+              f"({scheduler_stats['hedge_wins']} won), failovers: {scheduler_stats['failovers']}, "
+              f"rate-limit wait: {scheduler_stats['throttled_seconds']:.1f}s")
+    if call_stats['calls']:
+        print(f"Agent payload: {call_stats['request_bytes'] / 1e6:.2f} MB sent "
+              f"({call_stats['request_bytes'] / call_stats['calls'] / 1e3:.1f} kB per call), "
+              f"{call_stats['images']} images ({call_stats['image_bytes'] / 1e6:.2f} MB base64, "
+              f"{call_stats['encode_cache_hits']} reused encodings)")
+    triage_stats = triage.get_triage_stats()
+    if triage_stats['patches']:
+        saved = triage_stats['skipped'] + triage_stats['analyzed']
+        print(f"Local triage: {saved} of {triage_stats['patches']} patch decisions made without the agent "
+              f"({triage_stats['skipped']} skipped, {triage_stats['analyzed']} analyzed)")
+    if config.DECISION_CACHE_ENABLED:
+        print(f"Decision cache: {cache.get_decision_cache().stats()}")
+    if config.DETECTION_CACHE_ENABLED:
+        print(f"Detection cache: {cache.get_detection_cache().stats()}")
+    if instrumentation.enabled():
+        print("Timers (s):")
+        for name, summary in instrumentation.snapshot()['timers'].items():
+            print(f"  {name:<18} n={summary['count']:<6} total={summary['sum']:.3f} p50={summary['p50']:.4f}"
+                  f" p95={summary['p95']:.4f} p99={summary['p99']:.4f} max={summary['max']:.4f}")
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    if not config.OPENROUTER_API_KEY or config.OPENROUTER_API_KEY == "YOUR_OPENROUTER_API_KEY_HERE":
+        print("Error: OpenRouter API key not configured in src/config.py. Please set it to your actual key and run again.", file=sys.stderr)
+        return 1
+
+    # Detector.get reads these when the model is first loaded (here or in the detection pool)
+    config.DETECTOR_BACKEND = args.detector_backend
+    config.DETECTOR_QUANTIZE_INT8 = config.DETECTOR_QUANTIZE_INT8 or args.quantize_int8
+
+    settings_kwargs = {}
+    detection_pool = None
+    detect_workers = args.detect_workers
+    if args.detect_processes > 0:
+        # Fork the workers before any other thread starts
+        detection_pool = DetectionPool(
+            num_workers=args.detect_processes,
+            threads_per_worker=args.threads_per_process,
+            batch_size=args.batch_size or main_workflow.vision_tool_interface.DEFAULT_BATCH_SIZE,
+        )
+        settings_kwargs['detection_pool'] = detection_pool
+        detect_workers = max(detect_workers, args.detect_processes)
+    if args.batch_size is not None:
+        settings_kwargs['detection_batch_size'] = args.batch_size
+    if args.threshold is not None:
+        settings_kwargs['detection_threshold'] = args.threshold
+    settings = main_workflow.WorkflowSettings(
+        target_classes=[c.strip() for c in args.classes.split(',') if c.strip()] if args.classes else None,
+        num_rows=args.rows,
+        num_cols=args.cols,
+        expansion_factor=args.expansion_factor,
+        scheduler=args.scheduler,
+        decision_batch_size=args.decision_batch_size,
+        triage=(config.TRIAGE_ENABLED or args.triage or args.triage_detector) and not args.no_triage,
+        triage_detector=config.TRIAGE_USE_DETECTOR or args.triage_detector,
+        min_tile_size=args.min_tile_size,
+        max_depth=args.max_depth,
+        output_dir=args.render_dir,
+        render=args.render_dir is not None,
+        merge_method=None if args.merge == 'none' else args.merge,
+        merge_iou_threshold=args.merge_iou,
+        merge_metric=args.merge_metric,
+        border_fusion=config.MERGE_BORDER_FUSION and not args.no_border_fusion,
+        border_tolerance=args.border_tolerance,
+        stage_workers={'decode': args.workers, 'decide': args.workers, 'render': args.workers, 'detect': detect_workers},
+        **settings_kwargs,
+    )
+
+    completed = set() if args.no_resume else load_completed(args.output)
+    skipped = 0
+
+    def pending_paths():
+        nonlocal skipped
+        for path in expand_inputs(args.inputs):
+            if os.path.abspath(path) in completed:
+                skipped += 1
+                continue
+            yield path
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    if args.trace_file or args.metrics_file:
+        instrumentation.enable() # before the jobs are created, so each one gets a trace
+    trace_sink = open(args.trace_file, 'a', encoding='utf-8') if args.trace_file else None
+
+    # The detector weights are loaded once per process, on the first detection (or by DetectionPool before forking)
+    workflow_pipeline = main_workflow.build_pipeline(settings)
+    jobs = (main_workflow.ImageJob(path, settings) for path in pending_paths())
+    processed = failed = 0
+    started = time.perf_counter()
+    log = open(os.devnull, 'w') if args.quiet else sys.stdout
+    try:
+        with open(args.output, 'a', encoding='utf-8') as sink, contextlib.redirect_stdout(log):
+            for result in workflow_pipeline.run(jobs):
+                record = job_record(result)
+                sink.write(json.dumps(record) + "\n")
+                sink.flush() # every finished image is durable, so an interrupted run resumes where it stopped
+                processed += 1
+                job = result.item if isinstance(result, pipeline.StageFailure) else result
+                if trace_sink is not None and job is not None and job.trace is not None:
+                    trace_sink.write(json.dumps(dict(job.trace.to_dict(), status=record['status'])) + "\n")
+                    trace_sink.flush()
+                if record['status'] != 'ok':
+                    failed += 1
+                    print(f"Error: {record['image']} failed in the {record['stage']} stage: {record['error']}", file=sys.stderr)
+    except KeyboardInterrupt:
+        print("\nInterrupted; completed images are saved and will be skipped on the next run.", file=sys.stderr)
+    finally:
+        if log is not sys.stdout:
+            log.close()
+        if trace_sink is not None:
+            trace_sink.close()
+        if detection_pool is not None:
+            detection_pool.shutdown()
+        if args.metrics_file:
+            instrumentation.write_prometheus(args.metrics_file)
+
+    print_report(time.perf_counter() - started, processed, failed, skipped, workflow_pipeline.stage_seconds)
+    return 1 if failed else 0
@@ -1,3 +1,102 @@
 OPENROUTER_API_KEY = "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"
 # Placeholder for the specific multimodal model to be used on OpenRouter
 OPENROUTER_MULTIMODAL_MODEL = "google/gemini-2.0-flash-exp:free"
+# Chat-completions endpoint; point it at a local mock (see benchmarks/mock_openrouter.py) to run offline
+OPENROUTER_CHAT_URL = "https://openrouter.ai/api/v1/chat/completions"
+# Maximum number of OpenRouter requests in flight at once across the whole process, whichever image or
+# worker sends them (also the HTTP connection pool size)
+OPENROUTER_MAX_CONCURRENCY = 8
+# How patch images are encoded for the agent: the longer side is scaled down to AGENT_IMAGE_MAX_EDGE
+# (None keeps full resolution), saved as "JPEG" or "WEBP" (smaller, if Pillow has WebP support) at
+# AGENT_IMAGE_QUALITY, and the last AGENT_IMAGE_CACHE_ENTRIES encodings are reused when a patch is sent again.
+AGENT_IMAGE_MAX_EDGE = 1024
+AGENT_IMAGE_FORMAT = "JPEG"
+AGENT_IMAGE_QUALITY = 85
+AGENT_IMAGE_CACHE_ENTRIES = 256
+# Resilience of agent requests. Requests per minute are limited per model (models not listed are not
+# limited; OpenRouter's free models allow about 20). Transient failures (429, 5xx, timeouts) are retried
+# up to OPENROUTER_MAX_RETRIES times with exponential backoff and jitter, then OPENROUTER_FALLBACK_MODEL
+# (if set) is tried. With OPENROUTER_HEDGE_REQUESTS, a request slower than the recent p95 latency gets a
+# duplicate and the first answer wins.
+OPENROUTER_TIMEOUT_SECONDS = 60
+OPENROUTER_REQUESTS_PER_MINUTE = {"google/gemini-2.0-flash-exp:free": 20}
+OPENROUTER_RATE_BURST = 4
+OPENROUTER_MAX_RETRIES = 3
+OPENROUTER_BACKOFF_BASE_SECONDS = 1.0
+OPENROUTER_BACKOFF_MAX_SECONDS = 30.0
+OPENROUTER_HEDGE_REQUESTS = False
+OPENROUTER_HEDGE_MIN_DELAY_SECONDS = 2.0
+OPENROUTER_FALLBACK_MODEL = None
+# Decision used for a patch whose agent request failed for good. ANALYZE keeps the patch (the
+# detector decides); SKIP drops it.
+AGENT_FAILURE_DECISION = "ANALYZE"
+# Cache of parsed agent decisions, keyed by patch pixels, prompt and model.
+# Set DECISION_CACHE_PATH to None to keep the cache in memory only.
+DECISION_CACHE_ENABLED = True
+DECISION_CACHE_PATH = ".cache/agent_decisions.sqlite"
+DECISION_CACHE_MEMORY_ENTRIES = 4096
+DECISION_CACHE_MAX_ENTRIES = 200000
+DECISION_CACHE_TTL_SECONDS = 30 * 24 * 3600
+# Cache of raw DETR detections, keyed by source image digest, crop box, model and threshold.
+# Set DETECTION_CACHE_PATH to None to keep it in memory only (bounded by DETECTION_CACHE_MEMORY_ENTRIES).
+DETECTION_CACHE_ENABLED = True
+DETECTION_CACHE_PATH = ".cache/detections.sqlite"
+DETECTION_CACHE_MEMORY_ENTRIES = 2048
+DETECTION_CACHE_MAX_ENTRIES = 200000
+DETECTION_CACHE_TTL_SECONDS = None
+# Images with at least this many pixels are decoded once to a raw RGB file in TILE_CACHE_DIR
+# and memory-mapped, so only the regions being processed are read into memory. When a new file makes
+# the directory larger than TILE_CACHE_MAX_BYTES, the least recently used files are deleted (None: no limit).
+MEMMAP_MIN_PIXELS = 50_000_000
+TILE_CACHE_DIR = ".cache/tiles"
+TILE_CACHE_MAX_BYTES = 20 * 1024**3
+# Longest edge of the rendered output for memory-mapped images
+PREVIEW_MAX_EDGE = 4096
+# Object detection model, loaded lazily on the first detection. DETECTOR_DEVICE None picks CUDA if available.
+DETECTOR_MODEL_ID = "facebook/detr-resnet-50"
+DETECTOR_DEVICE = None
+# Detector inference backend (see src/detector_backends.py): "eager" runs the PyTorch model as loaded,
+# "torchscript" runs traced graphs and "onnx" runs an exported model with ONNX Runtime (CPU; needs the
+# onnxruntime package). "torchscript" and "onnx" are experimental: check them against "eager" with
+# benchmarks/compare_backends.py before use. DETECTOR_QUANTIZE_INT8 applies dynamic int8 quantization on the CPU.
+# DETECTOR_INPUT_SIZES are fixed (height, width) input buckets every patch is resized and padded into,
+# so exported graphs never see new shapes; None keeps the processor's dynamic sizes for "eager" and
+# uses detector_backends.DEFAULT_INPUT_SIZES for the others. Traces and ONNX files go to DETECTOR_EXPORT_DIR.
+DETECTOR_BACKEND = "eager"
+DETECTOR_QUANTIZE_INT8 = False
+DETECTOR_INPUT_SIZES = None
+DETECTOR_EXPORT_DIR = ".cache/detector"
+# Batch size of the TorchScript traces (one trace per input size). 1 suits CPUs, where batching gains little
+# and padding would waste work; on a GPU, set it to the detection batch size.
+DETECTOR_TRACE_BATCH_SIZE = 1
+# Border fusion while merging: an object cut by the shared edge of two adjacent patches is found as two
+# boxes that don't overlap; they are joined when both reach the edge (within MERGE_BORDER_TOLERANCE pixels),
+# line up along it and the image continues across the seam between them.
+MERGE_BORDER_FUSION = True
+MERGE_BORDER_TOLERANCE = 2.0
+# Patches decided per agent request. 1 sends one patch per request; larger values send several
+# patch images in one request and ask for a JSON object of per-patch decisions.
+AGENT_DECISION_BATCH_SIZE = 1
+# Local triage: cheap per-patch statistics decide trivially empty (and, optionally, obviously busy)
+# patches without calling the agent. Statistics are computed on TRIAGE_THUMBNAIL_SIZE grayscale thumbnails.
+# Off by default (the CLI's --triage turns it on): a skipped patch never reaches the agent or the detector.
+# A patch is skipped only when all three statistics are at or below their maximum. The defaults were measured
+# on 1000-pixel patches: a uniform or sensor-noise background stays below them, while a single 10-30 pixel
+# object with a contrast of 20 gray levels already produces edge pixels. Smooth gradients (sky) are not skipped.
+TRIAGE_ENABLED = False
+TRIAGE_THUMBNAIL_SIZE = 64
+TRIAGE_EDGE_MAGNITUDE = 8.0 # gradient magnitude (gray levels per pixel) that counts as an edge
+TRIAGE_SKIP_MAX_VARIANCE = 1.0 # gray-level variance
+TRIAGE_SKIP_MAX_EDGE_DENSITY = 0.0 # fraction of edge pixels: no edge at all
+TRIAGE_SKIP_MAX_ENTROPY = 1.5 # tonal variety (bits, 0-6)
+TRIAGE_ANALYZE_MIN_EDGE_DENSITY = None # e.g. 0.25 to auto-ANALYZE very busy patches
+TRIAGE_ANALYZE_MIN_ENTROPY = None # e.g. 5.5
+# Optionally run the detector at a low threshold on small thumbnails of the undecided patches
+TRIAGE_USE_DETECTOR = False
+TRIAGE_DETECTOR_SIZE = 384
+TRIAGE_DETECTOR_THRESHOLD = 0.3
+# Stage timers, counters and per-image traces (see src/instrumentation.py). Off by default; the CLI
+# turns them on for --trace-file and --metrics-file. Percentiles use the last INSTRUMENTATION_MAX_SAMPLES
+# samples of every timer.
+INSTRUMENTATION_ENABLED = False
+INSTRUMENTATION_MAX_SAMPLES = 10000
@@ -0,0 +1,175 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from PIL import Image
+from . import config
+from . import vision_tool_interface
+
+def _init_worker(num_threads: int):
+    # Each worker gets its own slice of the cores instead of every process using all of them
+    import torch
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass # already fixed in this process
+
+def _ping():
+    return os.getpid()
+
+def _warmup_in_worker():
+    vision_tool_interface.Detector.get(vision_tool_interface.MODEL_ID).warmup()
+    return os.getpid()
+
+def _detect_in_worker(images, batch_size, threshold):
+    # Runs in a forked worker: the model was loaded by the parent and its weights are shared copy-on-write
+    return vision_tool_interface.detect_raw_batch(images, batch_size=batch_size, threshold=threshold)
+
+class DetectionPool:
+    """
+    A pool of forked worker processes running DETR inference.
+
+    The model is loaded once in the parent before the workers are forked, so every worker
+    maps the same weight pages copy-on-write instead of loading its own copy, and each worker
+    limits torch to `threads_per_worker` intra-op threads. Work is submitted in batches and
+    returns futures, so the detection stages of many images can keep all workers busy.
+    With an exported backend, one worker builds the traces or ONNX files before the pool is
+    used and the others load them.
+
+    Create the pool before starting other threads or running inference in the parent:
+    forking a process that is already running torch's thread pools can deadlock the children.
+    """
+
+    def __init__(self, num_workers: int = None, threads_per_worker: int = None, batch_size: int = vision_tool_interface.DEFAULT_BATCH_SIZE):
+        """
+        Args:
+            num_workers (int, optional): Number of worker processes. Defaults to the CPU count.
+            threads_per_worker (int, optional): torch threads per worker. Defaults to an even
+                                                share of the CPUs (at least 1).
+            batch_size (int): Maximum number of images per forward pass in a worker.
+        """
+        # Load the weights in the parent so the forked workers share them instead of loading their own
+        try:
+            vision_tool_interface.Detector.get(vision_tool_interface.MODEL_ID)
+        except Exception as e:
+            raise RuntimeError(f"Could not load the detection model, cannot start the detection pool: {e}") from e
+
+        cpu_count = os.cpu_count() or 1
+        self.num_workers = max(1, num_workers or cpu_count)
+        self.threads_per_worker = max(1, threads_per_worker or cpu_count // self.num_workers)
+        self.batch_size = max(1, batch_size)
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=multiprocessing.get_context('fork'),
+            initializer=_init_worker,
+            initargs=(self.threads_per_worker,),
+        )
+        # Fork every worker now, while the parent is still single-threaded, rather than on the first real submit
+        for future in [self._executor.submit(_ping) for _ in range(self.num_workers)]:
+            future.result()
+        if config.DETECTOR_BACKEND != "eager":
+            # Build the traces or ONNX files once, in one worker (the parent must not run inference
+            # before forking), so the other workers load them from DETECTOR_EXPORT_DIR instead of
+            # all exporting the same files at once
+            self._executor.submit(_warmup_in_worker).result()
+
+    def submit_raw(self, images: list[Image.Image], threshold: float = vision_tool_interface.DETECTION_THRESHOLD) -> list[Future]:
+        """
+        Queues images for detection, one task per batch.
+
+        Args:
+            images (list[PIL.Image.Image]): RGB Pillow Image objects.
+            threshold (float): Minimum score of a detection.
+
+        Returns:
+            list[Future]: One future per batch of `batch_size` images, each resolving to the
+                          raw detection lists of its images (see `detect_raw_batch`).
+        """
+        return [
+            self._executor.submit(_detect_in_worker, images[start:start + self.batch_size], self.batch_size, threshold)
+            for start in range(0, len(images), self.batch_size)
+        ]
+
+    def submit(self, images: list[Image.Image], target_classes: list[str] = None,
+               threshold: float = vision_tool_interface.DETECTION_THRESHOLD) -> Future:
+        """
+        Queues images for detection and returns a single future for all of them.
+
+        Args:
+            images (list[PIL.Image.Image]): The Pillow Image objects to run detection on.
+            target_classes (list[str], optional): A list of class names to filter for.
+            threshold (float): Minimum score of a detection.
+
+        Returns:
+            Future: Resolves to one list of detections per image, like `detect_objects_batch`.
+        """
+        images = [image if image.mode == 'RGB' else image.convert('RGB') for image in images]
+        batch_futures = self.submit_raw(images, threshold)
+        result = Future()
+        remaining = [len(batch_futures)]
+        # Callbacks run in the executor's thread, or in this one for futures already done
+        remaining_lock = threading.Lock()
+
+        def on_batch_done(_):
+            with remaining_lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            try:
+                raw = [detections for future in batch_futures for detections in future.result()]
+                result.set_result([vision_tool_interface._filter_detections(r or [], target_classes) for r in raw])
+            except Exception as e:
+                result.set_exception(e)
+
+        if not batch_futures:
+            result.set_result([])
+        for future in batch_futures:
+            future.add_done_callback(on_batch_done)
+        return result
+
+    def detect_raw_batch(self, images: list[Image.Image], batch_size: int = None,
+                         threshold: float = vision_tool_interface.DETECTION_THRESHOLD):
+        """
+        Drop-in replacement for `vision_tool_interface.detect_raw_batch` that spreads the
+        batches over the worker processes and waits for them.
+
+        Args:
+            images (list[PIL.Image.Image]): RGB Pillow Image objects.
+            batch_size (int, optional): Ignored; the pool's own batch size is used.
+            threshold (float): Minimum score of a detection.
+
+        Returns:
+            list: One list of raw detections per image, or None where a batch failed.
+        """
+        raw_detections = []
+        for future in self.submit_raw(images, threshold):
+            try:
+                raw_detections.extend(future.result())
+            except Exception as e:
+                print(f"Error in detection worker: {e}")
+                raw_detections.extend([None] * min(self.batch_size, len(images) - len(raw_detections)))
+        return raw_detections
+
+    def warmup(self):
+        """
+        Runs `Detector.warmup` in the workers, so the first real batches don't pay for lazy
+        initialization. Use this instead of warming up the detector in the parent, which
+        must not run inference before or while the workers are forked.
+
+        Returns:
+            int: The number of distinct workers that ran a warm-up (the pool hands the tasks
+                 to idle workers, so a worker may occasionally take two).
+        """
+        futures = [self._executor.submit(_warmup_in_worker) for _ in range(self.num_workers)]
+        return len({future.result() for future in futures})
+
+    def shutdown(self):
+        """Stops the worker processes after the queued work finishes."""
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.shutdown()
@@ -0,0 +1,327 @@
+import copy
+import os
+import re
+import threading
+import types
+import numpy as np
+from PIL import Image
+from . import config
+
+# torch, transformers and onnxruntime are imported inside the functions that need them, like in
+# vision_tool_interface, so importing this module stays cheap.
+#
+# The "torchscript" and "onnx" backends are experimental: their detections and speed have not been
+# verified against "eager" yet (benchmarks/compare_backends.py does that on a set of images).
+
+BACKENDS = ("eager", "torchscript", "onnx")
+EXPERIMENTAL_BACKENDS = ("torchscript", "onnx")
+# (height, width) buckets used by the exported backends when DETECTOR_INPUT_SIZES is not set; close to
+# DETR's own 800-pixel shortest edge, in landscape, square and portrait shapes
+DEFAULT_INPUT_SIZES = ((800, 1088), (800, 800), (1088, 800))
+
+def backend_signature(backend: str, quantize: bool, input_sizes) -> str:
+    """
+    Describes a backend configuration, e.g. for cache keys: quantized or resized inputs can
+    change the detections slightly, so results of different configurations must not mix.
+
+    Args:
+        backend (str): One of BACKENDS.
+        quantize (bool): Whether dynamic int8 quantization is applied.
+        input_sizes (tuple, optional): The (height, width) buckets, or None for dynamic sizes.
+
+    Returns:
+        str: A short, stable description.
+    """
+    sizes = ",".join(f"{h}x{w}" for h, w in input_sizes) if input_sizes else "dynamic"
+    return f"{backend}{'-int8' if quantize else ''}@{sizes}"
+
+def choose_input_size(image_size, input_sizes):
+    """
+    Picks the bucket an image fits best when scaled with its aspect ratio kept.
+
+    Args:
+        image_size (tuple): (width, height) of the image.
+        input_sizes (tuple): Candidate (height, width) buckets.
+
+    Returns:
+        tuple: ((height, width) of the bucket, (width, height) to resize the image to).
+    """
+    width, height = image_size
+    best = None
+    for bucket_height, bucket_width in input_sizes:
+        scale = min(bucket_height / height, bucket_width / width)
+        resized = (max(1, min(bucket_width, round(width * scale))), max(1, min(bucket_height, round(height * scale))))
+        # Prefer the bucket the image fills most (least padding), then the smaller one
+        fill = (resized[0] * resized[1]) / (bucket_width * bucket_height)
+        key = (fill, -bucket_width * bucket_height)
+        if best is None or key > best[0]:
+            best = (key, (bucket_height, bucket_width), resized)
+    return best[1], best[2]
+
+def preprocess_fixed(images, input_size, image_mean, image_std):
+    """
+    Resizes, normalizes and pads images into one fixed-size batch.
+
+    Each image is resized (keeping its aspect ratio) to fit `input_size` and placed in the
+    top-left corner; the pixel mask marks the real pixels, as DETR's own processor does for
+    padded batches. The predicted boxes are therefore relative to each image's own extent
+    and are post-processed exactly like the processor's output.
+
+    Args:
+        images (list[PIL.Image.Image]): RGB images.
+        input_size (tuple): (height, width) of the batch.
+        image_mean (list): Per-channel mean, in the 0-1 range.
+        image_std (list): Per-channel standard deviation, in the 0-1 range.
+
+    Returns:
+        tuple: (pixel_values, pixel_mask) as a float32 (B, 3, H, W) and an int64 (B, H, W) array.
+    """
+    height, width = input_size
+    pixel_values = np.zeros((len(images), 3, height, width), dtype=np.float32)
+    pixel_mask = np.zeros((len(images), height, width), dtype=np.int64)
+    mean = np.asarray(image_mean, dtype=np.float32).reshape(3, 1, 1)
+    scale = 1.0 / (np.asarray(image_std, dtype=np.float32).reshape(3, 1, 1) * 255.0)
+    for i, image in enumerate(images):
+        _, (new_width, new_height) = choose_input_size(image.size, [input_size])
+        resized = np.asarray(image.resize((new_width, new_height), Image.BILINEAR), dtype=np.float32)
+        pixel_values[i, :, :new_height, :new_width] = resized.transpose(2, 0, 1) * scale - mean * scale * 255.0
+        pixel_mask[i, :new_height, :new_width] = 1
+    return pixel_values, pixel_mask
+
+def as_detr_outputs(logits, pred_boxes):
+    """
+    Wraps raw backend outputs so `DetrImageProcessor.post_process_object_detection` accepts them.
+
+    Args:
+        logits (torch.Tensor | numpy.ndarray): (B, queries, classes + 1) class logits.
+        pred_boxes (torch.Tensor | numpy.ndarray): (B, queries, 4) normalized (cx, cy, w, h) boxes.
+
+    Returns:
+        types.SimpleNamespace: An object with `logits` and `pred_boxes` tensors.
+    """
+    import torch
+    if isinstance(logits, np.ndarray):
+        logits, pred_boxes = torch.from_numpy(logits), torch.from_numpy(pred_boxes)
+    return types.SimpleNamespace(logits=logits, pred_boxes=pred_boxes)
+
+def _export_name(model_id, quantize, suffix):
+    safe_id = re.sub(r'[^A-Za-z0-9]+', '_', model_id).strip('_')
+    return f"{safe_id}{'_int8' if quantize else ''}_{suffix}"
+
+def _write_atomically(path, write):
+    # Writes through a temp file private to this process, so concurrent processes exporting the
+    # same file never see (or load) a partial one; a failed write leaves nothing behind
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _output_module(model):
+    """Wraps a DETR model in a module taking plain tensors and returning (logits, pred_boxes)."""
+    import torch
+
+    class DetrOutputs(torch.nn.Module):
+        def __init__(self, detr):
+            super().__init__()
+            self.detr = detr
+
+        def forward(self, pixel_values, pixel_mask):
+            outputs = self.detr(pixel_values=pixel_values, pixel_mask=pixel_mask)
+            return outputs.logits, outputs.pred_boxes
+
+    return DetrOutputs(model).eval()
+
+def quantize_dynamic_int8(model):
+    """
+    Applies dynamic int8 quantization to the linear layers of a model (CPU inference only).
+
+    The transformer's linear layers hold most of DETR's compute and weights; their weights
+    are stored as int8 and activations are quantized on the fly, while the convolutional
+    backbone stays in fp32.
+
+    Args:
+        model (torch.nn.Module): The fp32 model, on the CPU.
+
+    Returns:
+        torch.nn.Module: The quantized model.
+    """
+    import torch
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+class EagerBackend:
+    """Runs the (optionally quantized) PyTorch model directly."""
+
+    def __init__(self, model, device, model_id=None, quantize=False, export_dir=None):
+        self.device = device
+        self.module = _output_module(quantize_dynamic_int8(model) if quantize else model)
+
+    def __call__(self, pixel_values, pixel_mask):
+        import torch
+        with torch.inference_mode():
+            return self.module(torch.from_numpy(pixel_values).to(self.device), torch.from_numpy(pixel_mask).to(self.device))
+
+class TorchScriptBackend:
+    """
+    Runs TorchScript traces of the model, exactly one per input size. Experimental.
+
+    Every trace is made at the fixed batch size config.DETECTOR_TRACE_BATCH_SIZE: larger
+    batches run through it in chunks and a partial chunk is padded with blank images whose
+    outputs are dropped. With fixed input sizes the number of traces is the number of buckets,
+    each traced once (or loaded from `export_dir`, where traces are saved) and never re-traced.
+    """
+
+    def __init__(self, model, device, model_id, quantize=False, export_dir=None):
+        self.device = device
+        self.model_id = model_id
+        self.quantize = quantize
+        self.export_dir = export_dir
+        self.batch_size = max(1, config.DETECTOR_TRACE_BATCH_SIZE)
+        self.module = _output_module(quantize_dynamic_int8(model) if quantize else model)
+        self._traces = {}
+        self._lock = threading.Lock()
+
+    def _trace(self, pixel_values, pixel_mask):
+        import torch
+        key = tuple(pixel_values.shape)
+        traced = self._traces.get(key)
+        if traced is not None:
+            return traced
+        with self._lock:
+            traced = self._traces.get(key)
+            if traced is None:
+                path = None
+                if self.export_dir:
+                    os.makedirs(self.export_dir, exist_ok=True)
+                    path = os.path.join(self.export_dir, _export_name(self.model_id, self.quantize, f"b{key[0]}_{key[2]}x{key[3]}_{self.device}.pt"))
+                if path and os.path.exists(path):
+                    traced = torch.jit.load(path, map_location=self.device)
+                else:
+                    print(f"Tracing the detector for input shape {key}...")
+                    with torch.inference_mode():
+                        traced = torch.jit.trace(self.module, (pixel_values, pixel_mask), check_trace=False)
+                    traced = torch.jit.freeze(traced) if not self.quantize else traced
+                    if path:
+                        _write_atomically(path, lambda tmp_path: torch.jit.save(traced, tmp_path))
+                self._traces[key] = traced
+        return traced
+
+    def __call__(self, pixel_values, pixel_mask):
+        import torch
+        logits, pred_boxes = [], []
+        for start in range(0, len(pixel_values), self.batch_size):
+            values = pixel_values[start:start + self.batch_size]
+            mask = pixel_mask[start:start + self.batch_size]
+            count = len(values)
+            if count < self.batch_size:
+                # Pad with blank images (fully valid masks, so attention stays well-defined)
+                padding = self.batch_size - count
+                values = np.concatenate([values, np.zeros((padding,) + values.shape[1:], dtype=values.dtype)])
+                mask = np.concatenate([mask, np.ones((padding,) + mask.shape[1:], dtype=mask.dtype)])
+            values = torch.from_numpy(values).to(self.device)
+            mask = torch.from_numpy(mask).to(self.device)
+            traced = self._trace(values, mask)
+            with torch.inference_mode():
+                chunk_logits, chunk_boxes = traced(values, mask)
+            logits.append(chunk_logits[:count])
+            pred_boxes.append(chunk_boxes[:count])
+        return torch.cat(logits), torch.cat(pred_boxes)
+
+class OnnxBackend:
+    """
+    Runs the model with ONNX Runtime on the CPU. Experimental.
+
+    The model is exported once per input size (with a dynamic batch dimension) to
+    `export_dir` and, with `quantize`, converted to dynamic int8 by ONNX Runtime's quantizer.
+    Sessions are created lazily in each process, so a DetectionPool can fork after the
+    detector is set up without sharing ONNX Runtime's thread pools across processes.
+    """
+
+    def __init__(self, model, device, model_id, quantize=False, export_dir=None):
+        if device != "cpu":
+            print(f"Note: the ONNX backend runs on the CPU; ignoring device {device}.")
+        self.model_id = model_id
+        self.quantize = quantize
+        self.export_dir = export_dir or config.DETECTOR_EXPORT_DIR
+        # Export from a CPU copy: `model.to` moves in place, and the model is shared with the Detector
+        self.module = _output_module(model if device == "cpu" else copy.deepcopy(model).to("cpu"))
+        self._sessions = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def _export(self, input_size):
+        import torch
+        height, width = input_size
+        os.makedirs(self.export_dir, exist_ok=True)
+        path = os.path.join(self.export_dir, _export_name(self.model_id, False, f"{height}x{width}.onnx"))
+        if not os.path.exists(path):
+            print(f"Exporting the detector to ONNX for input size {height}x{width}...")
+            example = (torch.zeros(1, 3, height, width), torch.ones(1, height, width, dtype=torch.int64))
+            _write_atomically(path, lambda tmp_path: torch.onnx.export(
+                self.module, example, tmp_path,
+                input_names=["pixel_values", "pixel_mask"], output_names=["logits", "pred_boxes"],
+                dynamic_axes={"pixel_values": {0: "batch"}, "pixel_mask": {0: "batch"},
+                              "logits": {0: "batch"}, "pred_boxes": {0: "batch"}},
+                opset_version=17, do_constant_folding=True,
+            ))
+        if not self.quantize:
+            return path
+
+        quantized_path = os.path.join(self.export_dir, _export_name(self.model_id, True, f"{height}x{width}.onnx"))
+        if not os.path.exists(quantized_path):
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            print(f"Quantizing the ONNX detector for input size {height}x{width} to int8...")
+            _write_atomically(quantized_path, lambda tmp_path: quantize_dynamic(path, tmp_path, weight_type=QuantType.QInt8))
+        return quantized_path
+
+    def _session(self, input_size):
+        if self._pid != os.getpid():
+            # Forked: sessions of the parent are not safe to use here
+            self._sessions, self._pid, self._lock = {}, os.getpid(), threading.Lock()
+        session = self._sessions.get(input_size)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(input_size)
+                if session is None:
+                    import onnxruntime
+                    options = onnxruntime.SessionOptions()
+                    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+                    session = onnxruntime.InferenceSession(self._export(input_size), options, providers=["CPUExecutionProvider"])
+                    self._sessions[input_size] = session
+        return session
+
+    def __call__(self, pixel_values, pixel_mask):
+        session = self._session(tuple(pixel_values.shape[2:]))
+        logits, pred_boxes = session.run(["logits", "pred_boxes"], {"pixel_values": pixel_values, "pixel_mask": pixel_mask})
+        return logits, pred_boxes
+
+def create_backend(name: str, model, device: str, model_id: str, quantize: bool = False, export_dir: str = None):
+    """
+    Builds an inference backend for a loaded DETR model.
+
+    Args:
+        name (str): 'eager', 'torchscript' or 'onnx' (the last two are experimental).
+        model (DetrForObjectDetection): The loaded model, in eval mode.
+        device (str): torch device of the model.
+        model_id (str): Model id, used to name exported files.
+        quantize (bool): Apply dynamic int8 quantization (CPU only; ignored with a warning on GPUs).
+        export_dir (str, optional): Where traces and ONNX files are saved. Defaults to
+                                    config.DETECTOR_EXPORT_DIR.
+
+    Returns:
+        A callable taking (pixel_values, pixel_mask) NumPy arrays and returning (logits, pred_boxes).
+
+    Raises:
+        ValueError: For an unknown backend name.
+    """
+    backends = {"eager": EagerBackend, "torchscript": TorchScriptBackend, "onnx": OnnxBackend}
+    if name not in backends:
+        raise ValueError(f"Unknown detector backend: {name} (expected one of {', '.join(BACKENDS)})")
+    if name in EXPERIMENTAL_BACKENDS:
+        print(f"Note: the {name} detector backend is experimental; compare it with 'eager' using benchmarks/compare_backends.py.")
+    if quantize and device != "cpu" and name != "onnx":
+        print(f"Warning: dynamic int8 quantization only runs on the CPU; running {name} in fp32 on {device}.")
+        quantize = False
+    return backends[name](model, device, model_id, quantize=quantize, export_dir=export_dir or config.DETECTOR_EXPORT_DIR)
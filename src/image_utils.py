@@ -1,4 +1,102 @@
 from PIL import Image
+import numpy as np
+import contextlib
+import hashlib
+import os
+import threading
+
+class Patch:
+    """
+    A lazy view of a rectangular region of a source image.
+
+    Only the source reference and the coordinates are stored; pixels are cropped out of the
+    source when `image` or `array` is accessed and are not kept afterwards, so a grid of
+    patches costs no more memory than the source image itself. The source can be a Pillow
+    Image or an (H, W, 3) NumPy array, in which case `array` is a zero-copy view.
+
+    For compatibility with code written against the old dictionaries, `patch['patch_image']`
+    and `patch['coords']` still work.
+    """
+    __slots__ = ('source', 'coords')
+
+    def __init__(self, source, coords):
+        """
+        Args:
+            source (PIL.Image.Image | numpy.ndarray): The full image the patch belongs to.
+            coords (tuple): (left, upper, right, lower) of the patch in the source image.
+        """
+        self.source = source
+        self.coords = coords
+
+    @property
+    def width(self):
+        return self.coords[2] - self.coords[0]
+
+    @property
+    def height(self):
+        return self.coords[3] - self.coords[1]
+
+    @property
+    def size(self):
+        return (self.width, self.height)
+
+    @property
+    def array(self):
+        """numpy.ndarray: The patch pixels as an (H, W, C) array (a view when the source is an array)."""
+        left, upper, right, lower = self.coords
+        if isinstance(self.source, np.ndarray):
+            return self.source[upper:lower, left:right]
+        return np.asarray(self.source.crop(self.coords))
+
+    @property
+    def image(self):
+        """PIL.Image.Image: The patch pixels, cropped from the source on every access."""
+        if isinstance(self.source, np.ndarray):
+            return Image.fromarray(np.ascontiguousarray(self.array))
+        return self.source.crop(self.coords)
+
+    def __getitem__(self, key):
+        if key == 'patch_image':
+            return self.image
+        if key == 'coords':
+            return self.coords
+        raise KeyError(key)
+
+    def __repr__(self):
+        return f"Patch(coords={self.coords})"
+
+def _source_size(image):
+    # (width, height) of a Pillow Image or an (H, W, C) array
+    if isinstance(image, np.ndarray):
+        return image.shape[1], image.shape[0]
+    return image.size
+
+# Image.MAX_IMAGE_PIXELS is process-wide: concurrent decoders share one lift of the limit
+_pixel_limit_lock = threading.Lock()
+_pixel_limit_users = 0
+_pixel_limit_saved = None
+
+@contextlib.contextmanager
+def _unlimited_pixels():
+    """
+    Lifts Pillow's decompression-bomb limit while gigapixel inputs are opened.
+
+    The first thread to enter saves the limit and the last one to leave restores it, so
+    overlapping calls from several decode workers can't leave the check disabled.
+    """
+    global _pixel_limit_users, _pixel_limit_saved
+    with _pixel_limit_lock:
+        if _pixel_limit_users == 0:
+            _pixel_limit_saved = Image.MAX_IMAGE_PIXELS
+            Image.MAX_IMAGE_PIXELS = None
+        _pixel_limit_users += 1
+    try:
+        yield
+    finally:
+        with _pixel_limit_lock:
+            _pixel_limit_users -= 1
+            if _pixel_limit_users == 0:
+                Image.MAX_IMAGE_PIXELS = _pixel_limit_saved
 
 def load_image(image_path):
     """
@@ -21,65 +119,221 @@ def load_image(image_path):
         print(f"Error loading image {image_path}: {e}")
         return None
 
+def get_image_pixel_count(image_path):
+    """
+    Reads the pixel count of an image file from its header, without decoding it.
+
+    Args:
+        image_path (str): The path to the image file.
+
+    Returns:
+        int: width * height, or None if the file can't be opened.
+    """
+    try:
+        # Gigapixel inputs are expected here, so don't let Pillow refuse them as decompression bombs
+        with _unlimited_pixels(), Image.open(image_path) as img:
+            width, height = img.size
+        return width * height
+    except Exception as e:
+        print(f"Error reading image header {image_path}: {e}")
+        return None
+
+def _raw_cache_path(image_path, cache_dir):
+    # The cache file is tied to the exact source file version (path, size and mtime)
+    stat = os.stat(image_path)
+    source_id = f"{os.path.abspath(image_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    name = hashlib.sha256(source_id.encode('utf-8')).hexdigest()[:32]
+    return os.path.join(cache_dir, f"{name}.npy")
+
+def trim_tile_cache(cache_dir, max_bytes, keep=None):
+    """
+    Deletes the least recently used raw files in a tile cache until it fits in `max_bytes`.
+
+    Files that are still mapped stay readable until they are closed (POSIX), so a running job is
+    not affected; the next job that needs a deleted file decodes it again.
+
+    Args:
+        cache_dir (str): The tile cache directory.
+        max_bytes (int | None): Size limit of the cache; None disables the limit.
+        keep (str, optional): A file that must not be deleted (the one just written).
+
+    Returns:
+        int: The number of files deleted.
+    """
+    if max_bytes is None:
+        return 0
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.npy') and entry.is_file():
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if keep is not None and os.path.abspath(path) == os.path.abspath(keep):
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue # Removed by another process in the meantime
+        total -= size
+        removed += 1
+    return removed
+
+def load_image_memmap(image_path, cache_dir, strip_height=256, max_cache_bytes=None):
+    """
+    Loads an image as a read-only memory-mapped (H, W, 3) uint8 RGB array.
+
+    The first call decodes the file once into a raw `.npy` file under `cache_dir`, writing
+    it strip by strip; later calls just map that file. Reading a region (e.g. through a
+    `Patch`) then only pages in the rows it covers, so images larger than RAM can be
+    processed with memory bounded by the patch size. `.npy` inputs are mapped directly.
+
+    Args:
+        image_path (str): The path to the image file.
+        cache_dir (str): Directory for the decoded raw RGB files.
+        strip_height (int): Number of rows converted and written per step during the decode.
+        max_cache_bytes (int, optional): After a new decode, the least recently used raw files are
+            deleted until `cache_dir` fits in this size (see `trim_tile_cache`).
+
+    Returns:
+        numpy.memmap: The image pixels, or None if an error occurs.
+    """
+    try:
+        if image_path.lower().endswith('.npy'):
+            return np.load(image_path, mmap_mode='r')
+
+        raw_path = _raw_cache_path(image_path, cache_dir)
+        if os.path.exists(raw_path):
+            # Mark the file as recently used so trim_tile_cache keeps it
+            os.utime(raw_path)
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{raw_path}.{os.getpid()}.tmp"
+            try:
+                with _unlimited_pixels(), Image.open(image_path) as img:
+                    width, height = img.size
+                    raw = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(height, width, 3))
+                    # Convert to RGB strip by strip so we never hold a second full-size copy
+                    for upper in range(0, height, strip_height):
+                        lower = min(height, upper + strip_height)
+                        raw[upper:lower] = np.asarray(img.crop((0, upper, width, lower)).convert('RGB'))
+                    raw.flush()
+                    del raw
+                os.replace(tmp_path, raw_path)
+            finally:
+                # A failed decode leaves a partial file behind
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            trim_tile_cache(cache_dir, max_cache_bytes, keep=raw_path)
+
+        return np.load(raw_path, mmap_mode='r')
+    except FileNotFoundError:
+        print(f"Error: Image file not found at {image_path}")
+        return None
+    except Exception as e:
+        print(f"Error memory-mapping image {image_path}: {e}")
+        return None
+
+def make_preview(image, max_edge):
+    """
+    Builds a downscaled Pillow copy of an image for drawing results.
+
+    Array sources are subsampled with a stride, so only the sampled rows are read.
+
+    Args:
+        image (PIL.Image.Image | numpy.ndarray): The full image.
+        max_edge (int): Maximum width or height of the preview.
+
+    Returns:
+        tuple: (PIL.Image.Image preview, float scale) where preview = original * scale.
+    """
+    width, height = _source_size(image)
+    step = max(1, -(-max(width, height) // max_edge)) # ceil division
+    if isinstance(image, np.ndarray):
+        preview = Image.fromarray(np.ascontiguousarray(image[::step, ::step]))
+    elif step > 1:
+        preview = image.resize((-(-width // step), -(-height // step)))
+    else:
+        preview = image.copy()
+    return preview, preview.size[0] / width
+
 def partition_image(image, num_rows, num_cols):
     """
-    Partitions the given image into a grid of patches.
+    Partitions the given image into a grid of lazy patches.
+
+    No pixels are copied here; each patch crops its region from `image` only when its
+    pixels are requested.
 
     Args:
-        image (PIL.Image.Image): The Pillow Image object to partition.
+        image (PIL.Image.Image | numpy.ndarray): The image to partition.
         num_rows (int): The number of rows in the grid.
         num_cols (int): The number of columns in the grid.
 
     Returns:
-        list: A list of dictionaries, where each dictionary contains:
-              'patch_image' (PIL.Image.Image): The patch image object.
-              'coords' (tuple): A tuple (left, upper, right, lower) representing the
-                                coordinates of the patch in the original image.
+        list[Patch]: One patch per grid cell, in row-major order. `patch.coords` is a tuple
+                     (left, upper, right, lower) representing the coordinates of the patch
+                     in the original image, and `patch.image` materializes its pixels.
+    """
+    img_width, img_height = _source_size(image)
+    return [Patch(image, coords) for coords in partition_box((0, 0, img_width, img_height), num_rows, num_cols)]
+
+def partition_box(box, num_rows, num_cols):
     """
-    img_width, img_height = image.size
-    patch_width = img_width // num_cols
-    patch_height = img_height // num_rows
-    patches = []
+    Splits a box into a grid of sub-boxes.
+
+    Args:
+        box (tuple): (left, upper, right, lower) of the region to split.
+        num_rows (int): The number of rows in the grid.
+        num_cols (int): The number of columns in the grid.
+
+    Returns:
+        list[tuple]: The (left, upper, right, lower) of every cell, in row-major order. The last
+                     row and column absorb the remainder so the cells cover the whole box.
+    """
+    box_left, box_upper, box_right, box_lower = box
+    patch_width = (box_right - box_left) // num_cols
+    patch_height = (box_lower - box_upper) // num_rows
+    boxes = []
 
     for i in range(num_rows):
         for j in range(num_cols):
-            left = j * patch_width
-            upper = i * patch_height
-            # For the last column, extend to the image width
-            right = (j + 1) * patch_width if j < num_cols - 1 else img_width
-            # For the last row, extend to the image height
-            lower = (i + 1) * patch_height if i < num_rows - 1 else img_height
-            
-            patch_image = image.crop((left, upper, right, lower))
-            patches.append({'patch_image': patch_image, 'coords': (left, upper, right, lower)})
-            
-    return patches
+            left = box_left + j * patch_width
+            upper = box_upper + i * patch_height
+            # For the last column, extend to the box width
+            right = box_left + (j + 1) * patch_width if j < num_cols - 1 else box_right
+            # For the last row, extend to the box height
+            lower = box_upper + (i + 1) * patch_height if i < num_rows - 1 else box_lower
+            boxes.append((left, upper, right, lower))
+
+    return boxes
 
 def get_image_size(image):
     """
     Gets the dimensions of the given Pillow Image object.
 
     Args:
-        image (PIL.Image.Image): The Pillow Image object.
+        image (PIL.Image.Image | numpy.ndarray): The Pillow Image object or (H, W, C) array.
 
     Returns:
         tuple: A tuple (width, height) representing the image dimensions.
     """
-    return image.size
+    return _source_size(image)
 
-def get_contextual_patch(original_image, patch_coords, expansion_factor):
+def get_contextual_coords(original_image, patch_coords, expansion_factor):
     """
-    Extracts a contextual patch from the original image, expanding from a given patch's coordinates.
+    Computes the box of a contextual patch, expanding from a given patch's coordinates.
 
     Args:
-        original_image (PIL.Image.Image): The Pillow Image object of the full image.
+        original_image (PIL.Image.Image | numpy.ndarray): The full image, used for its size.
         patch_coords (tuple): A tuple (left, upper, right, lower) defining the box of the original patch.
         expansion_factor (float): Factor to expand the patch (e.g., 1.5 for 50% expansion).
 
     Returns:
-        tuple: A tuple containing:
-               - PIL.Image.Image: The cropped contextual patch.
-               - tuple: The new coordinates (left, upper, right, lower) of the contextual patch.
+        tuple: The new coordinates (left, upper, right, lower) of the contextual patch,
+               clipped to the image boundaries.
     """
     original_left, original_upper, original_right, original_lower = patch_coords
     patch_width = original_right - original_left
@@ -97,7 +351,7 @@ def get_contextual_patch(original_image, patch_coords, expansion_factor):
     new_lower = center_y + new_height / 2
 
     # Clip coordinates to image boundaries
-    img_width, img_height = original_image.size
+    img_width, img_height = _source_size(original_image)
     new_left_clipped = max(0, int(new_left))
     new_upper_clipped = max(0, int(new_upper))
     new_right_clipped = min(img_width, int(new_right))
@@ -123,8 +377,23 @@ def get_contextual_patch(original_image, patch_coords, expansion_factor):
                 new_lower_clipped = img_height
                 new_upper_clipped = img_height -1 if img_height > 0 else 0
 
+    return (new_left_clipped, new_upper_clipped, new_right_clipped, new_lower_clipped)
+
+def get_contextual_patch(original_image, patch_coords, expansion_factor):
+    """
+    Extracts a contextual patch from the original image, expanding from a given patch's coordinates.
+
+    Args:
+        original_image (PIL.Image.Image): The Pillow Image object of the full image.
+        patch_coords (tuple): A tuple (left, upper, right, lower) defining the box of the original patch.
+        expansion_factor (float): Factor to expand the patch (e.g., 1.5 for 50% expansion).
 
-    contextual_patch_img = original_image.crop((new_left_clipped, new_upper_clipped, new_right_clipped, new_lower_clipped))
-    final_coords = (new_left_clipped, new_upper_clipped, new_right_clipped, new_lower_clipped)
+    Returns:
+        tuple: A tuple containing:
+               - PIL.Image.Image: The cropped contextual patch.
+               - tuple: The new coordinates (left, upper, right, lower) of the contextual patch.
+    """
+    final_coords = get_contextual_coords(original_image, patch_coords, expansion_factor)
+    contextual_patch_img = Patch(original_image, final_coords).image
 
     return contextual_patch_img, final_coords
@@ -0,0 +1,279 @@
+import contextvars
+import math
+import os
+import re
+import threading
+import time
+from collections import deque
+from . import config
+
+# Timers and counters do nothing until `enable()` is called (or INSTRUMENTATION_ENABLED is set),
+# so the calls left in the hot paths cost one flag check when instrumentation is off.
+_enabled = config.INSTRUMENTATION_ENABLED
+
+_histograms = {}
+_counters = {}
+_lock = threading.Lock()
+
+# The trace of the image being processed by the current thread (or task), if any
+_current_trace = contextvars.ContextVar('trace', default=None)
+
+def enable(enabled: bool = True):
+    """
+    Turns timers and counters on or off for the whole process.
+
+    Args:
+        enabled (bool): Whether to record.
+    """
+    global _enabled
+    _enabled = enabled
+
+def enabled() -> bool:
+    return _enabled
+
+def percentile(values, fraction):
+    """
+    Computes a nearest-rank percentile; the one percentile definition used by every report.
+
+    Args:
+        values (iterable): The samples, in any order.
+        fraction (float): The percentile as a fraction, e.g. 0.95.
+
+    Returns:
+        float: The percentile, or 0.0 for no samples.
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+class Histogram:
+    """
+    Latency samples of one timer.
+
+    The count, sum and maximum are exact; percentiles are computed over the most recent
+    `max_samples` samples so a long run doesn't grow without bound.
+    """
+
+    def __init__(self, max_samples: int = None):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._samples = deque(maxlen=max_samples or config.INSTRUMENTATION_MAX_SAMPLES)
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        self._samples.append(seconds)
+
+    def summary(self) -> dict:
+        """
+        Returns:
+            dict: 'count', 'sum', 'mean', 'p50', 'p95', 'p99' and 'max', in seconds.
+        """
+        samples = sorted(self._samples)
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'p50': percentile(samples, 0.50),
+            'p95': percentile(samples, 0.95),
+            'p99': percentile(samples, 0.99),
+            'max': self.max,
+        }
+
+class Trace:
+    """
+    Timings and counters of one image, collected from every thread that worked on it.
+    """
+
+    def __init__(self, name: str):
+        """
+        Args:
+            name (str): What the trace is about, e.g. the image path.
+        """
+        self.name = name
+        self.started = time.time()
+        self.spans = {} # timer name -> list of durations
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, seconds: float):
+        with self._lock:
+            self.spans.setdefault(name, []).append(seconds)
+
+    def add_count(self, name: str, amount: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def to_dict(self) -> dict:
+        """
+        Returns:
+            dict: The JSON-serializable trace: 'name', 'started' (Unix time), per-timer
+                  'spans' ({'count', 'total'} in seconds) and 'counters'.
+        """
+        with self._lock:
+            return {
+                'name': self.name,
+                'started': self.started,
+                'spans': {name: {'count': len(durations), 'total': sum(durations)} for name, durations in self.spans.items()},
+                'counters': dict(self.counters),
+            }
+
+class _NoopTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NOOP_TIMER = _NoopTimer()
+
+class _Timer:
+    __slots__ = ('name', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record(self.name, time.perf_counter() - self.started)
+        return False
+
+def timer(name: str):
+    """
+    Times a block of code into the histogram `name` and the current image trace.
+
+        with instrumentation.timer("detect.forward"):
+            outputs = model(**inputs)
+
+    Args:
+        name (str): The timer name, e.g. 'load' or 'agent.call'.
+
+    Returns:
+        A context manager; a shared no-op one when instrumentation is disabled.
+    """
+    if not _enabled:
+        return _NOOP_TIMER
+    return _Timer(name)
+
+def record(name: str, seconds: float):
+    """
+    Records a duration measured elsewhere, like a finished `timer` block.
+
+    Args:
+        name (str): The timer name.
+        seconds (float): The duration.
+    """
+    if not _enabled:
+        return
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.record(seconds)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_span(name, seconds)
+
+def count(name: str, amount: float = 1):
+    """
+    Adds to the counter `name` and to the current image trace's counter of the same name.
+
+    Args:
+        name (str): The counter name, e.g. 'decisions.SKIP' or 'agent.request_bytes'.
+        amount (float): How much to add.
+    """
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_count(name, amount)
+
+class tracing:
+    """
+    Context manager making `trace` the current trace of this thread (or task) for its duration.
+
+    Work handed to other threads keeps the trace when it is submitted through
+    `contextvars.copy_context().run`.
+    """
+
+    def __init__(self, trace: Trace):
+        self.trace = trace
+        self._token = None
+
+    def __enter__(self):
+        self._token = _current_trace.set(self.trace)
+        return self.trace
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_trace.reset(self._token)
+        return False
+
+def snapshot() -> dict:
+    """
+    Returns the process-wide timers and counters.
+
+    Returns:
+        dict: {'timers': {name: Histogram.summary()}, 'counters': {name: value}}.
+    """
+    with _lock:
+        return {
+            'timers': {name: histogram.summary() for name, histogram in sorted(_histograms.items())},
+            'counters': dict(sorted(_counters.items())),
+        }
+
+def reset():
+    """Clears every timer and counter."""
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+def _metric_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+def prometheus_text(prefix: str = "image_store") -> str:
+    """
+    Formats the timers and counters in the Prometheus text exposition format.
+
+    Timers become one summary (`<prefix>_stage_seconds{stage="..."}` with 0.5/0.95/0.99
+    quantiles, _sum and _count); counters become `<prefix>_<name>_total` counters.
+
+    Args:
+        prefix (str): Metric name prefix.
+
+    Returns:
+        str: The metrics text.
+    """
+    data = snapshot()
+    lines = [f"# HELP {prefix}_stage_seconds Time spent in each instrumented stage.",
+             f"# TYPE {prefix}_stage_seconds summary"]
+    for name, summary in data['timers'].items():
+        for quantile, key in (("0.5", 'p50'), ("0.95", 'p95'), ("0.99", 'p99')):
+            lines.append(f'{prefix}_stage_seconds{{stage="{name}",quantile="{quantile}"}} {summary[key]:.6f}')
+        lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {summary["sum"]:.6f}')
+        lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {summary["count"]}')
+    for name, value in data['counters'].items():
+        metric = f"{prefix}_{_metric_name(name)}_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {value}")
+    return "\n".join(lines) + "\n"
+
+def write_prometheus(path: str, prefix: str = "image_store"):
+    """
+    Writes `prometheus_text()` to a file, e.g. for the node exporter's textfile collector.
+
+    Args:
+        path (str): Output file; replaced atomically.
+        prefix (str): Metric name prefix.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(prometheus_text(prefix))
+    os.replace(tmp_path, path)
@@ -1,9 +1,703 @@
 from . import image_utils
 from . import vision_tool_interface
 from . import openrouter_agent
+from . import cache
 from . import config # For API key check and potentially other configs
-from PIL import ImageDraw, ImageFont # For drawing results later
+from . import pipeline
+from . import box_merge
+from . import scheduler
+from . import triage
+from . import instrumentation
+from PIL import Image, ImageDraw, ImageFont # For drawing results later
+import functools
+import json
 import os
+import re
+import numpy as np
+
+# Raw (H, W, 3) .npy arrays are accepted only as explicit paths, never picked up from a directory walk
+# (which would otherwise also find the raw tile cache under TILE_CACHE_DIR)
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+def build_agent_prompt(patch_coords, target_classes):
+    """
+    Builds the decision prompt sent to the LLM agent for one patch.
+
+    Args:
+        patch_coords (tuple): (left, upper, right, lower) of the patch in the original image.
+        target_classes (list[str]): The object classes we are looking for.
+
+    Returns:
+        str: The prompt text.
+    """
+    return (
+        f"You are an object detection assistant. This image patch is from coordinates {patch_coords} of a larger image. "
+        f"Your task is to identify if any of the following target objects might be present in THIS SPECIFIC PATCH: {', '.join(target_classes)}. "
+        f"Based on the visual information in this patch, do you think it's worth running a detailed object detection model on it? "
+        f"Respond with only one of these keywords: 'ANALYZE' if yes, 'SKIP' if no. "
+        f"If the patch is ambiguous (e.g., shows only a small part of a potential object, like a wheel of a car) such that the full object might be outside this patch but nearby, respond with 'EXPAND_CONTEXT'. "
+        f"Your response must be ONLY one of these three keywords."
+    )
+
+def extract_decision_keyword(agent_decision_text):
+    """
+    Finds the decision keyword in the agent's response, if there is a clear one.
+
+    Args:
+        agent_decision_text (str): The raw response returned by the agent.
+
+    Returns:
+        str | None: 'ANALYZE', 'EXPAND_CONTEXT' or 'SKIP', or None if the response is not a
+                    string or contains none of the keywords.
+    """
+    if not isinstance(agent_decision_text, str):
+        return None
+    cleaned_response = agent_decision_text.strip().upper()
+    if "ANALYZE" in cleaned_response:
+        return "ANALYZE"
+    elif "EXPAND_CONTEXT" in cleaned_response:
+        return "EXPAND_CONTEXT"
+    elif "SKIP" in cleaned_response:
+        return "SKIP"
+    return None
+
+def parse_agent_decision(agent_decision_text, patch_coords):
+    """
+    Sanitizes the agent's response and reduces it to one of the decision keywords.
+
+    Args:
+        agent_decision_text (str): The raw response returned by the agent.
+        patch_coords (tuple): The patch coordinates, used for log messages.
+
+    Returns:
+        str: 'ANALYZE', 'EXPAND_CONTEXT' or 'SKIP'.
+    """
+    decision = extract_decision_keyword(agent_decision_text)
+    if decision is not None:
+        return decision
+    if isinstance(agent_decision_text, str):
+        # Default to SKIP if no clear keyword found
+        print(f"  Patch {patch_coords}: Agent raw decision: '{agent_decision_text}'. Could not parse a clear keyword, defaulting to SKIP.")
+    else: # If the response isn't a string (e.g. error message from API)
+        print(f"  Patch {patch_coords}: Agent response was not a string: '{agent_decision_text}'. Defaulting to SKIP.")
+    return "SKIP"
+
+def build_batch_agent_prompt(patches_coords, target_classes):
+    """
+    Builds the prompt for deciding several patches in one request.
+
+    Args:
+        patches_coords (list[tuple]): (left, upper, right, lower) of each patch, in the order the
+                                      patch images are attached to the request.
+        target_classes (list[str]): The object classes we are looking for.
+
+    Returns:
+        str: The prompt text.
+    """
+    patch_lines = "\n".join(f"Patch {n}: coordinates {coords}" for n, coords in enumerate(patches_coords, start=1))
+    return (
+        f"You are an object detection assistant. You are given {len(patches_coords)} image patches of a larger image, "
+        f"attached in this order:\n{patch_lines}\n"
+        f"For EACH patch, decide whether any of the following target objects might be present in that specific patch: {', '.join(target_classes)}. "
+        f"Use 'ANALYZE' if it is worth running a detailed object detection model on the patch, 'SKIP' if not, "
+        f"and 'EXPAND_CONTEXT' if the patch is ambiguous (e.g., shows only a small part of a potential object, like a wheel of a car) "
+        f"such that the full object might be outside the patch but nearby. "
+        f"Respond with ONLY a JSON object mapping each patch number to one of these three keywords, "
+        f'for example {{"1": "ANALYZE", "2": "SKIP"}}.'
+    )
+
+def parse_batch_decisions(agent_response_text, count):
+    """
+    Parses the JSON object returned for a multi-patch request.
+
+    Args:
+        agent_response_text (str): The raw response returned by the agent.
+        count (int): Number of patches in the request.
+
+    Returns:
+        list: The decision of every patch (1-based numbering in the response), or None for a
+              patch whose decision is missing or unclear.
+    """
+    decisions = [None] * count
+    if not isinstance(agent_response_text, str):
+        return decisions
+    # Models often wrap JSON in a markdown code fence or add a sentence around it
+    match = re.search(r"\{.*\}", agent_response_text, re.DOTALL)
+    if not match:
+        return decisions
+    try:
+        parsed = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return decisions
+    if not isinstance(parsed, dict):
+        return decisions
+    for key, value in parsed.items():
+        try:
+            index = int(str(key).strip().lstrip('#').replace('Patch', '').strip()) - 1
+        except ValueError:
+            continue
+        if 0 <= index < count:
+            decisions[index] = extract_decision_keyword(value)
+    return decisions
+
+def run_detection_jobs(detection_jobs, target_classes, batch_size, detection_cache=None, image_key=None,
+                       threshold=vision_tool_interface.DETECTION_THRESHOLD, detection_pool=None):
+    """
+    Runs batched object detection on queued patches and maps the boxes to original image coordinates.
+
+    Args:
+        detection_jobs (list[image_utils.Patch]): Lazy patches to run detection on; they are
+                                                  only cropped here, one batch at a time.
+        target_classes (list[str]): The object classes to keep.
+        batch_size (int): Maximum number of patches per forward pass.
+        detection_cache (TieredCache, optional): Cache of raw detections to reuse across runs.
+        image_key (str, optional): Digest of the original image; with the patch coords it
+                                   identifies each region in the detection cache.
+        threshold (float): Minimum detection score.
+        detection_pool (DetectionPool, optional): Worker processes to run inference in. By default
+                                                  inference runs in the calling thread.
+
+    Returns:
+        tuple: (boxes, scores, labels, regions) arrays of all detections, with boxes ([x, y, w, h])
+               in original image coordinates (see box_merge.detections_to_arrays) and the
+               (left, upper, right, lower) of the patch each box was found in.
+    """
+    if not detection_jobs:
+        return (*box_merge.detections_to_arrays([]), np.zeros((0, 4)))
+
+    print(f"  Running object detection on {len(detection_jobs)} queued patches...")
+    region_keys = None
+    if detection_cache is not None and image_key is not None:
+        region_keys = [cache.region_key(image_key, job.coords) for job in detection_jobs]
+    batch_results = vision_tool_interface.detect_objects_batch(
+        detection_jobs, target_classes, batch_size=batch_size,
+        cache=detection_cache, region_keys=region_keys, threshold=threshold,
+        raw_detector=detection_pool.detect_raw_batch if detection_pool is not None else None
+    )
+    patch_arrays = []
+    regions = []
+    for job, detections in zip(detection_jobs, batch_results):
+        job_coords = job.coords
+        if detections:
+            print(f"    Found {len(detections)} objects in patch {job_coords}.")
+            # Convert patch-relative boxes [x_patch, y_patch, w, h] to original image coordinates
+            patch_arrays.append(box_merge.detections_to_arrays(detections, offset=job_coords[:2]))
+            regions.extend([job_coords] * len(detections))
+        else:
+            print(f"    No objects found in patch {job_coords} by vision tool.")
+    return (*box_merge.concatenate(patch_arrays), np.array(regions, dtype=np.float64).reshape(-1, 4))
+
+# Agent calls are network-bound and already concurrent within an image, detection is CPU-bound
+DEFAULT_STAGE_WORKERS = {'decode': 2, 'partition': 1, 'decide': 2, 'detect': 1, 'aggregate': 1, 'render': 2}
+
+class WorkflowSettings:
+    """
+    Parameters of the agentic detection workflow shared by every image of a run.
+    """
+
+    def __init__(self, target_classes=None, num_rows=3, num_cols=3, expansion_factor=1.5,
+                 detection_batch_size=vision_tool_interface.DEFAULT_BATCH_SIZE,
+                 detection_threshold=vision_tool_interface.DETECTION_THRESHOLD, output_dir="data",
+                 render=True, stage_workers=None, queue_size=4, detection_pool=None,
+                 merge_method="nms", merge_iou_threshold=0.5, merge_metric="iou",
+                 border_fusion=config.MERGE_BORDER_FUSION, border_tolerance=config.MERGE_BORDER_TOLERANCE,
+                 scheduler="grid", min_tile_size=512, max_depth=4,
+                 decision_batch_size=config.AGENT_DECISION_BATCH_SIZE, triage=config.TRIAGE_ENABLED,
+                 triage_detector=config.TRIAGE_USE_DETECTOR):
+        """
+        Args:
+            target_classes (list[str], optional): The object classes to look for.
+            num_rows (int): The number of rows in the patch grid.
+            num_cols (int): The number of columns in the patch grid.
+            expansion_factor (float): Expansion of EXPAND_CONTEXT patches (e.g., 1.5 for 50%).
+            detection_batch_size (int): Maximum number of patches per DETR forward pass.
+            detection_threshold (float): Minimum score of a detection.
+            output_dir (str): Where rendered images are saved.
+            render (bool): Whether to draw and save an output image per input image.
+            stage_workers (dict, optional): Worker threads per pipeline stage, overriding
+                                            DEFAULT_STAGE_WORKERS for the stages given.
+            queue_size (int): Capacity of the queues between pipeline stages.
+            detection_pool (DetectionPool, optional): Worker processes for DETR inference. Give
+                                                      the detect stage about as many workers so
+                                                      every process stays busy.
+            merge_method (str): How duplicate boxes from overlapping patches are merged: 'nms',
+                                'wbf' (weighted box fusion), or None to keep every box.
+            merge_iou_threshold (float): Overlap above which two same-class boxes are duplicates.
+            merge_metric (str): 'iou', or 'ios' (intersection over the smaller box) to also
+                                merge partial boxes cut at patch borders.
+            border_fusion (bool): Join the parts of objects cut by the shared edge of adjacent
+                                  patches (see box_merge.fuse_border_boxes).
+            border_tolerance (float): Pixels within which a box counts as reaching a patch edge.
+            scheduler (str): 'grid' asks the agent about every grid patch once; 'quadtree' treats
+                             the grid patches as root tiles and only splits the tiles the agent
+                             wants analyzed (see scheduler.schedule_quadtree).
+            min_tile_size (int): Smallest quadtree tile side, in pixels.
+            max_depth (int): Maximum number of quadtree splits below the root tiles.
+            decision_batch_size (int): Patches decided per agent request. Above 1, several patches
+                                       are sent in one request and the agent answers with JSON;
+                                       patches it doesn't answer clearly fall back to single calls.
+            triage (bool): Decide trivially empty patches locally from cheap image statistics
+                           instead of asking the agent (see triage.triage_patches).
+            triage_detector (bool): During triage, also run the detector at a low threshold on
+                                    small thumbnails and analyze patches with a likely target.
+        """
+        self.target_classes = target_classes or ["person", "car", "dog", "cat", "bicycle", "traffic light", "stop sign"]
+        self.num_rows = num_rows
+        self.num_cols = num_cols
+        self.expansion_factor = expansion_factor
+        self.detection_batch_size = detection_batch_size
+        self.detection_threshold = detection_threshold
+        self.output_dir = output_dir
+        self.render = render
+        self.stage_workers = dict(DEFAULT_STAGE_WORKERS, **(stage_workers or {}))
+        self.queue_size = queue_size
+        self.detection_pool = detection_pool
+        self.merge_method = merge_method
+        self.merge_iou_threshold = merge_iou_threshold
+        self.merge_metric = merge_metric
+        self.border_fusion = border_fusion
+        self.border_tolerance = border_tolerance
+        self.scheduler = scheduler
+        self.min_tile_size = min_tile_size
+        self.max_depth = max_depth
+        self.decision_batch_size = max(1, decision_batch_size)
+        self.triage = triage
+        self.triage_detector = triage_detector
+
+class ImageJob:
+    """
+    The state of one image as it moves through the workflow stages.
+    """
+
+    def __init__(self, image_path, settings):
+        self.image_path = image_path
+        self.settings = settings
+        self.name = os.path.basename(image_path)
+        self.image = None # PIL.Image.Image, or a memory-mapped array for very large inputs
+        self.image_key = None # file digest identifying the image in the detection (and, if memory-mapped, decision) cache
+        self.patches = []
+        self.decisions = {} # patch coords -> decision
+        self.agent_failures = 0 # patches decided by config.AGENT_FAILURE_DECISION because their agent request failed
+        self.detection_jobs = [] # lazy patches to run detection on
+        self.raw_detections = None # (boxes, scores, labels, regions) arrays of all patches, in image coordinates
+        self.detections = [] # final detections for the image
+        self.output_path = None
+        # Per-stage timings and counters of this image, when instrumentation is enabled
+        self.trace = instrumentation.Trace(image_path) if instrumentation.enabled() else None
+
+def decode_stage(job):
+    """
+    Loads the image of a job, memory-mapping it when it is very large.
+
+    Args:
+        job (ImageJob): The job to load.
+
+    Returns:
+        ImageJob: The same job with `image` (and `image_key` when detections are cached) set.
+    """
+    print(f"[{job.name}] Loading image: {job.image_path}")
+    is_raw = job.image_path.lower().endswith('.npy')
+    pixel_count = None if is_raw else image_utils.get_image_pixel_count(job.image_path)
+    if is_raw or (pixel_count is not None and pixel_count >= config.MEMMAP_MIN_PIXELS):
+        # Too large to decode into memory comfortably; patches read their regions from a memory-mapped copy
+        print(f"[{job.name}] Memory-mapping a raw RGB copy from {config.TILE_CACHE_DIR}")
+        with instrumentation.timer("load"):
+            job.image = image_utils.load_image_memmap(job.image_path, config.TILE_CACHE_DIR,
+                                                      max_cache_bytes=config.TILE_CACHE_MAX_BYTES)
+    else:
+        with instrumentation.timer("load"):
+            job.image = image_utils.load_image(job.image_path)
+    if job.image is None:
+        raise RuntimeError(f"Failed to load image: {job.image_path}")
+
+    # Memory-mapped images are too large to hash patch by patch, so decisions are keyed by region too
+    if config.DETECTION_CACHE_ENABLED or (config.DECISION_CACHE_ENABLED and isinstance(job.image, np.ndarray)):
+        job.image_key = cache.file_digest(job.image_path)
+    return job
+
+def partition_stage(job):
+    """
+    Splits the image of a job into a grid of lazy patches.
+
+    Args:
+        job (ImageJob): A decoded job.
+
+    Returns:
+        ImageJob: The same job with `patches` set.
+    """
+    settings = job.settings
+    with instrumentation.timer("partition"):
+        job.patches = image_utils.partition_image(job.image, settings.num_rows, settings.num_cols)
+    if not job.patches:
+        raise RuntimeError("Failed to partition image.")
+    print(f"[{job.name}] Image partitioned into {len(job.patches)} patches ({settings.num_rows}x{settings.num_cols}).")
+    return job
+
+def decide_patches(job, patches, failed=None):
+    """
+    Gets the agent's decision for a list of patches of a job.
+
+    Patches the local triage can decide from cheap image statistics never reach the agent;
+    other decisions are served from the decision cache where possible, and the remaining
+    patches are sent to OpenRouter concurrently.
+
+    Args:
+        job (ImageJob): The job the patches belong to.
+        patches (list[image_utils.Patch]): The patches to decide on.
+        failed (set, optional): Receives the indices of the patches whose agent request failed
+                                and that got config.AGENT_FAILURE_DECISION instead of an answer.
+
+    Returns:
+        list[str]: 'ANALYZE', 'EXPAND_CONTEXT' or 'SKIP' for every patch, in order.
+    """
+    settings = job.settings
+    agent_prompts = [build_agent_prompt(patch.coords, settings.target_classes) for patch in patches]
+    decisions = [None] * len(patches)
+
+    triaged = 0
+    if settings.triage:
+        with instrumentation.timer("triage"):
+            decisions = triage.triage_patches(
+                patches, settings.target_classes, objectness=settings.triage_detector,
+                raw_detector=settings.detection_pool.detect_raw_batch if settings.detection_pool is not None else None
+            )
+        triaged = len(patches) - decisions.count(None)
+        instrumentation.count("decisions.triaged", triaged)
+        if triaged:
+            print(f"[{job.name}] {triaged} of {len(patches)} patches decided by local triage without an agent call.")
+
+    # Serve decisions we've already paid for from the cache; only the misses go to OpenRouter
+    decision_cache = cache.get_decision_cache() if config.DECISION_CACHE_ENABLED else None
+    decision_keys = [None] * len(patches)
+    pending = [] # patch indices that still need an agent call
+    for i, patch in enumerate(patches):
+        if decisions[i] is not None:
+            continue
+        if decision_cache is not None:
+            if isinstance(job.image, np.ndarray) and job.image_key is not None:
+                decision_keys[i] = cache.decision_key(None, agent_prompts[i], region=cache.region_key(job.image_key, patch.coords))
+            else:
+                decision_keys[i] = cache.decision_key(patch.image, agent_prompts[i])
+            decisions[i] = decision_cache.get(decision_keys[i])
+            if decisions[i] is not None:
+                continue
+        pending.append(i)
+
+    cached = len(patches) - len(pending) - triaged
+    instrumentation.count("decision_cache.hits", cached)
+    if cached:
+        print(f"[{job.name}] {cached} of {len(patches)} patch decisions served from the decision cache.")
+
+    def give_up(i):
+        # Don't let a failed request pass for a SKIP; it is never cached, so the next run asks again
+        decisions[i] = config.AGENT_FAILURE_DECISION
+        job.agent_failures += 1
+        instrumentation.count("decisions.agent_failures")
+        if failed is not None:
+            failed.add(i)
+
+    def remember(i, result):
+        if not result.ok:
+            give_up(i)
+            print(f"[{job.name}] Patch {patches[i].coords}: agent request failed after {result.attempts} attempts "
+                  f"({result.error}). Using {decisions[i]}.")
+            return
+        decisions[i] = parse_agent_decision(result.text, patches[i].coords)
+        # Only cache clear answers; unparseable replies should be asked again next time
+        if decision_cache is not None and extract_decision_keyword(result.text) is not None:
+            decision_cache.put(decision_keys[i], decisions[i])
+
+    batch_size = settings.decision_batch_size
+    if batch_size > 1 and len(pending) > 1:
+        # Several patches per request; each request carries its patches as numbered images
+        groups = [pending[start:start + batch_size] for start in range(0, len(pending), batch_size)]
+        # A leftover single patch is asked with the regular single-patch prompt below
+        single = groups.pop() if len(groups[-1]) == 1 else []
+        print(f"[{job.name}] Sending {len(pending)} patches to OpenRouter agent in {len(groups)} multi-patch requests "
+              f"(model: {config.OPENROUTER_MULTIMODAL_MODEL})...")
+        batch_requests = [
+            (build_batch_agent_prompt([patches[i].coords for i in group], settings.target_classes), [patches[i] for i in group])
+            for group in groups
+        ]
+        unresolved = []
+        for g, result in openrouter_agent.iter_agent_responses(batch_requests):
+            group = groups[g]
+            if not result.ok:
+                # The request itself failed (and was already retried); asking each patch again would
+                # only multiply the failing calls
+                for i in group:
+                    give_up(i)
+                print(f"[{job.name}] Multi-patch request failed after {result.attempts} attempts ({result.error}). "
+                      f"Using {config.AGENT_FAILURE_DECISION} for its {len(group)} patches.")
+                continue
+            for i, decision in zip(group, parse_batch_decisions(result.text, len(group))):
+                if decision is None:
+                    unresolved.append(i)
+                    continue
+                decisions[i] = decision
+                if decision_cache is not None:
+                    decision_cache.put(decision_keys[i], decision)
+        if unresolved:
+            print(f"[{job.name}] {len(unresolved)} patches had no clear decision in the multi-patch replies; asking about them one by one.")
+        pending = sorted(unresolved + single)
+
+    if pending:
+        print(f"[{job.name}] Sending {len(pending)} patches to OpenRouter agent (model: {config.OPENROUTER_MULTIMODAL_MODEL})...")
+        # Patches are passed lazily; each one is cropped and encoded inside its request thread
+        agent_requests = [(agent_prompts[i], patches[i]) for i in pending]
+        for j, result in openrouter_agent.iter_agent_responses(agent_requests):
+            remember(pending[j], result)
+
+    for patch, decision in zip(patches, decisions):
+        print(f"[{job.name}] Patch {patch.coords}: Agent decision: {decision}")
+        instrumentation.count(f"decisions.{decision}")
+    return decisions
+
+def decide_stage(job):
+    """
+    Gets the agent's decisions for a job and queues the regions to analyze.
+
+    With the 'grid' scheduler every grid patch is decided once; with the 'quadtree'
+    scheduler the grid patches are the root tiles of a coarse-to-fine search.
+
+    Args:
+        job (ImageJob): A partitioned job.
+
+    Returns:
+        ImageJob: The same job with `decisions` and `detection_jobs` set.
+    """
+    settings = job.settings
+
+    if settings.scheduler == "quadtree":
+        def decide_level(patches):
+            failed = set()
+            return decide_patches(job, patches, failed=failed), failed
+
+        job.detection_jobs, job.decisions = scheduler.schedule_quadtree(
+            job.image, job.patches, decide_level,
+            min_tile_size=settings.min_tile_size, max_depth=settings.max_depth,
+            expansion_factor=settings.expansion_factor
+        )
+        print(f"[{job.name}] Quadtree search asked about {len(job.decisions)} tiles and queued {len(job.detection_jobs)} regions for detection.")
+        return job
+
+    decisions = decide_patches(job, job.patches)
+    for patch, decision in zip(job.patches, decisions):
+        patch_coords = patch.coords # (left, upper, right, lower) relative to original
+        job.decisions[patch_coords] = decision
+
+        if decision == "ANALYZE":
+            job.detection_jobs.append(patch)
+        elif decision == "EXPAND_CONTEXT":
+            contextual_coords = image_utils.get_contextual_coords(job.image, patch_coords, settings.expansion_factor)
+            print(f"[{job.name}]   Contextual patch coords (original image): {contextual_coords}")
+            job.detection_jobs.append(image_utils.Patch(job.image, contextual_coords))
+    return job
+
+def detect_stage(job):
+    """
+    Runs batched object detection on the patches the agent approved.
+
+    Args:
+        job (ImageJob): A job whose decisions are known.
+
+    Returns:
+        ImageJob: The same job with `raw_detections` set, in original image coordinates.
+    """
+    settings = job.settings
+    detection_cache = cache.get_detection_cache() if config.DETECTION_CACHE_ENABLED else None
+    job.raw_detections = run_detection_jobs(
+        job.detection_jobs, settings.target_classes, settings.detection_batch_size, detection_cache, job.image_key,
+        threshold=settings.detection_threshold, detection_pool=settings.detection_pool
+    )
+    return job
+
+def aggregate_stage(job):
+    """
+    Merges the per-patch detections of a job into the final list for the image.
+
+    Objects straddling patch borders, and objects inside an EXPAND_CONTEXT crop that overlaps
+    analyzed neighbours, are found more than once: the parts cut by a shared patch edge are
+    joined, then duplicates are merged in global coordinates.
+
+    Args:
+        job (ImageJob): A job with `raw_detections`.
+
+    Returns:
+        ImageJob: The same job with `detections` set.
+    """
+    settings = job.settings
+    if job.raw_detections is not None:
+        boxes, scores, labels, regions = job.raw_detections
+    else:
+        boxes, scores, labels = box_merge.detections_to_arrays([])
+        regions = None
+    found = len(scores)
+    if settings.merge_method:
+        with instrumentation.timer("merge"):
+            boxes, scores, labels = box_merge.merge_boxes(
+                boxes, scores, labels, iou_threshold=settings.merge_iou_threshold,
+                method=settings.merge_method, metric=settings.merge_metric,
+                regions=regions if settings.border_fusion else None, image=job.image,
+                border_tolerance=settings.border_tolerance
+            )
+    job.detections = box_merge.arrays_to_detections(boxes, scores, labels)
+    job.raw_detections = None
+    print(f"[{job.name}] Total objects detected in the image: {len(job.detections)} ({found} before merging duplicates)")
+    return job
+
+def draw_detections(image, detections, scale=1.0):
+    """
+    Draws detection boxes and labels on an image in place.
+
+    Args:
+        image (PIL.Image.Image): The image to draw on.
+        detections (list): Detections with 'box' ([x, y, w, h] in original image coordinates),
+                           'label' and 'score'.
+        scale (float): Size of `image` relative to the original image (e.g. for a preview).
+    """
+    draw = ImageDraw.Draw(image)
+    try:
+        font = ImageFont.load_default()
+    except IOError:
+        print("Default font not found. Using a fallback.")
+        font = None # Or specify a path to a known font if available
+
+    for det in detections:
+        box = [c * scale for c in det['box']]  # Original image coordinates [x, y, w, h], scaled to the drawn image
+        label = f"{det['label']}: {det['score']:.2f}"
+
+        # Define rectangle for drawing [left, top, right, bottom]
+        rect = [box[0], box[1], box[0] + box[2], box[1] + box[3]]
+        draw.rectangle(rect, outline="red", width=3)
+
+        # Adjust text position if it goes off-image (simple adjustment)
+        text_x = box[0]
+        text_y = box[1] - 15 if box[1] - 15 > 0 else box[1] + 5 # move above, or below if too close to top
+
+        draw.text((text_x, text_y), label, fill="red", font=font)
+
+def render_stage(job):
+    """
+    Draws the detections of a job on the image and saves it as `output_<name>`.
+
+    Args:
+        job (ImageJob): An aggregated job.
+
+    Returns:
+        ImageJob: The same job with `output_path` set if an image was saved. The decoded
+                  image is released afterwards.
+    """
+    settings = job.settings
+    if settings.render and job.detections:
+        with instrumentation.timer("draw"):
+            if isinstance(job.image, Image.Image):
+                draw_image, scale = job.image.copy(), 1.0
+            else:
+                # Memory-mapped inputs are drawn on a downscaled preview instead of a full-size copy
+                draw_image, scale = image_utils.make_preview(job.image, config.PREVIEW_MAX_EDGE)
+            draw_detections(draw_image, job.detections, scale)
+
+        base_name = os.path.splitext(job.name)[0] + ".png" if job.name.lower().endswith('.npy') else job.name
+        output_path = os.path.join(settings.output_dir, "output_" + base_name)
+        try:
+            os.makedirs(settings.output_dir, exist_ok=True)
+            with instrumentation.timer("save"):
+                draw_image.save(output_path)
+            job.output_path = output_path
+            print(f"[{job.name}] Processed image with detections saved to: {output_path}")
+        except Exception as e:
+            print(f"[{job.name}] Error saving image: {e}")
+
+    # Nothing downstream needs the pixels; drop them so finished jobs don't pin image memory
+    job.image = None
+    job.patches = []
+    job.detection_jobs = []
+    return job
+
+def iter_image_paths(source):
+    """
+    Expands a workflow input into image paths.
+
+    Args:
+        source (str | iterable): An image file (including a raw .npy array), a directory
+                                 (searched recursively for IMAGE_EXTENSIONS files), or any
+                                 iterable of image paths.
+
+    Yields:
+        str: Image paths, lazily.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        if os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                for file_name in sorted(files):
+                    if file_name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield os.path.join(root, file_name)
+        else:
+            yield os.fspath(source)
+    else:
+        yield from source
+
+def traced_stage(name, stage_fn):
+    """
+    Wraps a stage function so the work it does is recorded in the job's trace.
+
+    Args:
+        name (str): The stage name; its total time is recorded as the 'stage.<name>' timer.
+        stage_fn (callable): The stage function, taking and returning an ImageJob.
+
+    Returns:
+        callable: The wrapped stage function (a plain call when the job has no trace).
+    """
+    @functools.wraps(stage_fn)
+    def run(job):
+        if job.trace is None:
+            return stage_fn(job)
+        with instrumentation.tracing(job.trace), instrumentation.timer(f"stage.{name}"):
+            return stage_fn(job)
+    return run
+
+def build_pipeline(settings):
+    """
+    Builds the decode -> partition -> decide -> detect -> aggregate -> render pipeline.
+
+    Args:
+        settings (WorkflowSettings): Workflow parameters, including the workers per stage.
+
+    Returns:
+        pipeline.Pipeline: A pipeline that takes ImageJob items.
+    """
+    workers = settings.stage_workers
+    stages = [
+        pipeline.Stage('decode', traced_stage('decode', decode_stage), workers['decode']),
+        pipeline.Stage('partition', traced_stage('partition', partition_stage), workers['partition']),
+        pipeline.Stage('decide', traced_stage('decide', decide_stage), workers['decide']),
+        pipeline.Stage('detect', traced_stage('detect', detect_stage), workers['detect']),
+        pipeline.Stage('aggregate', traced_stage('aggregate', aggregate_stage), workers['aggregate']),
+        pipeline.Stage('render', traced_stage('render', render_stage), workers['render']),
+    ]
+    return pipeline.Pipeline(stages, queue_size=settings.queue_size)
+
+def process_images(source, settings=None):
+    """
+    Runs the agentic detection workflow over many images as a streaming pipeline.
+
+    Images flow through decode, partition, decide, detect, aggregate and render stages,
+    each with its own worker threads and bounded queues in between, so agent calls for one
+    image overlap with detection on another and with decoding the next.
+
+    Args:
+        source (str | iterable): An image file, a directory, or an iterable of image paths.
+        settings (WorkflowSettings, optional): Workflow parameters. Defaults to WorkflowSettings().
+
+    Yields:
+        ImageJob | pipeline.StageFailure: Each image as soon as it completes (not necessarily in
+                                          input order), or a failure naming the stage that raised.
+    """
+    settings = settings or WorkflowSettings()
+    jobs = (ImageJob(path, settings) for path in iter_image_paths(source))
+    yield from build_pipeline(settings).run(jobs)
 
 def main():
     # 1. Initial Setup
@@ -21,102 +715,22 @@ def main():
             print("Error: data/ directory does not exist.")
         return
 
-    target_classes = ["person", "car", "dog", "cat", "bicycle", "traffic light", "stop sign"] # Expanded example
-    num_rows = 3
-    num_cols = 3
-    expansion_factor = 1.5
-
-    # 2. Load and Partition Image
-    print(f"Loading image: {input_image_path}")
-    original_image = image_utils.load_image(input_image_path)
-    if original_image is None:
-        print(f"Failed to load image: {input_image_path}")
-        return
-    
-    print(f"Partitioning image into {num_rows}x{num_cols} patches...")
-    patches_info = image_utils.partition_image(original_image, num_rows, num_cols)
-    if not patches_info:
-        print("Failed to partition image.")
-        return
-    print(f"Image partitioned into {len(patches_info)} patches.")
-
-    # 3. Main Loop through Patches
-    all_detections = [] # To store detections from all patches, relative to original image
-
-    for i, patch_info in enumerate(patches_info):
-        patch_image = patch_info['patch_image']
-        patch_coords = patch_info['coords'] # (left, upper, right, lower) relative to original
-        
-        print(f"\nProcessing Patch {i+1}/{len(patches_info)} - Coords: {patch_coords}")
-
-        # Construct initial prompt for the LLM agent
-        prompt = (
-            f"You are an object detection assistant. This image patch is from coordinates {patch_coords} of a larger image. "
-            f"Your task is to identify if any of the following target objects might be present in THIS SPECIFIC PATCH: {', '.join(target_classes)}. "
-            f"Based on the visual information in this patch, do you think it's worth running a detailed object detection model on it? "
-            f"Respond with only one of these keywords: 'ANALYZE' if yes, 'SKIP' if no. "
-            f"If the patch is ambiguous (e.g., shows only a small part of a potential object, like a wheel of a car) such that the full object might be outside this patch but nearby, respond with 'EXPAND_CONTEXT'. "
-            f"Your response must be ONLY one of these three keywords."
-        )
-
-        # Call the OpenRouter agent
-        print(f"  Sending patch to OpenRouter agent (model: {config.OPENROUTER_MULTIMODAL_MODEL})...")
-        agent_decision_text = openrouter_agent.get_agent_response(prompt, image=patch_image)
-        
-        # Sanitize and simplify the agent's response to one of the keywords
-        if isinstance(agent_decision_text, str):
-            cleaned_response = agent_decision_text.strip().upper()
-            if "ANALYZE" in cleaned_response:
-                decision = "ANALYZE"
-            elif "EXPAND_CONTEXT" in cleaned_response:
-                decision = "EXPAND_CONTEXT"
-            elif "SKIP" in cleaned_response:
-                decision = "SKIP"
-            else:
-                decision = "SKIP" # Default to SKIP if no clear keyword found
-                print(f"  Patch {patch_coords}: Agent raw decision: '{agent_decision_text}'. Could not parse a clear keyword, defaulting to SKIP.")
-        else: # If the response isn't a string (e.g. error message from API)
-            decision = "SKIP"
-            print(f"  Patch {patch_coords}: Agent response was not a string: '{agent_decision_text}'. Defaulting to SKIP.")
+    settings = WorkflowSettings(
+        target_classes=["person", "car", "dog", "cat", "bicycle", "traffic light", "stop sign"], # Expanded example
+        num_rows=3,
+        num_cols=3,
+        expansion_factor=1.5,
+    )
 
-        print(f"  Patch {patch_coords}: Agent decision: {decision}")
-
-        if decision == "ANALYZE":
-            print(f"  Action: ANALYZE - Running object detection on current patch {patch_coords}...")
-            detections = vision_tool_interface.detect_objects(patch_image, target_classes)
-            if detections:
-                print(f"    Found {len(detections)} objects in patch {patch_coords}.")
-                for det in detections:
-                    # Convert patch-relative box [x_patch, y_patch, w, h] to original image coordinates
-                    det['box'][0] += patch_coords[0]  # x_orig = x_patch + patch_left
-                    det['box'][1] += patch_coords[1]  # y_orig = y_patch + patch_top
-                    all_detections.append(det)
-            else:
-                print(f"    No objects found in patch {patch_coords} by vision tool.")
+    # 2. Run the decode -> partition -> decide -> detect -> aggregate -> render pipeline
+    for result in process_images([input_image_path], settings):
+        if isinstance(result, pipeline.StageFailure):
+            print(f"Error: processing failed in the {result.stage} stage: {result.error}")
+            continue
+        if not result.detections:
+            print("\nNo objects were detected in the image after processing all patches.")
 
-        elif decision == "EXPAND_CONTEXT":
-            print(f"  Action: EXPAND_CONTEXT - Getting contextual patch and running object detection...")
-            contextual_patch_img, contextual_coords = image_utils.get_contextual_patch(original_image, patch_coords, expansion_factor)
-            print(f"    Contextual patch coords (original image): {contextual_coords}")
-            
-            detections = vision_tool_interface.detect_objects(contextual_patch_img, target_classes)
-            if detections:
-                print(f"    Found {len(detections)} objects in contextual patch {contextual_coords}.")
-                for det in detections:
-                    # Convert contextual-patch-relative box [x_context, y_context, w, h] to original image coordinates
-                    det['box'][0] += contextual_coords[0]  # x_orig = x_context + contextual_patch_left
-                    det['box'][1] += contextual_coords[1]  # y_orig = y_context + contextual_patch_top
-                    all_detections.append(det)
-            else:
-                print(f"    No objects found in contextual patch {contextual_coords} by vision tool.")
-                
-        elif decision == "SKIP":
-            print(f"  Action: SKIP - Skipping detailed analysis for patch {patch_coords} based on agent decision.")
-            pass
-    
-    print("\nFinished processing all patches.")
-
-    # 4. Summarization Step (Optional - keeping as placeholder for now)
+    # 3. Summarization Step (Optional - keeping as placeholder for now)
     # if all_detections:
     #     # This is where you could send `all_detections` (with global coordinates) to an LLM
     #     # to get a summary of the entire image's content.
@@ -126,47 +740,11 @@ def main():
     #     # final_summary = openrouter_agent.get_agent_response(summary_prompt) # No image needed for this call
     #     # print(f"\nOverall Image Summary:\n{final_summary}")
     #     pass
-    # else:
-    #     # print("\nNo objects detected in the image after processing all patches for summarization.")
-    #     pass
 
-    # 5. Display/Save Results
-    if all_detections:
-        print(f"\nTotal objects detected in the image: {len(all_detections)}")
-        draw_image = original_image.copy()
-        draw = ImageDraw.Draw(draw_image)
-        try:
-            font = ImageFont.load_default()
-        except IOError:
-            print("Default font not found. Using a fallback.")
-            font = None # Or specify a path to a known font if available
-
-        for det in all_detections:
-            box = det['box']  # These are now original image coordinates [x, y, w, h]
-            label = f"{det['label']}: {det['score']:.2f}"
-            
-            # Define rectangle for drawing [left, top, right, bottom]
-            rect = [box[0], box[1], box[0] + box[2], box[1] + box[3]]
-            draw.rectangle(rect, outline="red", width=3)
-            
-            # Adjust text position if it goes off-image (simple adjustment)
-            text_x = box[0]
-            text_y = box[1] - 15 if box[1] - 15 > 0 else box[1] + 5 # move above, or below if too close to top
-            
-            draw.text((text_x, text_y), label, fill="red", font=font)
-
-        base_name = os.path.basename(input_image_path)
-        output_image_path = os.path.join("data", "output_" + base_name)
-        
-        try:
-            draw_image.save(output_image_path)
-            print(f"Processed image with detections saved to: {output_image_path}")
-            # draw_image.show() # Optional: display the image
-        except Exception as e:
-            print(f"Error saving or showing image: {e}")
-            
-    else:
-        print("\nNo objects were detected in the image after processing all patches.")
+    if config.DECISION_CACHE_ENABLED:
+        print(f"Decision cache stats: {cache.get_decision_cache().stats()}")
+    if config.DETECTION_CACHE_ENABLED:
+        print(f"Detection cache stats: {cache.get_detection_cache().stats()}")
 
 if __name__ == "__main__":
     main()
@@ -3,68 +3,297 @@ import requests
 import json
 from PIL import Image
 import io
+import contextvars
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from PIL import features
+from requests.adapters import HTTPAdapter
+from . import cache
 from . import config # To access OPENROUTER_API_KEY and model
+from . import image_utils
+from . import instrumentation
+from . import request_scheduler
 
-def _image_to_base64(image: Image.Image) -> str | None:
+OPENROUTER_CHAT_URL = config.OPENROUTER_CHAT_URL
+
+_session = None
+_session_lock = threading.Lock()
+# Process-wide limit of requests in flight, shared by every caller (pipeline workers, hedges, retries)
+_request_slots = None
+# Long-lived threads that run the requests of `iter_agent_responses`, so their encode buffers are reused
+_executor = None
+
+_call_stats = {'calls': 0, 'errors': 0, 'images': 0, 'image_bytes': 0, 'request_bytes': 0, 'encode_cache_hits': 0}
+_call_stats_lock = threading.Lock()
+
+# Recent encodings by patch region (or pixel digest) and encode settings, and one reusable buffer per thread
+_encoded_images = OrderedDict()
+_encoded_images_lock = threading.Lock()
+_encode_buffers = threading.local()
+
+def get_call_stats() -> dict:
+    """
+    Returns how many agent requests were sent by this process and what they carried.
+
+    Returns:
+        dict: 'calls' and 'errors' counts, the number of 'images' attached, their encoded
+              size in 'image_bytes', the total JSON body size in 'request_bytes', and how many
+              images were served from the encode cache ('encode_cache_hits').
     """
-    Converts a Pillow Image object to a base64 encoded string (JPEG format).
+    with _call_stats_lock:
+        return dict(_call_stats)
+
+def _count_call(failed: bool, request_bytes: int = 0):
+    with _call_stats_lock:
+        _call_stats['calls'] += 1
+        _call_stats['request_bytes'] += request_bytes
+        if failed:
+            _call_stats['errors'] += 1
+    instrumentation.count("agent.calls")
+    instrumentation.count("agent.request_bytes", request_bytes)
+    if failed:
+        instrumentation.count("agent.errors")
+
+def _count_image(encoded_size: int, cache_hit: bool):
+    with _call_stats_lock:
+        _call_stats['images'] += 1
+        _call_stats['image_bytes'] += encoded_size
+        if cache_hit:
+            _call_stats['encode_cache_hits'] += 1
+    instrumentation.count("agent.images")
+    instrumentation.count("agent.image_bytes", encoded_size)
+    if cache_hit:
+        instrumentation.count("agent.encode_cache_hits")
+
+def _get_session() -> requests.Session:
+    """
+    Returns the shared HTTP session, creating it on first use.
+
+    The session keeps connections to OpenRouter alive between calls, and its connection
+    pool is sized to the configured concurrency so parallel requests don't queue for a socket.
+
+    Returns:
+        requests.Session: The pooled session used for all agent calls.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, config.OPENROUTER_MAX_CONCURRENCY))
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+def _get_request_slots() -> threading.BoundedSemaphore:
+    """
+    Returns the semaphore that bounds the agent requests in flight across the whole process.
+
+    Every HTTP request holds one slot, whichever thread or image it belongs to, so at most
+    config.OPENROUTER_MAX_CONCURRENCY requests are open at once and the session's connection
+    pool (sized to match) never has to discard connections.
+
+    Returns:
+        threading.BoundedSemaphore: The shared semaphore, created on first use.
+    """
+    global _request_slots
+    if _request_slots is None:
+        with _session_lock:
+            if _request_slots is None:
+                _request_slots = threading.BoundedSemaphore(max(1, config.OPENROUTER_MAX_CONCURRENCY))
+    return _request_slots
+
+def _get_executor() -> ThreadPoolExecutor:
+    # One pool for every call, sized to the process-wide request limit; created on first use
+    global _executor
+    if _executor is None:
+        with _session_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=max(1, config.OPENROUTER_MAX_CONCURRENCY),
+                                               thread_name_prefix="openrouter")
+    return _executor
+
+def _encode_format(image_format: str) -> str:
+    image_format = (image_format or "JPEG").upper()
+    if image_format == "WEBP" and not features.check('webp'):
+        return "JPEG" # this Pillow build has no WebP encoder
+    return image_format
+
+def _scaled_image(image, max_edge: int = None) -> Image.Image:
+    """
+    Returns the pixels of an image or lazy patch with the longer side at most `max_edge`.
+
+    A patch of a Pillow source is resampled straight from its region of the source, so the
+    full-resolution crop is never materialized.
+
+    Args:
+        image (PIL.Image.Image | image_utils.Patch): The image to scale.
+        max_edge (int, optional): Maximum width and height; None keeps the full resolution.
+
+    Returns:
+        PIL.Image.Image: The (possibly) downscaled image. The input image is never modified.
+    """
+    width, height = image.size
+    if not max_edge or max(width, height) <= max_edge:
+        return image.image if isinstance(image, image_utils.Patch) else image
+
+    scale = max_edge / max(width, height)
+    new_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    if isinstance(image, image_utils.Patch):
+        if isinstance(image.source, Image.Image):
+            return image.source.resize(new_size, Image.LANCZOS, box=image.coords, reducing_gap=3.0)
+        image = image.image
+    return image.resize(new_size, Image.LANCZOS, reducing_gap=3.0)
+
+def _cached_encoding(key) -> str | None:
+    with _encoded_images_lock:
+        entry = _encoded_images.get(key)
+        if entry is None:
+            return None
+        source_ref, img_str = entry
+        if source_ref is not None and source_ref() is None:
+            del _encoded_images[key] # the source was freed and its id may have been reused
+            return None
+        _encoded_images.move_to_end(key)
+    _count_image(len(img_str), cache_hit=True)
+    return img_str
+
+def _image_to_base64(image, max_edge: int = None, quality: int = None, image_format: str = None) -> str | None:
+    """
+    Converts a Pillow Image object (or lazy patch) to a base64 encoded string.
+
+    The image is scaled down to `max_edge` and encoded with the configured format and
+    quality. Encodings are cached by source image and region for lazy patches (checked with a
+    weak reference, so a freed source never matches) and by a digest of the scaled pixels
+    otherwise, so a patch that is sent again (a retry, a fallback from a multi-patch request)
+    is neither re-scaled nor re-encoded, and each
+    thread reuses one encode buffer instead of allocating a new one per image.
 
     Args:
-        image (PIL.Image.Image): The Pillow Image object to convert.
+        image (PIL.Image.Image | image_utils.Patch): The image to convert.
+        max_edge (int, optional): Longest side sent. Defaults to config.AGENT_IMAGE_MAX_EDGE.
+        quality (int, optional): Encoder quality. Defaults to config.AGENT_IMAGE_QUALITY.
+        image_format (str, optional): "JPEG" or "WEBP". Defaults to config.AGENT_IMAGE_FORMAT;
+                                      falls back to JPEG when Pillow lacks WebP support.
 
     Returns:
         str | None: The base64 encoded string, or None if an error occurs.
     """
+    max_edge = config.AGENT_IMAGE_MAX_EDGE if max_edge is None else max_edge
+    quality = quality or config.AGENT_IMAGE_QUALITY
+    image_format = _encode_format(image_format or config.AGENT_IMAGE_FORMAT)
     try:
-        if image.mode == 'RGBA': # Convert RGBA to RGB to avoid issues with JPEG saving
-            image = image.convert('RGB')
-        buffered = io.BytesIO()
-        image.save(buffered, format="JPEG")
-        img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
+        source_ref = None
+        if isinstance(image, image_utils.Patch):
+            source_ref = weakref.ref(image.source)
+            key = ('patch', id(image.source), image.coords, max_edge, image_format, quality)
+            img_str = _cached_encoding(key)
+            if img_str is not None:
+                return img_str
+
+        with instrumentation.timer("encode.scale"):
+            image = _scaled_image(image, max_edge)
+            if image.mode != 'RGB': # JPEG has no alpha channel (and WebP doesn't need one here)
+                image = image.convert('RGB')
+
+        if source_ref is None:
+            key = ('pixels', cache.image_digest(image), image_format, quality)
+            img_str = _cached_encoding(key)
+            if img_str is not None:
+                return img_str
+
+        with instrumentation.timer("encode"):
+            buffered = getattr(_encode_buffers, 'buffer', None)
+            if buffered is None:
+                buffered = _encode_buffers.buffer = io.BytesIO()
+            buffered.seek(0)
+            buffered.truncate()
+            image.save(buffered, format=image_format, quality=quality)
+            with buffered.getbuffer() as encoded:
+                img_str = base64.b64encode(encoded).decode('utf-8')
+
+        if config.AGENT_IMAGE_CACHE_ENTRIES:
+            with _encoded_images_lock:
+                _encoded_images[key] = (source_ref, img_str)
+                while len(_encoded_images) > config.AGENT_IMAGE_CACHE_ENTRIES:
+                    _encoded_images.popitem(last=False)
+        _count_image(len(img_str), cache_hit=False)
         return img_str
     except Exception as e:
         print(f"Error converting image to base64: {e}")
         return None
 
-def get_agent_response(prompt: str, image: Image.Image = None) -> str:
+class AgentResult:
     """
-    Gets a response from the OpenRouter multimodal agent.
+    The outcome of an agent request: the response text, or a typed error.
+
+    Attributes:
+        text (str | None): The agent's response text when the request succeeded.
+        error (str | None): What went wrong when it failed.
+        status (int | None): HTTP status of the last attempt, if a response was received.
+        model (str | None): The model that produced the result (the fallback after a failover).
+        retryable (bool): Whether the failure is transient (429, 5xx, timeouts, connection errors).
+        failover (bool): Whether another model might succeed where this one failed.
+        retry_after (float | None): Seconds the server asked us to wait (Retry-After header).
+        attempts (int): HTTP requests made for this result, across retries and fallback models.
+        hedged (bool): Whether a duplicate request was sent because this one was slow.
+    """
+
+    def __init__(self, text=None, error=None, status=None, model=None, retryable=False, failover=True, retry_after=None):
+        self.text = text
+        self.error = error
+        self.status = status
+        self.model = model
+        self.retryable = retryable
+        self.failover = failover
+        self.retry_after = retry_after
+        self.attempts = 1
+        self.hedged = False
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and self.text is not None
+
+    def __str__(self):
+        return self.text if self.ok else f"Error: {self.error}"
+
+    def __repr__(self):
+        if self.ok:
+            return f"AgentResult(text={self.text!r}, model={self.model!r}, attempts={self.attempts})"
+        return f"AgentResult(error={self.error!r}, status={self.status}, model={self.model!r}, attempts={self.attempts})"
+
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def _retry_after_seconds(response) -> float | None:
+    value = response.headers.get("Retry-After") if response is not None else None
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except ValueError:
+        return None # an HTTP date; the exponential backoff applies instead
+
+def _send_request(model: str, messages_content: list) -> AgentResult:
+    """
+    Makes one HTTP request to OpenRouter and classifies the outcome.
 
     Args:
-        prompt (str): The text prompt to send to the agent.
-        image (PIL.Image.Image, optional): An optional Pillow Image object to send.
+        model (str): The model to ask.
+        messages_content (list): The content blocks of the user message.
 
     Returns:
-        str: The agent's text response, or an error message if an error occurs.
+        AgentResult: The response text, or the error with its HTTP status and whether it is retryable.
     """
-    if not config.OPENROUTER_API_KEY or config.OPENROUTER_API_KEY == "YOUR_OPENROUTER_API_KEY_HERE":
-        return "Error: OpenRouter API key not configured in src/config.py. Please set it to your actual key."
-
     headers = {
         "Authorization": f"Bearer {config.OPENROUTER_API_KEY}",
         "Content-Type": "application/json"
     }
-
-    messages_content = []
-
-    if image:
-        base64_image_string = _image_to_base64(image)
-        if base64_image_string:
-            messages_content.append({
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:image/jpeg;base64,{base64_image_string}"
-                }
-            })
-        else:
-            print("Warning: Image provided but conversion to base64 failed. Proceeding without image.")
-            # Optionally, return an error here instead of proceeding without image
-            # return "Error: Image conversion to base64 failed."
-    
-    messages_content.append({"type": "text", "text": prompt})
-
     data = {
-        "model": config.OPENROUTER_MULTIMODAL_MODEL,
+        "model": model,
         "messages": [
             {
                 "role": "user",
@@ -73,38 +302,215 @@ def get_agent_response(prompt: str, image: Image.Image = None) -> str:
         ]
     }
 
-    # If only text is present and the model expects a simple string for content
-    if not image and config.OPENROUTER_MULTIMODAL_MODEL in ["anthropic/claude-3-haiku", "google/gemini-flash-1.5"]: # Example check
-         # For some models, if no image, content might just be a string not a list
-         # However, the list format with a single text item usually works for most advanced models
-         pass # Keep as list of content blocks for consistency, it's generally supported.
-
+    body = json.dumps(data)
+    result = None
+    response = None
     try:
-        response = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers=headers,
-            data=json.dumps(data),
-            timeout=60  # Adding a timeout
-        )
+        # Waiting for a slot is not part of the call latency (it would skew the hedging p95)
+        with _get_request_slots(), instrumentation.timer("agent.call"):
+            response = _get_session().post(
+                OPENROUTER_CHAT_URL,
+                headers=headers,
+                data=body,
+                timeout=config.OPENROUTER_TIMEOUT_SECONDS
+            )
         response.raise_for_status()  # Raises an HTTPError for bad responses (4XX or 5XX)
-        
+
         response_json = response.json()
-        
+
         if response_json.get("choices") and len(response_json["choices"]) > 0:
             message = response_json["choices"][0].get("message", {})
             content = message.get("content")
             if content:
-                return content
+                result = AgentResult(text=content, status=response.status_code, model=model)
             else:
-                return f"Error: No content in agent's response. Full response: {response_json}"
+                result = AgentResult(error=f"No content in agent's response. Full response: {response_json}",
+                                     status=response.status_code, model=model, retryable=True)
         else:
-            return f"Error: Unexpected response format from OpenRouter. Full response: {response_json}"
+            # OpenRouter reports some upstream failures as an "error" object in a 200 response
+            error = response_json.get("error") if isinstance(response_json.get("error"), dict) else {}
+            code = error.get("code") if isinstance(error.get("code"), int) else None
+            result = AgentResult(error=f"Unexpected response format from OpenRouter. Full response: {response_json}",
+                                 status=code or response.status_code, model=model,
+                                 retryable=code is None or code in RETRYABLE_STATUS)
 
     except requests.exceptions.HTTPError as http_err:
-        return f"HTTP error occurred: {http_err}. Response: {response.text}"
+        status = response.status_code
+        result = AgentResult(error=f"HTTP error occurred: {http_err}. Response: {response.text}", status=status, model=model,
+                             retryable=status in RETRYABLE_STATUS or status >= 500,
+                             failover=status not in (401, 403), retry_after=_retry_after_seconds(response))
     except requests.exceptions.RequestException as req_err:
-        return f"Request error occurred: {req_err}"
+        # Timeouts and connection errors are transient
+        result = AgentResult(error=f"Request error occurred: {req_err}", model=model, retryable=True)
     except json.JSONDecodeError:
-        return f"Error decoding JSON response from OpenRouter. Response: {response.text if 'response' in locals() else 'No response object'}"
+        result = AgentResult(error=f"Error decoding JSON response from OpenRouter. Response: {response.text if response is not None else 'No response object'}",
+                             status=response.status_code if response is not None else None, model=model, retryable=True)
     except Exception as e:
-        return f"An unexpected error occurred: {e}"
+        result = AgentResult(error=f"An unexpected error occurred: {e}", model=model)
+    finally:
+        _count_call(failed=result is None or not result.ok, request_bytes=len(body))
+    return result
+
+def get_scheduler():
+    """
+    Returns the shared request scheduler, creating it from the OPENROUTER_* settings on first use.
+
+    Returns:
+        request_scheduler.RequestScheduler: The scheduler all agent requests go through; its
+                                            `stats()` report retries, hedges and failovers.
+    """
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = request_scheduler.RequestScheduler(
+                    _send_request,
+                    requests_per_minute=config.OPENROUTER_REQUESTS_PER_MINUTE,
+                    burst=config.OPENROUTER_RATE_BURST,
+                    max_retries=config.OPENROUTER_MAX_RETRIES,
+                    backoff_base=config.OPENROUTER_BACKOFF_BASE_SECONDS,
+                    backoff_max=config.OPENROUTER_BACKOFF_MAX_SECONDS,
+                    hedge=config.OPENROUTER_HEDGE_REQUESTS,
+                    hedge_min_delay=config.OPENROUTER_HEDGE_MIN_DELAY_SECONDS,
+                    max_workers=2 * max(1, config.OPENROUTER_MAX_CONCURRENCY),
+                )
+    return _scheduler
+
+def request_agent(prompt: str, image: Image.Image = None) -> AgentResult:
+    """
+    Asks the OpenRouter multimodal agent, with rate limiting, retries, hedging and failover.
+
+    Transient failures (429, 5xx, timeouts) are retried with exponential backoff and jitter;
+    when the primary model keeps failing, config.OPENROUTER_FALLBACK_MODEL is tried.
+
+    Args:
+        prompt (str): The text prompt to send to the agent.
+        image (PIL.Image.Image | image_utils.Patch | list, optional): An optional image, or a list
+              of images sent in order before the prompt. A lazy patch is only cropped here, so
+              concurrent callers hold only the crops of the requests in flight.
+
+    Returns:
+        AgentResult: The response text, or the typed error of the last attempt.
+    """
+    if not config.OPENROUTER_API_KEY or config.OPENROUTER_API_KEY == "YOUR_OPENROUTER_API_KEY_HERE":
+        return AgentResult(error="OpenRouter API key not configured in src/config.py. Please set it to your actual key.",
+                           model=config.OPENROUTER_MULTIMODAL_MODEL, failover=False)
+
+    messages_content = []
+
+    mime_type = f"image/{_encode_format(config.AGENT_IMAGE_FORMAT).lower()}"
+    images = image if isinstance(image, (list, tuple)) else [image] if image else []
+    for item in images:
+        # Lazy patches are scaled from their source region and encoded here, inside the request thread
+        base64_image_string = _image_to_base64(item)
+        if base64_image_string:
+            messages_content.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:{mime_type};base64,{base64_image_string}"
+                }
+            })
+        else:
+            print("Warning: Image provided but conversion to base64 failed. Proceeding without image.")
+            # Optionally, return an error here instead of proceeding without image
+            # return "Error: Image conversion to base64 failed."
+
+    messages_content.append({"type": "text", "text": prompt})
+
+    # If only text is present and the model expects a simple string for content
+    if not image and config.OPENROUTER_MULTIMODAL_MODEL in ["anthropic/claude-3-haiku", "google/gemini-flash-1.5"]: # Example check
+         # For some models, if no image, content might just be a string not a list
+         # However, the list format with a single text item usually works for most advanced models
+         pass # Keep as list of content blocks for consistency, it's generally supported.
+
+    models = [config.OPENROUTER_MULTIMODAL_MODEL]
+    if config.OPENROUTER_FALLBACK_MODEL and config.OPENROUTER_FALLBACK_MODEL != config.OPENROUTER_MULTIMODAL_MODEL:
+        models.append(config.OPENROUTER_FALLBACK_MODEL)
+    return get_scheduler().run(messages_content, models)
+
+def get_agent_response(prompt: str, image: Image.Image = None) -> str:
+    """
+    Gets a response from the OpenRouter multimodal agent.
+
+    Args:
+        prompt (str): The text prompt to send to the agent.
+        image (PIL.Image.Image | image_utils.Patch | list, optional): An optional image, or a list
+              of images sent in order before the prompt.
+
+    Returns:
+        str: The agent's text response, or an error message starting with "Error:" if the
+             request failed. Use `request_agent` to get a typed result instead.
+    """
+    return str(request_agent(prompt, image))
+
+
+def iter_agent_responses(prompts_and_images, max_concurrency: int = None):
+    """
+    Sends several agent requests concurrently and yields each result as soon as it arrives.
+
+    Requests run on a module-wide thread pool, so each thread's encode buffer is reused across
+    calls. Concurrent callers (e.g. several decide workers) share the process-wide limit of
+    config.OPENROUTER_MAX_CONCURRENCY requests in flight; `max_concurrency` can only lower it
+    for this call.
+
+    Args:
+        prompts_and_images (list): A list of (prompt, image) tuples; image may be None.
+        max_concurrency (int, optional): Maximum number of this call's requests in flight.
+                                         Defaults to config.OPENROUTER_MAX_CONCURRENCY.
+
+    Yields:
+        tuple: (index, result) pairs in completion order, where index is the position of the
+               request in `prompts_and_images` and result is the `AgentResult` of `request_agent`.
+    """
+    requests_list = list(prompts_and_images)
+    if not requests_list:
+        return
+
+    if max_concurrency is None:
+        max_concurrency = config.OPENROUTER_MAX_CONCURRENCY
+    max_concurrency = max(1, min(max_concurrency, len(requests_list)))
+
+    executor = _get_executor()
+    futures = {}
+    next_index = 0
+
+    def submit_next():
+        nonlocal next_index
+        prompt, image = requests_list[next_index]
+        # Each request runs in a copy of the caller's context, so its timings land in the caller's trace
+        futures[executor.submit(contextvars.copy_context().run, request_agent, prompt, image)] = next_index
+        next_index += 1
+
+    try:
+        # Keep at most max_concurrency of this call's requests queued or running
+        while next_index < min(max_concurrency, len(requests_list)):
+            submit_next()
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = futures.pop(future)
+                if next_index < len(requests_list):
+                    submit_next()
+                yield index, future.result()
+    finally:
+        # The caller stopped early: drop the requests that haven't started
+        for future in futures:
+            future.cancel()
+
+def get_agent_responses(prompts_and_images, max_concurrency: int = None) -> list[AgentResult]:
+    """
+    Sends several agent requests concurrently and waits for all of them.
+
+    Args:
+        prompts_and_images (list): A list of (prompt, image) tuples; image may be None.
+        max_concurrency (int, optional): Maximum number of requests in flight. Defaults to
+                                         config.OPENROUTER_MAX_CONCURRENCY.
+
+    Returns:
+        list[AgentResult]: The results in the same order as `prompts_and_images`.
+    """
+    requests_list = list(prompts_and_images)
+    responses = [None] * len(requests_list)
+    for index, response in iter_agent_responses(requests_list, max_concurrency):
+        responses[index] = response
+    return responses
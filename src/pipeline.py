@@ -0,0 +1,148 @@
+import queue
+import threading
+import time
+
+_END = object() # Marks the end of the input on a stage queue
+
+class Stage:
+    """
+    One step of a `Pipeline`: a function applied to every item by a pool of worker threads.
+    """
+
+    def __init__(self, name: str, fn, workers: int = 1):
+        """
+        Args:
+            name (str): Stage name, used in failures and logs.
+            fn (callable): Takes an item and returns the item to hand to the next stage.
+            workers (int): Number of threads running `fn` concurrently.
+        """
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+
+class StageFailure:
+    """
+    Emitted by a `Pipeline` in place of an item whose stage function raised.
+    """
+
+    def __init__(self, stage: str, item, error: Exception):
+        self.stage = stage
+        self.item = item
+        self.error = error
+
+    def __repr__(self):
+        return f"StageFailure(stage={self.stage!r}, error={self.error!r})"
+
+class Pipeline:
+    """
+    Runs items through a sequence of stages connected by bounded queues.
+
+    Every stage has its own worker threads, so a network-bound stage (agent calls) runs at
+    the same time as a CPU-bound one (detection) and as the decode of the next item. The
+    bounded queues apply backpressure: a fast stage blocks once `queue_size` items are
+    waiting for a slow one, keeping the number of items in flight (and their memory) bounded.
+    Items can finish out of input order when a stage has more than one worker. The wall
+    time each stage spent on each item is collected in `stage_seconds`.
+    """
+
+    def __init__(self, stages: list[Stage], queue_size: int = 4):
+        """
+        Args:
+            stages (list[Stage]): The stages, in processing order.
+            queue_size (int): Capacity of the queue in front of each stage and of the output queue.
+        """
+        self.stages = stages
+        self.queue_size = max(1, queue_size)
+        self.stage_seconds = {stage.name: [] for stage in stages} # per-item wall time of every stage
+        self._stats_lock = threading.Lock()
+
+    def run(self, items):
+        """
+        Feeds `items` through all stages and yields results as they complete.
+
+        Args:
+            items (iterable): The input items; consumed lazily, so it can be a generator.
+
+        Yields:
+            The items returned by the last stage, or a `StageFailure` for each item whose
+            stage function raised. Closing the generator early stops all workers.
+        """
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+        stop = threading.Event()
+        threads = []
+
+        def put(q, item):
+            # Block while the queue is full, but give up promptly once the pipeline is stopped
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def get(q):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+            return _END
+
+        def feed():
+            try:
+                for item in items:
+                    if not put(queues[0], item):
+                        return
+            except Exception as e:
+                put(queues[-1], StageFailure("input", None, e))
+            for _ in range(self.stages[0].workers if self.stages else 1):
+                put(queues[0], _END)
+
+        def work(index, stage, remaining):
+            in_queue, out_queue = queues[index], queues[index + 1]
+            while True:
+                item = get(in_queue)
+                if item is _END:
+                    break
+                if isinstance(item, StageFailure):
+                    put(out_queue, item)
+                    continue
+                started = time.perf_counter()
+                try:
+                    result = stage.fn(item)
+                except Exception as e:
+                    result = StageFailure(stage.name, item, e)
+                with self._stats_lock:
+                    self.stage_seconds[stage.name].append(time.perf_counter() - started)
+                if not put(out_queue, result):
+                    return
+            # The last worker of a stage to finish passes the end marker on to every worker of the next stage
+            with remaining['lock']:
+                remaining['count'] -= 1
+                last = remaining['count'] == 0
+            if last:
+                next_workers = self.stages[index + 1].workers if index + 1 < len(self.stages) else 1
+                for _ in range(next_workers):
+                    put(out_queue, _END)
+
+        threads.append(threading.Thread(target=feed, name="pipeline-feed", daemon=True))
+        for index, stage in enumerate(self.stages):
+            remaining = {'count': stage.workers, 'lock': threading.Lock()}
+            for n in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=work, args=(index, stage, remaining), name=f"pipeline-{stage.name}-{n}", daemon=True
+                ))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                result = get(queues[-1])
+                if result is _END:
+                    break
+                yield result
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
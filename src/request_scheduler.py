@@ -0,0 +1,243 @@
+import contextvars
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from . import instrumentation
+
+class TokenBucket:
+    """
+    A thread-safe token bucket: `rate` tokens are added per second, up to `capacity`.
+
+    Every request takes one token, so requests are spread out to at most `rate` per second
+    on average while up to `capacity` of them may go out back to back.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        """
+        Args:
+            rate (float): Tokens added per second.
+            capacity (float): Maximum number of stored tokens (the burst size), at least 1.
+        """
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Takes one token, waiting until one is available.
+
+        Returns:
+            float: Seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return waited
+                delay = (1.0 - self._tokens) / self.rate
+            # Sleep outside the lock so other threads can check (and queue up) meanwhile
+            time.sleep(delay)
+            waited += delay
+
+class LatencyTracker:
+    """
+    Keeps the latencies of the most recent successful requests to estimate percentiles.
+    """
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        """
+        Args:
+            window (int): Number of recent latencies kept.
+            min_samples (int): Percentiles are unknown (None) until this many were recorded.
+        """
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float) -> float | None:
+        """
+        Args:
+            q (float): The percentile as a fraction, e.g. 0.95.
+
+        Returns:
+            float | None: The nearest-rank percentile of the recent latencies, or None if
+                          there are fewer than `min_samples` of them.
+        """
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            samples = list(self._samples)
+        return instrumentation.percentile(samples, q)
+
+def backoff_delay(attempt: int, base: float, maximum: float, retry_after: float = None) -> float:
+    """
+    Computes the wait before a retry: exponential backoff with full jitter.
+
+    Args:
+        attempt (int): Number of attempts made so far (1 for the first retry).
+        base (float): Backoff of the first retry, in seconds.
+        maximum (float): Cap of the exponential backoff, in seconds.
+        retry_after (float, optional): Server-requested wait (Retry-After), honoured as a minimum.
+
+    Returns:
+        float: Seconds to wait.
+    """
+    delay = random.uniform(0.0, min(maximum, base * (2 ** (attempt - 1))))
+    if retry_after:
+        delay = max(delay, retry_after)
+    return delay
+
+class RequestScheduler:
+    """
+    Sends requests through a transport function with per-model rate limits, retries,
+    optional hedging and failover to secondary models.
+
+    The transport is called as `send(model, payload)` and must return a result object with
+    `ok` and `retryable` attributes, an optional `retry_after` (seconds) and `failover`
+    (False for errors another model would hit too, such as a bad API key), and writable
+    `attempts` and `hedged` attributes, which the scheduler fills in.
+    """
+
+    def __init__(self, send, requests_per_minute: dict = None, burst: float = 1.0, max_retries: int = 3,
+                 backoff_base: float = 1.0, backoff_max: float = 30.0, hedge: bool = False,
+                 hedge_min_delay: float = 1.0, max_workers: int = 8):
+        """
+        Args:
+            send (callable): The transport, `send(model, payload) -> result`.
+            requests_per_minute (dict, optional): Rate limit per model id; models not listed
+                                                  are not limited.
+            burst (float): Requests per model that may go out back to back before the rate applies.
+            max_retries (int): Retries per model after the first attempt, for retryable failures.
+            backoff_base (float): Backoff of the first retry, in seconds.
+            backoff_max (float): Cap of the exponential backoff, in seconds.
+            hedge (bool): Send a duplicate of a request that has been running longer than the
+                          p95 latency of recent requests, and use whichever answers first.
+            hedge_min_delay (float): Never hedge earlier than this many seconds.
+            max_workers (int): Threads for hedged requests (about twice the request concurrency).
+        """
+        self.send = send
+        self.max_retries = max(0, max_retries)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.latencies = LatencyTracker()
+        self._buckets = {
+            model: TokenBucket(limit / 60.0, burst)
+            for model, limit in (requests_per_minute or {}).items() if limit
+        }
+        self._max_workers = max(2, max_workers)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._stats = {'retries': 0, 'hedges': 0, 'hedge_wins': 0, 'failovers': 0, 'throttled_seconds': 0.0}
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: Counts of 'retries', 'hedges' (duplicates sent), 'hedge_wins' (duplicates that
+                  answered first) and 'failovers', and the total 'throttled_seconds' spent
+                  waiting for the rate limit.
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def _send_limited(self, model, payload):
+        bucket = self._buckets.get(model)
+        if bucket is not None:
+            waited = bucket.acquire()
+            if waited:
+                self._count('throttled_seconds', waited)
+        started = time.perf_counter()
+        result = self.send(model, payload)
+        if result.ok:
+            self.latencies.record(time.perf_counter() - started)
+        return result
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="hedge")
+        return self._executor
+
+    def _attempt(self, model, payload):
+        """Makes one attempt, hedging it if it runs longer than the recent p95 latency."""
+        p95 = self.latencies.percentile(0.95) if self.hedge else None
+        if p95 is None:
+            return self._send_limited(model, payload)
+
+        executor = self._get_executor()
+        primary = executor.submit(contextvars.copy_context().run, self._send_limited, model, payload)
+        done, _ = wait([primary], timeout=max(p95, self.hedge_min_delay))
+        if done:
+            result = primary.result()
+            result.hedged = False
+            return result
+
+        self._count('hedges')
+        duplicate = executor.submit(contextvars.copy_context().run, self._send_limited, model, payload)
+        pending = {primary, duplicate}
+        result = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                if result.ok:
+                    # The slower request is left to finish on its own; its answer is ignored
+                    if future is duplicate:
+                        self._count('hedge_wins')
+                    result.hedged = True
+                    return result
+        result.hedged = True
+        return result
+
+    def run(self, payload, models):
+        """
+        Sends a request, retrying and failing over until it succeeds or every option is exhausted.
+
+        Args:
+            payload: Passed unchanged to `send` on every attempt.
+            models (list[str]): The primary model followed by fallback models, in order.
+
+        Returns:
+            The first successful result, or the last failed one. Its `attempts` attribute
+            counts every attempt across all models.
+        """
+        attempts = 0
+        result = None
+        for position, model in enumerate(models):
+            if position > 0:
+                self._count('failovers')
+            for retry in range(self.max_retries + 1):
+                if retry > 0:
+                    self._count('retries')
+                    time.sleep(backoff_delay(retry, self.backoff_base, self.backoff_max, getattr(result, 'retry_after', None)))
+                result = self._attempt(model, payload)
+                attempts += 1
+                if result.ok or not result.retryable:
+                    break
+            result.attempts = attempts
+            if result.ok or not getattr(result, 'failover', True):
+                return result
+        return result
+
+    def shutdown(self):
+        """Stops the hedging threads (running requests finish first)."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
@@ -0,0 +1,57 @@
+from . import image_utils
+
+def schedule_quadtree(image, root_patches, decide, min_tile_size=512, max_depth=4, expansion_factor=1.5):
+    """
+    Decides where to run detection by asking the agent coarse-to-fine about a quadtree of tiles.
+
+    The agent is first asked about the large root tiles. A SKIP prunes the whole tile; an
+    ANALYZE or EXPAND_CONTEXT on a tile that can still be split recurses into its four
+    quadrants, which are all asked about together at the next level. At the leaves
+    (quadrants would be smaller than `min_tile_size`, or `max_depth` is reached) ANALYZE
+    queues the tile itself for detection and EXPAND_CONTEXT queues the contextual region
+    from `image_utils.get_contextual_coords`. Empty regions are therefore decided with one
+    call at a coarse level instead of one call per fine patch. A tile whose agent request
+    failed is a leaf whatever its size: its fallback decision is applied to the whole tile,
+    so a failing agent costs one request per root tile rather than one per quadrant.
+
+    Args:
+        image (PIL.Image.Image | numpy.ndarray): The full image.
+        root_patches (list[image_utils.Patch]): The tiles of the first level.
+        decide (callable): Takes a list of patches and returns their decisions ('ANALYZE',
+                           'SKIP' or 'EXPAND_CONTEXT') in the same order, and the set of
+                           indices whose decision is a fallback for a failed agent request.
+                           Called once per level.
+        min_tile_size (int): Tiles are not split if a quadrant's shorter side would be below this.
+        max_depth (int): Maximum number of splits below the root tiles.
+        expansion_factor (float): Expansion of EXPAND_CONTEXT leaves (e.g., 1.5 for 50%).
+
+    Returns:
+        tuple: (detection_patches, decisions) where detection_patches is the list of lazy
+               patches to run detection on and decisions maps every asked tile's coords to
+               its decision.
+    """
+    detection_patches = []
+    decisions = {}
+    frontier = [(patch, 0) for patch in root_patches]
+
+    while frontier:
+        level_decisions, failed = decide([patch for patch, _ in frontier])
+        next_frontier = []
+        for index, ((patch, depth), decision) in enumerate(zip(frontier, level_decisions)):
+            decisions[patch.coords] = decision
+            if decision == "SKIP":
+                continue
+
+            splittable = (index not in failed and depth < max_depth
+                          and min(patch.width, patch.height) // 2 >= min_tile_size)
+            if splittable:
+                for coords in image_utils.partition_box(patch.coords, 2, 2):
+                    next_frontier.append((image_utils.Patch(image, coords), depth + 1))
+            elif decision == "EXPAND_CONTEXT":
+                contextual_coords = image_utils.get_contextual_coords(image, patch.coords, expansion_factor)
+                detection_patches.append(image_utils.Patch(image, contextual_coords))
+            else:
+                detection_patches.append(patch)
+        frontier = next_frontier
+
+    return detection_patches, decisions
@@ -0,0 +1,140 @@
+import threading
+import numpy as np
+from PIL import Image
+from . import config
+
+ENTROPY_BINS = 64 # histogram bins for the entropy statistic, so it ranges from 0 to 6 bits
+
+_stats = {'patches': 0, 'skipped': 0, 'analyzed': 0}
+_stats_lock = threading.Lock()
+
+def get_triage_stats() -> dict:
+    """
+    Returns how many patches the local triage looked at and how many agent calls it saved.
+
+    Returns:
+        dict: 'patches' seen, and how many were decided locally as 'skipped' or 'analyzed'.
+    """
+    with _stats_lock:
+        return dict(_stats)
+
+def _downsampled(patch, width, height, mode):
+    # Reads the patch region straight into a width x height thumbnail, without cropping it at full resolution
+    left, upper, right, lower = patch.coords
+    source = patch.source
+    if isinstance(source, np.ndarray):
+        # Stride over the (possibly memory-mapped) array so only the sampled rows are read
+        step = max(1, min((right - left) // (2 * width), (lower - upper) // (2 * height)))
+        region = np.ascontiguousarray(source[upper:lower:step, left:right:step])
+        return Image.fromarray(region).convert(mode).resize((width, height), Image.BILINEAR)
+    return source.resize((width, height), Image.BILINEAR, box=patch.coords, reducing_gap=2.0).convert(mode)
+
+def _downsampled_gray(patch, size):
+    # A size x size grayscale thumbnail of the patch, for the statistics
+    return np.asarray(_downsampled(patch, size, size, 'L'), dtype=np.float32)
+
+def _downsampled_rgb(patch, max_edge):
+    # An RGB thumbnail of the patch that keeps its aspect ratio, for the objectness check
+    scale = min(1.0, max_edge / max(patch.width, patch.height))
+    return _downsampled(patch, max(1, round(patch.width * scale)), max(1, round(patch.height * scale)), 'RGB')
+
+def patch_statistics(patches, size=None):
+    """
+    Computes cheap content statistics of many patches at once.
+
+    Every patch is reduced to a size x size grayscale thumbnail; the thumbnails are stacked
+    and all statistics are computed with vectorized NumPy operations over the stack.
+
+    Args:
+        patches (list[image_utils.Patch]): The patches to measure.
+        size (int, optional): Thumbnail side. Defaults to config.TRIAGE_THUMBNAIL_SIZE.
+
+    Returns:
+        dict: Arrays with one value per patch:
+              'variance' of the gray levels (0-255 scale),
+              'edge_density', the fraction of pixels whose gradient magnitude exceeds
+              config.TRIAGE_EDGE_MAGNITUDE, and
+              'entropy' of the gray-level histogram, in bits (0 to log2(ENTROPY_BINS)).
+    """
+    size = size or config.TRIAGE_THUMBNAIL_SIZE
+    if not patches:
+        empty = np.zeros(0, dtype=np.float32)
+        return {'variance': empty, 'edge_density': empty, 'entropy': empty}
+
+    stack = np.stack([_downsampled_gray(patch, size) for patch in patches]) # (N, size, size)
+    count = len(patches)
+
+    variance = stack.var(axis=(1, 2))
+
+    gx = np.diff(stack, axis=2)[:, :-1, :]
+    gy = np.diff(stack, axis=1)[:, :, :-1]
+    magnitude = np.sqrt(gx * gx + gy * gy)
+    edge_density = (magnitude > config.TRIAGE_EDGE_MAGNITUDE).mean(axis=(1, 2))
+
+    # One bincount for all patches: offset each patch's bins so the histograms don't mix
+    bins = (stack.astype(np.uint8) >> int(np.log2(256 // ENTROPY_BINS))).reshape(count, -1).astype(np.int64)
+    bins += np.arange(count)[:, None] * ENTROPY_BINS
+    histograms = np.bincount(bins.ravel(), minlength=count * ENTROPY_BINS).reshape(count, ENTROPY_BINS)
+    probabilities = histograms / histograms.sum(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        entropy = np.nansum(probabilities * np.log2(1.0 / probabilities), axis=1)
+
+    return {'variance': variance, 'edge_density': edge_density, 'entropy': entropy}
+
+def triage_patches(patches, target_classes=None, objectness=None, raw_detector=None):
+    """
+    Decides the trivially empty and obviously busy patches locally, before asking the agent.
+
+    A patch is auto-SKIPped only when it is nearly uniform, has no edges and little tonal
+    variety, all at once: the statistics are averages over the whole patch, so any one of
+    them alone can be low for a small object on a plain background. It is auto-ANALYZEd when it is
+    both edge-dense and tonally rich, if those thresholds are set. Optionally, the remaining
+    patches are run through the detector at a low threshold, and any target-class hit
+    ANALYZEs the patch. Thresholds come from the TRIAGE_* settings in src/config.py.
+
+    Args:
+        patches (list[image_utils.Patch]): The patches to triage.
+        target_classes (list[str], optional): Classes that count as a hit for the objectness check.
+        objectness (bool, optional): Run the low-threshold detector check. Defaults to
+                                     config.TRIAGE_USE_DETECTOR.
+        raw_detector (callable, optional): Runs the objectness check, with the same signature as
+                                           `vision_tool_interface.detect_raw_batch` (the default),
+                                           e.g. `DetectionPool.detect_raw_batch` to use worker processes.
+
+    Returns:
+        list: 'SKIP' or 'ANALYZE' for the patches decided locally, None for the patches that
+              still need the agent.
+    """
+    stats = patch_statistics(patches)
+    variance, edge_density, entropy = stats['variance'], stats['edge_density'], stats['entropy']
+
+    skip = ((variance <= config.TRIAGE_SKIP_MAX_VARIANCE) & (edge_density <= config.TRIAGE_SKIP_MAX_EDGE_DENSITY)
+            & (entropy <= config.TRIAGE_SKIP_MAX_ENTROPY))
+    analyze = np.zeros(len(patches), dtype=bool)
+    if config.TRIAGE_ANALYZE_MIN_EDGE_DENSITY is not None and config.TRIAGE_ANALYZE_MIN_ENTROPY is not None:
+        analyze = ~skip & (edge_density >= config.TRIAGE_ANALYZE_MIN_EDGE_DENSITY) & (entropy >= config.TRIAGE_ANALYZE_MIN_ENTROPY)
+
+    decisions = [None] * len(patches)
+    for i in np.flatnonzero(skip):
+        decisions[i] = "SKIP"
+    for i in np.flatnonzero(analyze):
+        decisions[i] = "ANALYZE"
+
+    if objectness is None:
+        objectness = config.TRIAGE_USE_DETECTOR
+    undecided = [i for i, decision in enumerate(decisions) if decision is None]
+    if objectness and undecided:
+        if raw_detector is None:
+            from . import vision_tool_interface
+            raw_detector = vision_tool_interface.detect_raw_batch
+        thumbnails = [_downsampled_rgb(patches[i], config.TRIAGE_DETECTOR_SIZE) for i in undecided]
+        raw = raw_detector(thumbnails, threshold=config.TRIAGE_DETECTOR_THRESHOLD)
+        for i, detections in zip(undecided, raw):
+            if detections and any(not target_classes or det['label'] in target_classes for det in detections):
+                decisions[i] = "ANALYZE"
+
+    with _stats_lock:
+        _stats['patches'] += len(patches)
+        _stats['skipped'] += decisions.count("SKIP")
+        _stats['analyzed'] += decisions.count("ANALYZE")
+    return decisions
@@ -1,16 +1,358 @@
+import threading
 from PIL import Image
-from transformers import DetrImageProcessor, DetrForObjectDetection
-import torch
-
-# Initialize model and processor
-try:
-    processor = DetrImageProcessor.from_pretrained("facebook/detr-resnet-50")
-    model = DetrForObjectDetection.from_pretrained("facebook/detr-resnet-50")
-except Exception as e:
-    print(f"Error loading Hugging Face model or processor: {e}")
-    # Set to None so that functions using them can check and fail gracefully
-    processor = None
-    model = None
+from . import cache as cache_utils
+from . import config
+from . import detector_backends
+from . import image_utils
+from . import instrumentation
+
+# torch and transformers are imported inside Detector, so importing this module stays cheap
+MODEL_ID = config.DETECTOR_MODEL_ID
+DETECTION_THRESHOLD = 0.7
+DEFAULT_BATCH_SIZE = 8
+
+class Detector:
+    """
+    A loaded DETR model, its processor and the backend that runs it.
+
+    Detectors are created on first use through `Detector.get`, which keeps one instance per
+    (model id, device, backend configuration) for the life of the process, so the weights are
+    loaded (and exported) at most once and only when detection actually runs.
+    """
+
+    _instances = {}
+    _lock = threading.Lock()
+
+    def __init__(self, model_id: str = MODEL_ID, device: str = None, backend: str = "eager",
+                 quantize: bool = False, input_sizes: tuple = None):
+        """
+        Loads the processor and model weights. Prefer `Detector.get`, which reuses instances.
+
+        Args:
+            model_id (str): Hugging Face model id.
+            device (str, optional): torch device, e.g. 'cpu' or 'cuda'. Defaults to CUDA when
+                                    available, otherwise the CPU.
+            backend (str): 'eager', 'torchscript' or 'onnx' (see detector_backends).
+            quantize (bool): Apply dynamic int8 quantization (CPU only).
+            input_sizes (tuple, optional): Fixed (height, width) input buckets. None keeps the
+                                           processor's dynamic resizing, which only 'eager' supports;
+                                           the exported backends then use DEFAULT_INPUT_SIZES.
+        """
+        import torch
+        from transformers import DetrImageProcessor, DetrForObjectDetection
+
+        self.model_id = model_id
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.processor = DetrImageProcessor.from_pretrained(model_id)
+        self.model = DetrForObjectDetection.from_pretrained(model_id).to(self.device)
+        self.model.eval()
+
+        if input_sizes is None and (backend != "eager" or quantize):
+            input_sizes = detector_backends.DEFAULT_INPUT_SIZES
+        self.input_sizes = tuple(tuple(size) for size in input_sizes) if input_sizes else None
+        self.backend_name = backend
+        self.signature = detector_backends.backend_signature(backend, quantize, self.input_sizes)
+        self.backend = None
+        if self.input_sizes:
+            self.backend = detector_backends.create_backend(backend, self.model, self.device, model_id, quantize)
+
+    @classmethod
+    def get(cls, model_id: str = MODEL_ID, device: str = None, backend: str = None,
+            quantize: bool = None, input_sizes: tuple = None) -> "Detector":
+        """
+        Returns the shared detector for a model, device and backend, loading it on the first call.
+
+        Args:
+            model_id (str): Hugging Face model id.
+            device (str, optional): torch device. Defaults to config.DETECTOR_DEVICE, then to
+                                    CUDA when available, otherwise the CPU.
+            backend (str, optional): Inference backend. Defaults to config.DETECTOR_BACKEND.
+            quantize (bool, optional): Dynamic int8 quantization. Defaults to config.DETECTOR_QUANTIZE_INT8.
+            input_sizes (tuple, optional): Fixed input buckets. Defaults to config.DETECTOR_INPUT_SIZES.
+
+        Returns:
+            Detector: The loaded detector.
+
+        Raises:
+            Exception: Whatever loading the model raised (e.g. no network for the first download).
+        """
+        device = device or config.DETECTOR_DEVICE
+        backend = backend or config.DETECTOR_BACKEND
+        quantize = config.DETECTOR_QUANTIZE_INT8 if quantize is None else quantize
+        input_sizes = input_sizes or config.DETECTOR_INPUT_SIZES
+        input_sizes = tuple(tuple(size) for size in input_sizes) if input_sizes else None
+        key = (model_id, device, backend, quantize, input_sizes)
+        detector = cls._instances.get(key)
+        if detector is None:
+            with cls._lock:
+                detector = cls._instances.get(key)
+                if detector is None:
+                    print(f"Loading object detection model {model_id} ({backend}{', int8' if quantize else ''})...")
+                    detector = cls(model_id, device, backend, quantize, input_sizes)
+                    cls._instances[key] = detector
+        return detector
+
+    def warmup(self, image_size: tuple = (800, 800)):
+        """
+        Runs one forward pass on a blank image so that the first real call doesn't pay for
+        lazy initialization (kernel selection, memory allocation). With fixed input sizes,
+        every bucket is run once, which also traces or exports it.
+
+        Args:
+            image_size (tuple): (width, height) of the blank image.
+        """
+        if self.input_sizes:
+            for height, width in self.input_sizes:
+                self.detect_raw_batch([Image.new('RGB', (width, height))], batch_size=1)
+            return
+        self.detect_raw_batch([Image.new('RGB', image_size)], batch_size=1)
+
+    def detect_raw_batch(self, images: list[Image.Image], batch_size: int = DEFAULT_BATCH_SIZE, threshold: float = DETECTION_THRESHOLD):
+        """
+        Runs the model on RGB images, one forward pass per batch, without class filtering.
+
+        The processor resizes every image and pads the batch to a common size (the returned
+        pixel mask keeps the padding out of attention), so images of different sizes can be
+        stacked into a single pixel tensor. Boxes are scaled back with per-image target sizes.
+        With fixed input sizes, images are instead grouped by the bucket they fit best and
+        resized and padded to exactly that size, so the backend only ever sees a few shapes.
+
+        Args:
+            images (list[PIL.Image.Image]): RGB Pillow Image objects.
+            batch_size (int): Maximum number of images per forward pass.
+            threshold (float): Minimum score of a detection.
+
+        Returns:
+            list: One list of raw detections per image, in input order, or None for an image
+                  whose batch failed (so that callers don't cache the failure).
+        """
+        import torch
+
+        raw_detections = [None] * len(images)
+        batch_size = max(1, batch_size)
+        if self.input_sizes:
+            for bucket, indices in self._bucket_batches(images, batch_size):
+                self._detect_fixed(images, indices, bucket, threshold, raw_detections)
+            return raw_detections
+
+        for start in range(0, len(images), batch_size):
+            chunk = images[start:start + batch_size]
+            try:
+                with instrumentation.timer("detect.preprocess"):
+                    inputs = self.processor(images=chunk, return_tensors="pt").to(self.device)
+                with torch.inference_mode():
+                    # On CUDA the forward pass runs asynchronously; its time shows up in post-processing
+                    with instrumentation.timer("detect.forward"):
+                        outputs = self.model(**inputs)
+                    with instrumentation.timer("detect.postprocess"):
+                        # target_sizes expects [height, width] for every image in the batch
+                        target_sizes = torch.tensor([image.size[::-1] for image in chunk], device=self.device)
+                        results = self.processor.post_process_object_detection(outputs, threshold=threshold, target_sizes=target_sizes)
+
+                        for offset, result in enumerate(results):
+                            raw_detections[start + offset] = self._results_to_detections(result)
+            except Exception as e:
+                print(f"Error during batched object detection: {e}")
+
+        return raw_detections
+
+    def _bucket_batches(self, images, batch_size):
+        """
+        Groups images by the fixed input size they fit best, then splits every group into batches.
+
+        Returns:
+            list: (bucket, [image indices]) pairs, each holding at most `batch_size` images.
+        """
+        groups = {}
+        for index, image in enumerate(images):
+            bucket, _ = detector_backends.choose_input_size(image.size, self.input_sizes)
+            groups.setdefault(bucket, []).append(index)
+        return [(bucket, indices[start:start + batch_size])
+                for bucket, indices in groups.items()
+                for start in range(0, len(indices), batch_size)]
+
+    def _detect_fixed(self, images, indices, bucket, threshold, raw_detections):
+        """Runs one fixed-size batch through the backend, filling `raw_detections` at `indices`."""
+        import torch
+
+        chunk = [images[index] for index in indices]
+        try:
+            with instrumentation.timer("detect.preprocess"):
+                pixel_values, pixel_mask = detector_backends.preprocess_fixed(
+                    chunk, bucket, self.processor.image_mean, self.processor.image_std)
+            with instrumentation.timer("detect.forward"):
+                logits, pred_boxes = self.backend(pixel_values, pixel_mask)
+            with torch.inference_mode(), instrumentation.timer("detect.postprocess"):
+                outputs = detector_backends.as_detr_outputs(logits, pred_boxes)
+                target_sizes = torch.tensor([image.size[::-1] for image in chunk], device=outputs.logits.device)
+                results = self.processor.post_process_object_detection(outputs, threshold=threshold, target_sizes=target_sizes)
+                for index, result in zip(indices, results):
+                    raw_detections[index] = self._results_to_detections(result)
+        except Exception as e:
+            print(f"Error during batched object detection ({self.signature}): {e}")
+
+    def _results_to_detections(self, result):
+        """
+        Converts one post-processed DETR result into the detection dictionaries used by the workflow.
+
+        Args:
+            result (dict): A single entry from `processor.post_process_object_detection`,
+                           holding 'scores', 'labels' and 'boxes' tensors.
+
+        Returns:
+            list: A list of detection dictionaries with 'box' ([x, y, w, h]), 'label' and 'score'
+                  for every class the model knows.
+        """
+        detections = []
+        for score, label, box in zip(result["scores"].tolist(), result["labels"].tolist(), result["boxes"].tolist()):
+            class_name = self.model.config.id2label[label]
+
+            xmin, ymin, xmax, ymax = box
+            w = xmax - xmin
+            h = ymax - ymin
+
+            detection = {
+                'box': [int(xmin), int(ymin), int(w), int(h)],
+                'label': class_name,
+                'score': score
+            }
+            detections.append(detection)
+        return detections
+
+def _filter_detections(raw_detections, target_classes: list[str] = None):
+    """
+    Keeps the detections of the requested classes, returning fresh copies.
+
+    Raw detections may be shared with the detection cache, so callers always get
+    new dictionaries they are free to modify (e.g. to shift boxes into image coordinates).
+
+    Args:
+        raw_detections (list): Unfiltered detection dictionaries.
+        target_classes (list[str], optional): A list of class names to filter for.
+                                             If None or empty, keeps all classes.
+
+    Returns:
+        list: The filtered detection dictionaries.
+    """
+    return [
+        {'box': list(det['box']), 'label': det['label'], 'score': det['score']}
+        for det in raw_detections
+        if not target_classes or det['label'] in target_classes
+    ]
+
+def detection_cache_key(region_key: str, threshold: float = DETECTION_THRESHOLD) -> str:
+    """
+    Builds the detection cache key of an image region for the current model, backend and threshold.
+
+    Quantized or fixed-size inference can shift boxes and scores slightly, so a non-default
+    backend configuration gets its own keys; the default (eager, dynamic sizes) keeps the old ones.
+
+    Args:
+        region_key (str): Identifies the pixels, e.g. a digest of the source image plus the crop box.
+        threshold (float): The score threshold the detections were produced with.
+
+    Returns:
+        str: The cache key.
+    """
+    signature = detector_backends.backend_signature(config.DETECTOR_BACKEND, config.DETECTOR_QUANTIZE_INT8, config.DETECTOR_INPUT_SIZES)
+    if signature == detector_backends.backend_signature("eager", False, None):
+        return cache_utils.make_key('detection', region_key, MODEL_ID, threshold)
+    return cache_utils.make_key('detection', region_key, MODEL_ID, signature, threshold)
+
+def detect_raw_batch(images: list[Image.Image], batch_size: int = DEFAULT_BATCH_SIZE, threshold: float = DETECTION_THRESHOLD):
+    """
+    Runs the default detector (`Detector.get(MODEL_ID)`) on RGB images without class filtering,
+    loading the model on the first call.
+
+    Args:
+        images (list[PIL.Image.Image]): RGB Pillow Image objects.
+        batch_size (int): Maximum number of images per forward pass.
+        threshold (float): Minimum score of a detection.
+
+    Returns:
+        list: One list of raw detections per image, in input order, or None for an image
+              that could not be processed.
+    """
+    try:
+        detector = Detector.get(MODEL_ID)
+    except Exception as e:
+        print(f"Error loading Hugging Face model or processor: {e}")
+        return [None] * len(images)
+    return detector.detect_raw_batch(images, batch_size=batch_size, threshold=threshold)
+
+def _materialize(patch) -> Image.Image:
+    """Returns the RGB pixels of a lazy `image_utils.Patch` (cropped now) or of a Pillow image."""
+    image = patch.image if isinstance(patch, image_utils.Patch) else patch
+    return image if image.mode == 'RGB' else image.convert('RGB')
+
+def detect_objects_batch(patches: list, target_classes: list[str] = None, batch_size: int = DEFAULT_BATCH_SIZE,
+                         cache: cache_utils.TieredCache = None, region_keys: list[str] = None,
+                         threshold: float = DETECTION_THRESHOLD, raw_detector=None):
+    """
+    Detects objects in several image patches, running one DETR forward pass per batch.
+
+    Patches may be lazy `image_utils.Patch` views: they are cropped one batch at a time, right
+    before that batch runs, so at most `batch_size` crops are held in memory at once however
+    many regions are queued.
+
+    When a cache is given, the unfiltered detections of every patch are stored under a key
+    built from its region key, the model id and the threshold, so a later call for the same
+    region is served without inference, whatever its `target_classes`.
+
+    Args:
+        patches (list[PIL.Image.Image | image_utils.Patch]): The images or lazy patches to run detection on.
+        target_classes (list[str], optional): A list of class names to filter for.
+                                             If None or empty, detects all classes.
+        batch_size (int): Maximum number of patches per forward pass.
+        cache (TieredCache, optional): Cache of raw detections to read from and fill.
+        region_keys (list[str], optional): One key per patch identifying its pixels, e.g. the
+                                           source image digest plus the crop box. Defaults to
+                                           a digest of the patch pixels.
+        threshold (float): Minimum score of a detection.
+        raw_detector (callable, optional): Runs inference on the cache misses, with the same
+                                           signature as `detect_raw_batch` (the default), e.g.
+                                           `DetectionPool.detect_raw_batch` to use worker processes.
+                                           It is called once per batch.
+
+    Returns:
+        list: One list of detections per input patch, in input order. Each detection is a
+              dictionary with 'box' ([x, y, w, h]), 'label' (class_name) and 'score'.
+              A patch that could not be processed yields an empty list.
+    """
+    raw_detections = [[] for _ in patches]
+    cache_keys = [None] * len(patches)
+
+    # Keep track of the original index so that skipped patches don't shift the results
+    valid = []
+    for index, patch in enumerate(patches):
+        if not patch:
+            print(f"Error: Input patch {index} is None.")
+            continue
+        if cache is not None:
+            region_key = region_keys[index] if region_keys else cache_utils.image_digest(_materialize(patch))
+            cache_keys[index] = detection_cache_key(region_key, threshold)
+            cached = cache.get(cache_keys[index])
+            if cached is not None:
+                raw_detections[index] = cached
+                instrumentation.count("detection_cache.hits")
+                continue
+        valid.append(index)
+
+    if valid:
+        instrumentation.count("detect.patches", len(valid))
+        raw_detector = raw_detector or detect_raw_batch
+        batch_size = max(1, batch_size)
+        for start in range(0, len(valid), batch_size):
+            indices = valid[start:start + batch_size]
+            results = raw_detector([_materialize(patches[index]) for index in indices], batch_size=batch_size, threshold=threshold)
+            for index, raw in zip(indices, results):
+                if raw is None:
+                    continue
+                raw_detections[index] = raw
+                if cache is not None:
+                    cache.put(cache_keys[index], raw)
+
+    return [_filter_detections(raw, target_classes) for raw in raw_detections]
 
 def detect_objects(image_patch: Image.Image, target_classes: list[str] = None):
     """
@@ -27,48 +369,8 @@ def detect_objects(image_patch: Image.Image, target_classes: list[str] = None):
               Returns an empty list if no objects are detected, if the model failed to load,
               or an error occurs.
     """
-    if not processor or not model:
-        print("Error: Hugging Face model or processor not loaded. Cannot perform detection.")
-        return []
-
     if not image_patch:
         print("Error: Input image_patch is None.")
         return []
 
-    try:
-        # Ensure image is RGB
-        if image_patch.mode != 'RGB':
-            image_patch = image_patch.convert('RGB')
-
-        inputs = processor(images=image_patch, return_tensors="pt")
-        outputs = model(**inputs)
-
-        # Post-process results
-        # target_sizes expects [height, width]
-        results = processor.post_process_object_detection(outputs, threshold=0.7, target_sizes=torch.tensor([image_patch.size[::-1]]))
-
-        detections = []
-        if results and len(results) > 0:
-            for score, label, box in zip(results[0]["scores"], results[0]["labels"], results[0]["boxes"]):
-                class_name = model.config.id2label[label.item()]
-
-                # Filter by target_classes if provided
-                if target_classes and class_name not in target_classes:
-                    continue
-
-                xmin, ymin, xmax, ymax = box.tolist()
-                w = xmax - xmin
-                h = ymax - ymin
-                
-                detection = {
-                    'box': [int(xmin), int(ymin), int(w), int(h)],
-                    'label': class_name,
-                    'score': score.item()
-                }
-                detections.append(detection)
-        
-        return detections
-
-    except Exception as e:
-        print(f"Error during object detection: {e}")
-        return []
+    return detect_objects_batch([image_patch], target_classes, batch_size=1)[0]
@@ -0,0 +1,68 @@
+import numpy as np
+from PIL import Image, ImageDraw
+from src import box_merge
+
+def _arrays(boxes, scores, labels):
+    return np.array(boxes, dtype=np.float64), np.array(scores, dtype=np.float64), np.array(labels)
+
+LEFT, RIGHT = [0, 0, 100, 100], [100, 0, 200, 100]
+
+def _image(*rectangles):
+    image = Image.new("RGB", (200, 100), (120, 120, 120))
+    draw = ImageDraw.Draw(image)
+    for box, fill in rectangles:
+        draw.rectangle(box, fill=fill)
+    return image
+
+def test_nms_keeps_the_best_box_of_each_class():
+    boxes, scores, labels = _arrays([[0, 0, 10, 10], [1, 1, 10, 10], [1, 1, 10, 10], [50, 50, 10, 10]],
+                                    [0.6, 0.9, 0.8, 0.7], ["car", "car", "dog", "car"])
+    boxes, scores, labels = box_merge.merge_boxes(boxes, scores, labels, iou_threshold=0.5)
+    assert scores.tolist() == [0.9, 0.8, 0.7]
+    assert labels.tolist() == ["car", "dog", "car"]
+    assert boxes[0].tolist() == [1, 1, 10, 10]
+
+def test_wbf_averages_duplicates_by_score():
+    boxes, scores, labels = _arrays([[0, 0, 10, 10], [2, 0, 10, 10]], [0.75, 0.25], ["car", "car"])
+    boxes, scores, _ = box_merge.merge_boxes(boxes, scores, labels, iou_threshold=0.5, method="wbf")
+    assert scores.tolist() == [0.75]
+    np.testing.assert_allclose(boxes[0], [0.5, 0, 10, 10])
+
+def test_ios_merges_a_partial_box_into_the_full_one():
+    boxes, scores, labels = _arrays([[0, 0, 40, 20], [20, 0, 20, 20]], [0.9, 0.5], ["car", "car"])
+    assert len(box_merge.merge_boxes(boxes, scores, labels, metric="iou")[1]) == 2
+    assert len(box_merge.merge_boxes(boxes, scores, labels, metric="ios")[1]) == 1
+
+def test_object_cut_by_a_patch_edge_is_joined():
+    image = _image(([60, 40, 139, 59], (220, 40, 40)))
+    boxes, scores, labels = _arrays([[60, 40, 40, 20], [100, 40, 40, 20]], [0.9, 0.6], ["car", "car"])
+    boxes, scores, _ = box_merge.merge_boxes(boxes, scores, labels, regions=np.array([LEFT, RIGHT]), image=image)
+    assert boxes.tolist() == [[60, 40, 80, 20]]
+    assert scores.tolist() == [0.9]
+
+def test_separate_objects_touching_a_patch_edge_are_not_joined():
+    # Same boxes as above, but the image shows two objects meeting at the edge
+    image = _image(([60, 40, 99, 59], (220, 40, 40)), ([100, 40, 139, 59], (40, 40, 220)))
+    boxes, scores, labels = _arrays([[60, 40, 40, 20], [100, 40, 40, 20]], [0.9, 0.6], ["car", "car"])
+    boxes, _, _ = box_merge.merge_boxes(boxes, scores, labels, regions=np.array([LEFT, RIGHT]), image=image)
+    assert len(boxes) == 2
+
+def test_border_boxes_must_reach_the_edge_and_line_up():
+    image = _image(([60, 10, 139, 89], (220, 40, 40)))
+    regions = np.array([LEFT, RIGHT])
+    # The right box stops short of the edge
+    boxes, scores, labels = _arrays([[60, 40, 40, 20], [105, 40, 35, 20]], [0.9, 0.6], ["car", "car"])
+    assert len(box_merge.merge_boxes(boxes, scores, labels, regions=regions, image=image)[1]) == 2
+    # A small box against the side of a much taller one
+    boxes, scores, labels = _arrays([[60, 10, 40, 80], [100, 40, 40, 20]], [0.9, 0.6], ["car", "car"])
+    assert len(box_merge.merge_boxes(boxes, scores, labels, regions=regions, image=image)[1]) == 2
+    # Different classes
+    boxes, scores, labels = _arrays([[60, 40, 40, 20], [100, 40, 40, 20]], [0.9, 0.6], ["car", "dog"])
+    assert len(box_merge.merge_boxes(boxes, scores, labels, regions=regions, image=image)[1]) == 2
+
+def test_border_fusion_needs_regions_and_image():
+    image = _image(([60, 40, 139, 59], (220, 40, 40)))
+    boxes, scores, labels = _arrays([[60, 40, 40, 20], [100, 40, 40, 20]], [0.9, 0.6], ["car", "car"])
+    assert len(box_merge.merge_boxes(boxes, scores, labels)[1]) == 2
+    assert len(box_merge.merge_boxes(boxes, scores, labels, regions=np.array([LEFT, RIGHT]))[1]) == 2
+    assert len(box_merge.merge_boxes(boxes, scores, labels, regions=np.array([LEFT, RIGHT]), image=np.asarray(image))[1]) == 1
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from PIL import Image
+from src import cache
+
+class FakeClock:
+    def __init__(self, start=1000.0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(cache.time, "time", fake.time)
+    return fake
+
+def test_memory_tier_evicts_least_recently_used(clock):
+    store = cache.TieredCache(memory_entries=2)
+    store.put("a", 1)
+    store.put("b", 2)
+    assert store.get("a") == 1 # "a" is now the most recently used
+    store.put("c", 3)
+    assert store.get("b") is None
+    assert store.get("a") == 1
+    assert store.get("c") == 3
+
+def test_entries_expire_after_ttl(clock, tmp_path):
+    store = cache.TieredCache(path=str(tmp_path / "cache.sqlite"), ttl_seconds=10)
+    store.put("a", {"decision": "SKIP"})
+    clock.now += 5
+    assert store.get("a") == {"decision": "SKIP"}
+    clock.now += 10
+    assert store.get("a") is None
+    assert store.stats()['disk_entries'] == 0
+
+def test_disk_tier_is_trimmed_to_max_entries(clock, tmp_path):
+    store = cache.TieredCache(path=str(tmp_path / "cache.sqlite"), memory_entries=1, max_entries=2)
+    for i, key in enumerate("abc"):
+        clock.now += 1
+        store.put(key, i)
+    assert store.stats()['disk_entries'] == 2
+    assert store.get("a") is None
+    assert store.get("b") == 1
+    assert store.get("c") == 2
+
+def test_disk_tier_survives_restart(clock, tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    store = cache.TieredCache(path=path)
+    store.put("a", [1, 2, 3])
+    store.close()
+
+    reopened = cache.TieredCache(path=path)
+    assert reopened.get("a") == [1, 2, 3]
+    assert reopened.stats()['disk_hits'] == 1
+    assert reopened.stats()['disk_entries'] == 1
+
+def test_decision_key_by_region_does_not_read_pixels():
+    region = cache.region_key("digest", (0, 0, 10, 10))
+    key = cache.decision_key(None, "prompt", model="m", region=region)
+    assert key == cache.decision_key(None, "prompt", model="m", region=region)
+    assert key != cache.decision_key(None, "prompt", model="m", region=cache.region_key("digest", (10, 0, 20, 10)))
+    assert key != cache.decision_key(Image.fromarray(np.zeros((10, 10, 3), dtype=np.uint8)), "prompt", model="m")
@@ -0,0 +1,22 @@
+import json
+import os
+from src import cli
+from src.main_workflow import ImageJob, WorkflowSettings
+
+def test_resume_matches_paths_however_they_are_spelled(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "images").mkdir()
+    (tmp_path / "images" / "a.png").write_bytes(b"")
+    job = ImageJob("./images/a.png", WorkflowSettings())
+    results = tmp_path / "results.jsonl"
+    results.write_text(json.dumps(cli.job_record(job)) + "\n")
+
+    completed = cli.load_completed(str(results))
+    assert completed == {os.path.abspath("images/a.png")}
+    for spelling in ["images/a.png", "./images/a.png", str(tmp_path / "images" / "a.png")]:
+        assert os.path.abspath(spelling) in completed
+
+def test_expand_inputs_yields_each_image_once(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "a.png").write_bytes(b"")
+    assert list(cli.expand_inputs(["a.png", "./a.png", "*.png"])) == ["a.png"]
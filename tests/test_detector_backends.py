@@ -0,0 +1,26 @@
+import os
+import pytest
+from src import detector_backends
+
+def test_write_atomically_replaces_the_file(tmp_path):
+    path = str(tmp_path / "model.onnx")
+    detector_backends._write_atomically(path, lambda tmp: open(tmp, "w").write("new"))
+    assert open(path).read() == "new"
+    assert os.listdir(tmp_path) == ["model.onnx"]
+
+def test_failed_write_leaves_no_partial_file(tmp_path):
+    path = str(tmp_path / "model.onnx")
+
+    def write(tmp):
+        open(tmp, "w").write("partial")
+        raise RuntimeError("export failed")
+
+    with pytest.raises(RuntimeError):
+        detector_backends._write_atomically(path, write)
+    assert os.listdir(tmp_path) == []
+
+@pytest.mark.parametrize("image_size, expected", [((1600, 1000), (800, 1088)), ((500, 500), (800, 800)), ((600, 1200), (1088, 800))])
+def test_choose_input_size_picks_the_best_filled_bucket(image_size, expected):
+    bucket, resized = detector_backends.choose_input_size(image_size, detector_backends.DEFAULT_INPUT_SIZES)
+    assert bucket == expected
+    assert resized[0] <= bucket[1] and resized[1] <= bucket[0]
@@ -0,0 +1,44 @@
+import os
+import numpy as np
+from PIL import Image
+from src import image_utils
+
+def test_failed_decode_removes_temp_file(tmp_path):
+    broken = tmp_path / "broken.png"
+    broken.write_bytes(b"not an image")
+    cache_dir = tmp_path / "tiles"
+    assert image_utils.load_image_memmap(str(broken), str(cache_dir)) is None
+    assert os.listdir(cache_dir) == []
+
+def test_memmap_matches_decoded_image(tmp_path):
+    pixels = np.random.default_rng(0).integers(0, 256, (40, 30, 3), dtype=np.uint8)
+    path = tmp_path / "image.png"
+    Image.fromarray(pixels).save(path)
+    mapped = image_utils.load_image_memmap(str(path), str(tmp_path / "tiles"), strip_height=7)
+    assert np.array_equal(mapped, pixels)
+
+def test_tile_cache_is_trimmed_to_max_bytes(tmp_path):
+    cache_dir = tmp_path / "tiles"
+    paths = []
+    for i in range(3):
+        path = tmp_path / f"image{i}.png"
+        Image.fromarray(np.full((100, 100, 3), i, dtype=np.uint8)).save(path)
+        paths.append(str(path))
+    image_utils.load_image_memmap(paths[0], str(cache_dir))
+    image_utils.load_image_memmap(paths[1], str(cache_dir))
+    first, second = (image_utils._raw_cache_path(p, str(cache_dir)) for p in paths[:2])
+    os.utime(first, (1000, 1000))
+    os.utime(second, (2000, 2000))
+    size = os.path.getsize(first)
+
+    # Room for two files: the least recently used one goes, the new one stays
+    image_utils.load_image_memmap(paths[2], str(cache_dir), max_cache_bytes=2 * size)
+    assert not os.path.exists(first)
+    assert os.path.exists(second)
+    assert os.path.exists(image_utils._raw_cache_path(paths[2], str(cache_dir)))
+
+def test_trim_keeps_the_current_file(tmp_path):
+    path = tmp_path / "image.png"
+    Image.fromarray(np.zeros((50, 50, 3), dtype=np.uint8)).save(path)
+    image_utils.load_image_memmap(str(path), str(tmp_path), max_cache_bytes=0)
+    assert os.path.exists(image_utils._raw_cache_path(str(path), str(tmp_path)))
@@ -0,0 +1,106 @@
+import pytest
+from PIL import Image
+from src import config
+from src import image_utils
+from src import main_workflow
+from src import openrouter_agent
+from src.main_workflow import parse_batch_decisions
+from src.openrouter_agent import AgentResult
+
+@pytest.mark.parametrize("text, expected", [
+    ('{"1": "ANALYZE", "2": "SKIP", "3": "EXPAND_CONTEXT"}', ["ANALYZE", "SKIP", "EXPAND_CONTEXT"]),
+    ('Sure:\n```json\n{"1": "skip", "2": "analyze", "3": "skip"}\n```', ["SKIP", "ANALYZE", "SKIP"]),
+    ('{"Patch 1": "SKIP", "#2": "ANALYZE", " 3 ": "SKIP"}', ["SKIP", "ANALYZE", "SKIP"]),
+])
+def test_parse_batch_decisions_valid(text, expected):
+    assert parse_batch_decisions(text, 3) == expected
+
+def test_parse_batch_decisions_partial():
+    # Missing, unclear, out-of-range and non-numeric entries are left undecided
+    text = '{"1": "ANALYZE", "3": "maybe", "4": "SKIP", "two": "SKIP"}'
+    assert parse_batch_decisions(text, 3) == ["ANALYZE", None, None]
+
+@pytest.mark.parametrize("text", [
+    'ANALYZE all of them',
+    '{"1": "ANALYZE", "2": }',
+    '["ANALYZE", "SKIP", "SKIP"]',
+    '{"1": "ANALYZE"} and {"2": "SKIP"}', # two objects: the greedy match is not valid JSON
+    '',
+    None,
+])
+def test_parse_batch_decisions_malformed_or_not_a_dict(text):
+    assert parse_batch_decisions(text, 3) == [None, None, None]
+
+class FakeAgent:
+    """Answers agent requests from a function of the request and records every request."""
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.requests = []
+
+    def __call__(self, requests):
+        for index, (prompt, images) in enumerate(requests):
+            self.requests.append((prompt, images))
+            yield index, self.answer(prompt, images)
+
+def _job(batch_size):
+    settings = main_workflow.WorkflowSettings(decision_batch_size=batch_size, triage=False)
+    job = main_workflow.ImageJob("image.png", settings)
+    job.image = Image.new("RGB", (200, 200))
+    job.patches = image_utils.partition_image(job.image, 2, 2)
+    return job
+
+@pytest.fixture(autouse=True)
+def no_decision_cache(monkeypatch):
+    monkeypatch.setattr(config, "DECISION_CACHE_ENABLED", False)
+
+def test_unclear_batch_answers_fall_back_to_single_requests(monkeypatch):
+    def answer(prompt, images):
+        if isinstance(images, list):
+            return AgentResult(text='{"1": "ANALYZE", "2": "??", "3": "SKIP"}')
+        return AgentResult(text="EXPAND_CONTEXT")
+
+    agent = FakeAgent(answer)
+    monkeypatch.setattr(openrouter_agent, "iter_agent_responses", agent)
+    job = _job(batch_size=4)
+    # Four patches in one batch request; the fourth has no answer at all
+    decisions = main_workflow.decide_patches(job, job.patches)
+    assert decisions == ["ANALYZE", "EXPAND_CONTEXT", "SKIP", "EXPAND_CONTEXT"]
+    assert len(agent.requests) == 3
+    assert [len(images) for _, images in agent.requests if isinstance(images, list)] == [4]
+
+def test_unparseable_batch_reply_asks_every_patch_again(monkeypatch):
+    def answer(prompt, images):
+        if isinstance(images, list):
+            return AgentResult(text="I cannot answer in JSON.")
+        return AgentResult(text="ANALYZE")
+
+    agent = FakeAgent(answer)
+    monkeypatch.setattr(openrouter_agent, "iter_agent_responses", agent)
+    job = _job(batch_size=2)
+    assert main_workflow.decide_patches(job, job.patches) == ["ANALYZE"] * 4
+    assert len(agent.requests) == 2 + 4
+
+def test_failed_batch_request_is_not_retried_per_patch(monkeypatch):
+    agent = FakeAgent(lambda prompt, images: AgentResult(error="HTTP 503"))
+    monkeypatch.setattr(openrouter_agent, "iter_agent_responses", agent)
+    job = _job(batch_size=2)
+    failed = set()
+    decisions = main_workflow.decide_patches(job, job.patches, failed=failed)
+    assert decisions == [config.AGENT_FAILURE_DECISION] * 4
+    assert failed == {0, 1, 2, 3}
+    assert job.agent_failures == 4
+    assert len(agent.requests) == 2
+
+@pytest.mark.parametrize("max_depth", [0, 2, 4])
+def test_quadtree_does_not_split_tiles_whose_request_failed(monkeypatch, max_depth):
+    agent = FakeAgent(lambda prompt, images: AgentResult(error="HTTP 503"))
+    monkeypatch.setattr(openrouter_agent, "iter_agent_responses", agent)
+    settings = main_workflow.WorkflowSettings(scheduler="quadtree", min_tile_size=8, max_depth=max_depth, triage=False)
+    job = main_workflow.ImageJob("image.png", settings)
+    job.image = Image.new("RGB", (400, 400))
+    job.patches = image_utils.partition_image(job.image, 2, 2)
+    main_workflow.decide_stage(job)
+    # One request per root tile, however deep the tree could go; every root tile goes to detection
+    assert len(agent.requests) == 4
+    assert sorted(patch.coords for patch in job.detection_jobs) == sorted(patch.coords for patch in job.patches)
@@ -0,0 +1,36 @@
+import threading
+import time
+from src import openrouter_agent
+from src.openrouter_agent import AgentResult
+
+def test_requests_run_on_long_lived_threads(monkeypatch):
+    threads = set()
+
+    def request_agent(prompt, image):
+        threads.add(threading.get_ident())
+        return AgentResult(text=prompt)
+
+    monkeypatch.setattr(openrouter_agent, "request_agent", request_agent)
+    for _ in range(5):
+        results = dict(openrouter_agent.iter_agent_responses([(str(i), None) for i in range(4)]))
+        assert {i: r.text for i, r in results.items()} == {i: str(i) for i in range(4)}
+    # Five calls share one pool instead of starting new threads (and encode buffers) each time
+    assert len(threads) <= openrouter_agent.config.OPENROUTER_MAX_CONCURRENCY
+
+def test_max_concurrency_limits_one_call(monkeypatch):
+    running = {'now': 0, 'peak': 0}
+    lock = threading.Lock()
+
+    def request_agent(prompt, image):
+        with lock:
+            running['now'] += 1
+            running['peak'] = max(running['peak'], running['now'])
+        time.sleep(0.02)
+        with lock:
+            running['now'] -= 1
+        return AgentResult(text=prompt)
+
+    monkeypatch.setattr(openrouter_agent, "request_agent", request_agent)
+    results = list(openrouter_agent.iter_agent_responses([(str(i), None) for i in range(8)], max_concurrency=2))
+    assert sorted(index for index, _ in results) == list(range(8))
+    assert running['peak'] <= 2
@@ -0,0 +1,62 @@
+import itertools
+import threading
+from src.pipeline import Pipeline, Stage, StageFailure
+
+def _pipeline_threads():
+    return [t for t in threading.enumerate() if t.name.startswith("pipeline-")]
+
+def test_items_pass_through_every_stage():
+    pipeline = Pipeline([Stage("double", lambda x: x * 2, workers=3), Stage("inc", lambda x: x + 1)])
+    assert sorted(pipeline.run(range(10))) == [x * 2 + 1 for x in range(10)]
+    assert len(pipeline.stage_seconds["double"]) == 10
+    assert len(pipeline.stage_seconds["inc"]) == 10
+
+def test_failing_stage_yields_failure_and_skips_later_stages():
+    later = []
+
+    def check(x):
+        if x == 3:
+            raise ValueError("bad item")
+        return x
+
+    def record(x):
+        later.append(x)
+        return x
+
+    results = list(Pipeline([Stage("check", check), Stage("record", record)]).run(range(5)))
+    failures = [r for r in results if isinstance(r, StageFailure)]
+    assert len(failures) == 1
+    assert failures[0].stage == "check"
+    assert failures[0].item == 3
+    assert isinstance(failures[0].error, ValueError)
+    assert sorted(r for r in results if not isinstance(r, StageFailure)) == [0, 1, 2, 4]
+    assert 3 not in later
+
+def test_closing_early_stops_workers_and_input():
+    consumed = []
+
+    def items():
+        for i in itertools.count():
+            consumed.append(i)
+            yield i
+
+    results = Pipeline([Stage("a", lambda x: x, workers=2), Stage("b", lambda x: x)], queue_size=2).run(items())
+    assert next(results) is not None
+    results.close()
+    assert _pipeline_threads() == []
+    # Backpressure bounds how far the feeder got ahead of the consumer
+    assert len(consumed) < 20
+
+def test_raising_input_generator_yields_failure_and_finishes():
+    def items():
+        yield 1
+        yield 2
+        raise RuntimeError("listing failed")
+
+    results = list(Pipeline([Stage("a", lambda x: x)]).run(items()))
+    failures = [r for r in results if isinstance(r, StageFailure)]
+    assert len(failures) == 1
+    assert failures[0].stage == "input"
+    assert isinstance(failures[0].error, RuntimeError)
+    assert sorted(r for r in results if not isinstance(r, StageFailure)) == [1, 2]
+    assert _pipeline_threads() == []
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+from src import image_utils
+from src import triage
+
+def _plain_patch(noise=0.0, seed=0):
+    pixels = np.full((1000, 1000, 3), 120, dtype=np.float32)
+    if noise:
+        pixels += np.random.default_rng(seed).normal(0, noise, pixels.shape)
+    return Image.fromarray(pixels.clip(0, 255).astype(np.uint8))
+
+@pytest.mark.parametrize("noise", [0.0, 3.0])
+@pytest.mark.parametrize("size", [(30, 30), (50, 50), (80, 80), (120, 60)])
+def test_small_object_on_plain_background_is_not_skipped(noise, size):
+    image = _plain_patch(noise)
+    ImageDraw.Draw(image).rectangle([500, 500, 500 + size[0], 500 + size[1]], fill=(220, 220, 220))
+    decisions = triage.triage_patches([image_utils.Patch(image, (0, 0, 1000, 1000))], objectness=False)
+    assert decisions == [None]
+
+@pytest.mark.parametrize("noise", [0.0, 3.0])
+def test_blank_patch_is_skipped(noise):
+    image = _plain_patch(noise)
+    decisions = triage.triage_patches([image_utils.Patch(image, (0, 0, 1000, 1000))], objectness=False)
+    assert decisions == ["SKIP"]
+
+def test_objectness_check_uses_the_given_detector_on_small_thumbnails(monkeypatch):
+    monkeypatch.setattr(triage.config, "TRIAGE_DETECTOR_SIZE", 100)
+    source = np.random.default_rng(0).integers(0, 256, (500, 2000, 3), dtype=np.uint8)
+    patches = [image_utils.Patch(source, (0, 0, 1000, 500)), image_utils.Patch(source, (1000, 0, 2000, 500))]
+    calls = []
+
+    def raw_detector(images, threshold):
+        calls.append([image.size for image in images])
+        return [[{'label': 'car'}], [{'label': 'tree'}]]
+
+    decisions = triage.triage_patches(patches, ["car"], objectness=True, raw_detector=raw_detector)
+    assert calls == [[(100, 50), (100, 50)]]
+    assert decisions == ["ANALYZE", None]